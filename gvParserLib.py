@@ -1,9 +1,85 @@
 import datetime
+import array
+import os
+import sys
 import re
+import io
+import time
+import zlib
+import marshal
+import sqlite3
+import hashlib
+import threading
+import Queue
+import zipfile
+import tarfile
+import heapq
+import itertools
+import warnings
+import collections
+import contextlib
 import htmlentitydefs
 from dateutil import tz
 import dateutil.parser
 import html5lib
+try:
+    import lxml.etree
+except ImportError: #the lxml engine is optional
+    lxml = None
+try:
+    import numpy
+except ImportError: #only used to work over whole RecordBatch columns at once
+    numpy = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir #the scandir package backports it to Python 2
+    except ImportError:
+        scandir = None
+
+#The record classes test found nodes for truth, which in ElementTree means "has
+#children". lxml keeps that meaning but warns that it may change one day.
+warnings.filterwarnings("ignore", category=FutureWarning, module=__name__)
+
+XHTML = "{http://www.w3.org/1999/xhtml}"
+
+#A 64-bit array typecode. Python 2's array has no 'q', but its 'l' is 64 bits on
+#the platforms that matter.
+try:
+    array.array('q')
+    _INT64 = 'q'
+except ValueError:
+    _INT64 = 'l'
+
+#Bump whenever a change to the parser changes the records it reads from a file,
+#so that records cached by an older version are not used
+PARSER_VERSION = 3
+
+def _xhtml_path(path):
+    ''' turns a regular xpath expression into an XHTML one'''
+    return re.sub('/(?=\w)', '/' + XHTML, path)
+
+class Paths:
+    '''Every tree query the record classes make, translated to XHTML once at import
+    rather than through Parser.as_xhtml on every lookup'''
+    a                 = XHTML + 'a'
+    div               = XHTML + 'div'
+    span              = XHTML + 'span'
+    title             = _xhtml_path('.//title')
+    sender_tel        = _xhtml_path('.//cite[@class="sender vcard"]/a[@class="tel"]')
+    contributor_tel   = _xhtml_path('.//div[@class="contributor vcard"]/a[@class="tel"]')
+    fn                = _xhtml_path('./span[@class="fn"]')
+    abbr              = dict((c, _xhtml_path('./abbr[@class="%s"]' % c)) for c in ('dt', 'published', 'duration'))
+    haudio            = _xhtml_path('.//div[@class="haudio"]')
+    audio             = _xhtml_path('./audio')
+    description       = _xhtml_path('./span[@class="description"]')
+    full_text         = _xhtml_path('./span[@class="full-text"]')
+    confidence        = _xhtml_path('./span/span[@class="confidence"]')
+    q                 = _xhtml_path('./q')
+    chatlog           = _xhtml_path('.//div[@class="hChatLog hfeed"]')
+    message           = _xhtml_path('./div[@class="message"]')
+    tags              = _xhtml_path('./div[@class="tags"]/a[@rel="tag"]')
 
 #Contacts
 class Contact(object):
@@ -29,11 +105,11 @@ class Contact(object):
     @staticmethod
     def get_node(node):
         '''Given an HTML node, finds the self-or-descendant that encodes a Contact'''
-        if node.tag == "{http://www.w3.org/1999/xhtml}a" and node.attrib["class"] == "tel":
+        if node.tag == Paths.a and node.attrib["class"] == "tel":
             return node
-        contactnode = node.find(Parser.as_xhtml('.//cite[@class="sender vcard"]/a[@class="tel"]'))
+        contactnode = node.find(Paths.sender_tel)
         if not contactnode:
-            contactnode = node.find(Parser.as_xhtml('.//div[@class="contributor vcard"]/a[@class="tel"]'))
+            contactnode = node.find(Paths.contributor_tel)
         return contactnode
 
     @classmethod
@@ -43,13 +119,11 @@ class Contact(object):
         contactnode = cls.get_node(node);
         contact_obj = cls()
         #name
-        contact_obj.name = contactnode.findtext(Parser.as_xhtml('./span[@class="fn"]'))
+        contact_obj.name = contactnode.findtext(Paths.fn)
         if not contact_obj.name: #If a blank string or none.
             contact_obj.name = None
-        #phone number
-        contactphonenumber = re.search('\d+', contactnode.attrib['href'])
-        if contactphonenumber:
-            contact_obj.phonenumber = contactphonenumber.group(0)
+        #phone number, as written: see PhoneNumbers.canonical for what it means
+        contact_obj.phonenumber = PhoneNumbers.digits(contactnode.attrib['href'])
 
         return contact_obj
 
@@ -77,7 +151,7 @@ class GVoiceRecord(object):
         ''' finds and returns the first GVoiceRecord beneath the node in the tree.'''
         record_obj = cls()
         record_obj.contact = Contact.from_node(node)
-        record_obj.date = ParseTools.parse_date(node.find(Parser.as_xhtml('./abbr[@class="%s"]' % date_class)).attrib["title"])
+        record_obj.date = ParseTools.parse_date(node.find(Paths.abbr[date_class]).attrib["title"])
         return record_obj
 
 class TelephonyRecord(GVoiceRecord):
@@ -100,10 +174,10 @@ class TelephonyRecord(GVoiceRecord):
     @staticmethod
     def get_node(node):
         '''Given an HTML node, finds the self-or-descendant that encodes a TelephonyRecord'''
-        if node.tag == "{http://www.w3.org/1999/xhtml}div" and node.attrib["class"] == "haudio":
+        if node.tag == Paths.div and node.attrib["class"] == "haudio":
             return node
 
-        node = node.find(Parser.as_xhtml('.//div[@class="haudio"]'))
+        node = node.find(Paths.haudio)
         return node if node else None
 
     @classmethod
@@ -116,12 +190,19 @@ class TelephonyRecord(GVoiceRecord):
             return None
         base_obj = GVoiceRecord.from_node(node, "published")
         telephony_obj = cls(base_obj.contact, base_obj.date)
+        telephony_obj.read_duration(node)
+        return telephony_obj
 
-        duration_text = node.findtext(Parser.as_xhtml('./abbr[@class="duration"]'))
+    def read_duration(self, node):
+        ''' reads the duration from an haudio node, if it has one. While Parser.numbers
+        is a NumberBatch the text is left to it to convert.'''
+        duration_text = node.findtext(Paths.abbr['duration'])
         if duration_text is not None: #but 0 is OK
-            telephony_obj.duration = ParseTools.parse_time(duration_text)
-
-        return telephony_obj
+            numbers = Parser.numbers
+            if numbers is None:
+                self.duration = ParseTools.parse_time(duration_text)
+            else:
+                numbers.add_duration(self, duration_text)
 
 
 class CallRecord(TelephonyRecord):
@@ -145,7 +226,7 @@ class CallRecord(TelephonyRecord):
         node = TelephonyRecord.get_node(node)
         if node is None:
             return None
-        if node.find(Parser.as_xhtml('./audio')): #is audio, not call
+        if node.find(Paths.audio): #is audio, not call
             return None
         return node
 
@@ -158,21 +239,22 @@ class CallRecord(TelephonyRecord):
         if node is None:
             return None
 
-        base_obj = TelephonyRecord.from_node(node)
-        calltype = ParseTools.get_label(node)
-
-        return cls(base_obj.contact, base_obj.date, base_obj.duration, calltype)
+        base_obj = GVoiceRecord.from_node(node, "published")
+        call_obj = cls(base_obj.contact, base_obj.date, calltype = ParseTools.get_label(node))
+        call_obj.read_duration(node)
+        return call_obj
 
 class AudioRecord(TelephonyRecord):
-    __slots__ = ['audiotype', 'text', 'confidence', 'filename']
+    __slots__ = ['audiotype', 'text', 'confidence', 'filename', 'confidences']
     #audioTypes = ['Recording', 'Voicemail']
     def __init__(self, contact = None, date = None, duration = None,
-                 audiotype = None, text = None, confidence = None, filename = None):
+                 audiotype = None, text = None, confidence = None, filename = None, confidences = None):
         super(AudioRecord, self).__init__(contact, date, duration)
         self.audiotype = audiotype
         self.text = text
-        self.confidence = confidence
+        self.confidence = confidence   #the mean of confidences
         self.filename = filename
+        self.confidences = confidences #an array of the transcript's per-word confidences
     def __repr__(self):
         return "AudioRecord(%s, %s, %s, %s, %s, %s, %s)" % (repr(self.contact), repr(self.date), repr(self.duration),
                                                             repr(self.audiotype), repr(self.text), repr(self.confidence), repr(self.filename))
@@ -187,6 +269,10 @@ class AudioRecord(TelephonyRecord):
     def __nonzero__(self):
         ''' Returns whether or not the object has no effective information'''
         return super(AudioRecord, self) and bool(self.audiotype)
+    @property
+    def min_confidence(self):
+        ''' The confidence of the transcript's least certain word, or None'''
+        return min(self.confidences) if self.confidences else None
 
     @staticmethod
     def get_node(node):
@@ -194,7 +280,7 @@ class AudioRecord(TelephonyRecord):
         node = TelephonyRecord.get_node(node)
         if node is None:
             return None
-        if not node.find(Parser.as_xhtml('./audio')): #is audio, not call
+        if not node.find(Paths.audio): #is audio, not call
             return None
         return node
 
@@ -207,29 +293,61 @@ class AudioRecord(TelephonyRecord):
         if node is None:
             return None
 
-        base_obj = TelephonyRecord.from_node(node)
-        audio_obj = cls(base_obj.contact, base_obj.date, base_obj.duration)
+        base_obj = GVoiceRecord.from_node(node, "published")
+        audio_obj = cls(base_obj.contact, base_obj.date)
+        audio_obj.read_duration(node)
 
-        descriptionNode = node.find(Parser.as_xhtml('./span[@class="description"]'))
-        if descriptionNode and descriptionNode.findtext(Parser.as_xhtml('./span[@class="full-text"]')):
+        descriptionNode = node.find(Paths.description)
+        if descriptionNode and descriptionNode.findtext(Paths.full_text):
             #!!! FIX: html decode
-            fullText = descriptionNode.findtext(Parser.as_xhtml('./span[@class="full-text"]'))
+            fullText = descriptionNode.findtext(Paths.full_text)
             if fullText != 'Unable to transcribe this message.':
                 audio_obj.text = fullText
 
-            confidence_values = descriptionNode.findall(Parser.as_xhtml('./span/span[@class="confidence"]'))
-            totalconfid = sum( float(i.findtext('.')) for i in confidence_values )
-            audio_obj.confidence = totalconfid / len(confidence_values)
-        audio_obj.filename = node.find(Parser.as_xhtml('./audio')).attrib["src"]
+            confidence_texts = cls.confidence_texts(descriptionNode)
+            numbers = Parser.numbers
+            if numbers is None:
+                audio_obj.set_confidences(ParseTools.parse_numbers(confidence_texts))
+            else:
+                numbers.add_confidences(audio_obj, confidence_texts)
+        audio_obj.filename = node.find(Paths.audio).attrib["src"]
         audio_obj.audiotype = ParseTools.get_label(node)
         return audio_obj
 
+    def set_confidences(self, confidences):
+        ''' keeps the per-word confidences of the transcript, an array, and their mean.
+        A transcript without any has neither.'''
+        if confidences:
+            self.confidence  = sum(confidences) / len(confidences)
+            self.confidences = confidences
+        else:
+            self.confidence  = None
+            self.confidences = None
+
+    @staticmethod
+    def confidence_texts(node):
+        '''The text of each span.confidence in a description node, as Paths.confidence
+        finds them. Walking the children directly is much quicker than the query.'''
+        span = Paths.span
+        return [word.text or '' for child in node if child.tag == span
+                for word in child if word.tag == span and word.get('class') == 'confidence']
+
 class TextRecord(GVoiceRecord):
-    __slots__ = ['text','receiver']
+    __slots__ = ['text','_receiver']
     def __init__(self, contact = None, date = None, text = None):
         super(TextRecord, self).__init__(contact, date)
-        self.text     = text
-        self.receiver = Contact()
+        self.text      = text
+        self._receiver = None
+    @property
+    def receiver(self):
+        '''The Contact the text was sent to. Most texts are given the one shared by their
+        conversation, so a blank one is only made for a text that is asked for it without.'''
+        if self._receiver is None:
+            self._receiver = Contact()
+        return self._receiver
+    @receiver.setter
+    def receiver(self, contact):
+        self._receiver = contact
     def __repr__(self):
         return "TextRecord(%s, %s, %s)" % (self.contact, self.date, self.text)
     def dump(self):
@@ -244,7 +362,7 @@ class TextRecord(GVoiceRecord):
         ''' finds and returns the first TextRecord beneath the node in the tree.'''
         base_obj = GVoiceRecord.from_node(node, "dt")
         # !!! FIX: html decode the text content
-        text = ParseTools.unescape(node.findtext(Parser.as_xhtml('./q')))
+        text = ParseTools.unescape(node.findtext(Paths.q))
 
         return cls(base_obj.contact, base_obj.date, text)
 
@@ -260,9 +378,9 @@ class TextConversationList(list):
     @staticmethod
     def get_node(node):
         '''Given an HTML node, finds the self-or-descendant that encodes a TextConversationList'''
-        if node.tag == "{http://www.w3.org/1999/xhtml}div" and node.attrib["class"] == "hChatLog hfeed":
+        if node.tag == Paths.div and node.attrib["class"] == "hChatLog hfeed":
             return node
-        conversationnode = node.find(Parser.as_xhtml('.//div[@class="hChatLog hfeed"]'))
+        conversationnode = node.find(Paths.chatlog)
         return conversationnode if conversationnode else None
 
     @classmethod
@@ -270,37 +388,96 @@ class TextConversationList(list):
         ''' finds and returns the first TextConversationList beneath the node in the tree.
         The onewayname parameter is used to set the contact for outgoing texts when there is no replay'''
         '''*mynumbers* is a list of the phone numbers the account user uses'''
+        texts = cls.texts_from_node(node)
+        if texts is None:
+            return None
+        return cls.from_texts(texts, onewayname, filename, mynumbers)
+
+    @staticmethod
+    def texts_from_node(node):
+        ''' finds the first conversation beneath the node in the tree and returns its TextRecords,
+        as they are in the file, or None if there is none'''
         #get node of interest
-        conversationnode = cls.get_node(node)
+        conversationnode = TextConversationList.get_node(node)
         if conversationnode is None:
             return None
 
         #now move on to main exec
-        textnodes = conversationnode.findall(Parser.as_xhtml('./div[@class="message"]'))
+        textnodes = conversationnode.findall(Paths.message)
         #!!! FIX? Why is this necessary?
         if not textnodes:
             return None
 
-        #Read each text message, making a note of whether I sent it
-        txtConversation_obj = cls()
-        conv_with           = None
+        texts = []
         for txtNode in textnodes:
-            txtmsg = TextRecord.from_node(txtNode)
+            txtmsg = TextConversationList.message_from_node(txtNode)
+            if txtmsg is not None:
+                texts.append(txtmsg)
+        return texts
 
-            #TODO: Skip Google Voice error messages
-            if txtmsg.contact.name=='Google Voice':
-                continue
-            if not txtmsg.contact.name and not txtmsg.contact.phonenumber:
-                continue
+    @staticmethod
+    def message_from_node(node):
+        ''' returns the TextRecord of a div.message node, or None if it is not worth keeping'''
+        txtmsg = TextRecord.from_node(node)
 
-            if txtmsg.contact.phonenumber in mynumbers:
-                txtmsg.contact = Contact(name="###ME###",phonenumber=mynumbers[0])
-            else:
-                conv_with = txtmsg.contact
+        #TODO: Skip Google Voice error messages
+        if txtmsg.contact.name=='Google Voice':
+            return None
+        if not txtmsg.contact.name and not txtmsg.contact.phonenumber:
+            return None
+        return txtmsg
+
+    @staticmethod
+    def onewayname(title):
+        ''' the contact named by a conversation file's title when I sent the only texts, or None'''
+        return title[6::] if title.startswith("Me to") else None
+
+    @classmethod
+    def from_texts(cls, texts, onewayname, filename, mynumbers):
+        ''' builds the TextConversationList from the TextRecords returned by texts_from_node'''
+        '''*mynumbers* is a list of the phone numbers the account user uses'''
+        numbers   = PhoneNumbers.for_account(mynumbers)
+        mynumbers = numbers.mynumbers
+        #Make a note of whether I sent each text message
+        txtConversation_obj = cls()
+        for txtmsg in texts:
+            numbers.fix(txtmsg.contact)
+            cls.mark_me(txtmsg, mynumbers)
             txtConversation_obj.append(txtmsg)
 
+        conv_with, recipient = cls.parties((txt.contact for txt in txtConversation_obj), onewayname, filename, mynumbers)
+        if recipient is None: #Multiway conversation
+            return txtConversation_obj
+
+        #Note who I am conversing with
+        txtConversation_obj.contact = conv_with
+
+        #Set receivers for each text message in the conversation
+        for i in txtConversation_obj:
+            i.receiver = recipient[i.contact]
+
+        return txtConversation_obj
+
+    @staticmethod
+    def mark_me(txtmsg, mynumbers):
+        ''' makes the sender of a text I sent ###ME###'''
+        if txtmsg.contact.phonenumber in mynumbers:
+            txtmsg.contact = Contact(name="###ME###",phonenumber=mynumbers[0])
+
+    @staticmethod
+    def parties(contacts, onewayname, filename, mynumbers):
+        ''' works out who a conversation is with from the senders of its texts, in order and
+        after mark_me. Returns (contact, recipient), where recipient maps each sender to the
+        receiver of their texts, or (None, None) for a multiway conversation.'''
+        conv_with       = None
+        unique_contacts = set()
+        for contact in contacts:
+            if contact.phonenumber not in mynumbers:
+                conv_with = contact
+            unique_contacts.add(contact)
+
         #All contacts on conversation
-        unique_contacts = list(set(txt.contact for txt in txtConversation_obj))
+        unique_contacts = list(unique_contacts)
 
         #I sent an unreplied out-going message
         if not conv_with:
@@ -314,68 +491,536 @@ class TextConversationList(list):
             print "Multiway conversation detected!"
             print filename
             print unique_contacts
-            return txtConversation_obj
+            return None, None
 
-        #Note who I am conversing with. Clone by constructor
-        txtConversation_obj.contact = Contact(name=conv_with.name,phonenumber=conv_with.phonenumber)
-
-        #Set receivers for each text message in the conversation
+        #Clone by constructor
+        conv_with = Contact(name=conv_with.name,phonenumber=conv_with.phonenumber)
         recipient = {unique_contacts[0]:unique_contacts[1], unique_contacts[1]:unique_contacts[0]}
-        for i in txtConversation_obj:
-            i.receiver = recipient[i.contact]
+        return conv_with, recipient
 
-        return txtConversation_obj
+    @classmethod
+    def iter_texts(cls, data, filename, mynumbers):
+        ''' yields the TextRecords of the conversation in a file's contents one by one, finished
+        as from_node would finish them, without ever holding the whole file's tree or all of its
+        texts: it is read twice with a ConversationReader, once for who is in the conversation
+        and once for the texts. Needs lxml. Yields nothing if the file has no conversation.'''
+        '''*mynumbers* is a list of the phone numbers the account user uses'''
+        numbers   = PhoneNumbers.for_account(mynumbers)
+        mynumbers = numbers.mynumbers
+        reader    = ConversationReader(data)
+        def senders():
+            for txtmsg in reader.messages():
+                numbers.fix(txtmsg.contact)
+                cls.mark_me(txtmsg, mynumbers)
+                yield txtmsg.contact
+        contacts = senders()
+        first    = next(contacts, None)
+        if first is None:
+            return
+        recipient = cls.parties(itertools.chain([first], contacts), cls.onewayname(reader.title), filename, mynumbers)[1]
+
+        for txtmsg in reader.messages():
+            numbers.fix(txtmsg.contact)
+            cls.mark_me(txtmsg, mynumbers)
+            if recipient is not None:
+                txtmsg.receiver = recipient[txtmsg.contact]
+            yield txtmsg
+
+class ConversationReader(object):
+    '''Reads the texts of a conversation file incrementally with lxml's pull parser, for
+    threads too long to build the tree of. Each div.message is made into a TextRecord
+    as soon as it has been parsed and then thrown away, so memory does not grow with the
+    length of the thread. Gives the same texts as TextConversationList.texts_from_node on
+    the tree the lxml engine builds.'''
+    chunksize = 1 << 16 #bytes fed to the parser at a time
+
+    def __init__(self, data):
+        if lxml is None:
+            raise ImportError("Reading conversations incrementally requires the lxml package")
+        self.data  = data
+        self.title = None #the file's title, once messages() has read past it
+
+    def messages(self):
+        '''Yields the TextRecords of the file's first conversation as they are parsed,
+        before mark_me, leaving out the ones texts_from_node leaves out'''
+        chatlog = None
+        for event, node in self._events():
+            if event == 'start':
+                if chatlog is None and node.tag == 'div' and node.get('class') == 'hChatLog hfeed':
+                    chatlog = node
+            elif node.tag == 'title' and self.title is None:
+                self.title = node.text or ''
+            elif node is chatlog:
+                return #the rest of the file cannot hold a text
+            elif chatlog is not None and node.tag == 'div' and node.get('class') == 'message' and node.getparent() is chatlog:
+                for child in node.iter():
+                    if isinstance(child.tag, basestring): #skip comments and processing instructions
+                        child.tag = XHTML + child.tag
+                txtmsg = TextConversationList.message_from_node(node)
+                #Drop the message, and any text between it and the last one
+                node.clear()
+                while node.getprevious() is not None:
+                    del chatlog[0]
+                if txtmsg is not None:
+                    yield txtmsg
+
+    def _events(self):
+        '''Yields the parser's (event, element) pairs, feeding it the file a slice at a
+        time rather than copying all of it into a file object'''
+        parser = lxml.etree.HTMLPullParser(events = ('start', 'end'), encoding = "iso-8859-15")
+        data   = self.data
+        for i in xrange(0, len(data), self.chunksize):
+            parser.feed(data[i:i + self.chunksize])
+            for event in parser.read_events():
+                yield event
+        parser.close()
+        for event in parser.read_events():
+            yield event
+
+class TextConversationStream(object):
+    '''A conversation that is read from a file's contents each time it is iterated over,
+    with TextConversationList.iter_texts, rather than held: its TextRecords are made one
+    at a time and can be dropped as soon as they have been used, so a consumer that uses
+    each text once needs no more memory than the file. Parser makes these in place of a
+    TextConversationList for long conversations when Parser.stream_texts is set.'''
+    def __init__(self, data, filename, mynumbers):
+        self.data      = data
+        self.filename  = filename
+        self.mynumbers = mynumbers
+
+    @classmethod
+    def from_bytes(cls, data, filename, mynumbers):
+        ''' the TextConversationStream of a file's contents, or None if it has no texts'''
+        if next(ConversationReader(data).messages(), None) is None:
+            return None
+        return cls(data, filename, mynumbers)
+
+    def __iter__(self):
+        return TextConversationList.iter_texts(self.data, self.filename, self.mynumbers)
+
+    def __nonzero__(self):
+        return True
+
+class StringPool(object):
+    '''Stores each distinct string once, handing out small integer ids for them.
+    Id 0 is always None.'''
+    def __init__(self):
+        self.strings = [None]
+        self.ids     = {None : 0}
+    def __len__(self):
+        return len(self.strings)
+    def __getitem__(self, i):
+        return self.strings[i]
+    def intern(self, string):
+        '''Returns the id of *string*, adding it to the pool if it is new'''
+        i = self.ids.get(string)
+        if i is None:
+            i = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return i
+
+class PhoneNumbers(StringPool):
+    '''The canonical forms of phone numbers in the country of an account's own numbers:
+    E.164 without the '+', so "+1 555-123-4567", "(555) 123-4567" and "011 1 555 123 4567"
+    are all "15551234567" to a North American account. Canonical numbers are pooled, so
+    every record with a number shares one string for it. The canonical form of each
+    number as written is memoized.'''
+    #Country calling codes are prefix free. These are the one- and two-digit ones;
+    #every other is three digits.
+    _short_codes = frozenset(['1', '7'] + ('20 27 30 31 32 33 34 36 39 40 41 43 44 45 46 47 48 49 51 52 53 54 '
+                                           '55 56 57 58 60 61 62 63 64 65 66 81 82 84 86 90 91 92 93 94 95 98').split())
+    _nondigit    = re.compile(r'\D+')
+    _accounts    = {} #the PhoneNumbers of each account, by its numbers
+
+    def __init__(self, country = '1', mynumbers = ()):
+        StringPool.__init__(self)
+        self.country   = country #the calling code of numbers written without one
+        self.memo      = {}      #number as written -> canonical number
+        self.mynumbers = [self.canonical(number) for number in mynumbers]
+
+    @classmethod
+    def for_account(cls, mynumbers, country = None):
+        '''The PhoneNumbers for the account with these numbers, made once per account.
+        Its *mynumbers* are theirs in canonical form. *country* is the calling code of
+        numbers written without one, worked out by country_of if it is not given; pass
+        it along with numbers already made canonical, which country_of cannot always
+        tell the country of.'''
+        key     = tuple(mynumbers)
+        numbers = cls._accounts.get(key)
+        if numbers is None or (country is not None and numbers.country != country):
+            numbers = cls._accounts[key] = cls(country or cls.country_of(mynumbers), mynumbers)
+            #The same account, once its numbers have been made canonical
+            cls._accounts[tuple(numbers.mynumbers)] = numbers
+        return numbers
+
+    @classmethod
+    def digits(cls, text):
+        '''The digits of a number or tel: link, with its '+' if it has one, or None if it
+        has no digits. This is all that can be said of a number without knowing whose
+        account it is from.'''
+        if text.startswith('tel:'):
+            text = text[4:]
+        text   = text.split(';', 1)[0] #any ;ext= or other parameters
+        digits = cls._nondigit.sub('', text)
+        if not digits:
+            return None
+        return '+' + digits if text.lstrip().startswith('+') else digits
+
+    @classmethod
+    def calling_code(cls, digits):
+        '''The country calling code at the start of an international number'''
+        for n in (1, 2):
+            if digits[:n] in cls._short_codes:
+                return digits[:n]
+        return digits[:3]
+
+    @classmethod
+    def country_of(cls, mynumbers):
+        '''The calling code of the first of an account's numbers written with one, or
+        North America's, as for every Google Voice number, if none is'''
+        for number in mynumbers:
+            digits = number and cls.digits(number)
+            if not digits:
+                continue
+            if digits.startswith('+'):
+                return cls.calling_code(digits[1:])
+            if len(digits) == 11 and digits[0] == '1':
+                return '1'
+            if len(digits) > 11 and digits[0] != '0':
+                return cls.calling_code(digits)
+        return '1'
+
+    def canonical(self, number):
+        '''The canonical form of a number, or the number itself if it has no digits'''
+        try:
+            return self.memo[number]
+        except KeyError:
+            pass
+        digits = self.digits(number) if number else None
+        if digits is None:
+            canonical = number
+        elif digits.startswith('+'):
+            canonical = digits[1:]
+        elif self.country == '1':
+            #North American numbers are ten digits, the first of which is never 0 or 1
+            if digits.startswith('011'):
+                canonical = digits[3:]
+            elif len(digits) == 10 and digits[0] not in '01':
+                canonical = '1' + digits
+            else:
+                canonical = digits
+        elif digits.startswith('00'):
+            canonical = digits[2:]
+        elif digits.startswith('0'): #a trunk prefix
+            canonical = self.country + digits[1:]
+        else:
+            canonical = digits
+        if digits is not None:
+            canonical = self.strings[self.intern(canonical)]
+        self.memo[number] = canonical
+        return canonical
+
+    def fix(self, contact):
+        '''Puts a Contact's number into canonical form'''
+        if contact.phonenumber:
+            contact.phonenumber = self.canonical(contact.phonenumber)
+
+class RecordBatch(object):
+    '''Many records held as columns of plain arrays rather than as objects: one row per
+    text message, call or voicemail, with text conversations already exploded. Dates
+    are microseconds since the epoch, durations are whole seconds, and names, numbers
+    and call types are ids in a StringPool. A record object is only built when one is
+    asked for, and is a copy: changing it does not change the batch.'''
+    TEXT, CALL, AUDIO = 0, 1, 2
+
+    def __init__(self, records = ()):
+        self.pool       = StringPool()        #names, numbers, call and audio types
+        self.kind       = array.array('b')    #TEXT, CALL or AUDIO
+        self.time       = array.array(_INT64) #microseconds since the epoch, UTC
+        self.name       = array.array('i')    #the contact's name
+        self.number     = array.array('i')    #the contact's number
+        self.rname      = array.array('i')    #a text's receiver's name
+        self.rnumber    = array.array('i')    #a text's receiver's number
+        self.duration   = array.array('i')    #seconds, or -1 if there is none
+        self.label      = array.array('i')    #calltype or audiotype
+        self.confidence = array.array('d')    #of a voicemail's transcript, or NaN if there is none
+        self.words      = array.array('d')    #the per-word confidences of every transcript, end to end
+        self.word_end   = array.array(_INT64) #where each row's words end in words
+        self.text       = []                  #a message, a voicemail's transcript, or None
+        self.filename   = []                  #a voicemail's audio file, or None
+        self.extend(records)
+
+    def __len__(self):
+        return len(self.kind)
+
+    def _add(self, kind, contact, date, receiver = None, duration = None, label = None,
+             confidence = None, text = None, filename = None, confidences = None):
+        intern = self.pool.intern
+        self.kind.append(kind)
+        self.time.append(ParseTools.to_microseconds(date))
+        self.name.append(intern(contact.name))
+        self.number.append(intern(contact.phonenumber))
+        self.rname.append(0 if receiver is None else intern(receiver.name))
+        self.rnumber.append(0 if receiver is None else intern(receiver.phonenumber))
+        self.duration.append(-1 if duration is None else ParseTools.to_seconds(duration))
+        self.label.append(intern(label))
+        self.confidence.append(float('nan') if confidence is None else confidence)
+        if confidences:
+            self.words.extend(confidences)
+        self.word_end.append(len(self.words))
+        self.text.append(text)
+        self.filename.append(filename)
+
+    def append(self, record):
+        '''Adds a record: a TextConversationList, TextConversationStream, TextRecord,
+        CallRecord or AudioRecord'''
+        if isinstance(record, (TextConversationList, TextConversationStream)):
+            for txt in record:
+                self.append(txt)
+        elif isinstance(record, TextRecord):
+            self._add(self.TEXT, record.contact, record.date, record._receiver, text = record.text)
+        elif isinstance(record, AudioRecord):
+            self._add(self.AUDIO, record.contact, record.date, duration = record.duration, label = record.audiotype,
+                      confidence = record.confidence, text = record.text, filename = record.filename,
+                      confidences = record.confidences)
+        elif isinstance(record, CallRecord):
+            self._add(self.CALL, record.contact, record.date, duration = record.duration, label = record.calltype)
+        else:
+            raise TypeError("Cannot add %r to a RecordBatch" % (record,))
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def date(self, i):
+        '''The date of row *i*, as a naive UTC datetime'''
+        return ParseTools.from_microseconds(self.time[i])
+
+    def contacts(self):
+        '''Yields the (name, number) of the contact of each row'''
+        strings = self.pool.strings
+        for name, number in zip(self.name, self.number):
+            yield strings[name], strings[number]
+
+    def fill_contacts(self, names_to_numbers, numbers_to_names):
+        '''Fills in missing names and numbers from the contact tables, as
+        gvproc.FillContacts does for record objects'''
+        strings    = list(self.pool.strings)
+        intern     = self.pool.intern
+        blank      = set(i for i, string in enumerate(strings) if not string)
+        name_for   = dict((i, intern(numbers_to_names[string])) for i, string in enumerate(strings) if string in numbers_to_names)
+        number_for = dict((i, intern(names_to_numbers[string])) for i, string in enumerate(strings) if string in names_to_numbers)
+        for names, numbers, texts_only in ((self.name, self.number, False), (self.rname, self.rnumber, True)):
+            for i in xrange(len(self.kind)):
+                if texts_only and self.kind[i] != self.TEXT:
+                    continue
+                name, number = names[i], numbers[i]
+                if name in blank and number in name_for:
+                    names[i] = name_for[number]
+                elif number in blank and name in number_for:
+                    numbers[i] = number_for[name]
+
+    def __getitem__(self, i):
+        '''Builds the record object for row *i*'''
+        strings  = self.pool.strings
+        contact  = Contact(strings[self.number[i]], strings[self.name[i]])
+        date     = self.date(i)
+        kind     = self.kind[i]
+        if kind == self.TEXT:
+            record = TextRecord(contact, date, self.text[i])
+            if self.rname[i] or self.rnumber[i]:
+                record.receiver = Contact(strings[self.rnumber[i]], strings[self.rname[i]])
+            return record
+        duration = None if self.duration[i] < 0 else ParseTools.from_seconds(self.duration[i])
+        if kind == self.CALL:
+            return CallRecord(contact, date, duration, strings[self.label[i]])
+        confidence = self.confidence[i]
+        return AudioRecord(contact, date, duration, strings[self.label[i]], self.text[i],
+                           None if confidence != confidence else confidence, self.filename[i], self.confidences(i))
+
+    def confidences(self, i):
+        '''The per-word confidences of row *i*'s transcript, as an array, or None'''
+        start = self.word_end[i - 1] if i else 0
+        if start == self.word_end[i]:
+            return None
+        return self.words[start:self.word_end[i]]
+
+    def min_confidences(self):
+        '''The confidence of the least certain word of each row's transcript, NaN for
+        rows without one: a NumPy array if NumPy is installed, else an array'''
+        ends = self.word_end
+        if numpy is None:
+            words = self.words
+            return array.array('d', (min(words[start:end]) if end > start else float('nan')
+                                     for start, end in itertools.izip(itertools.chain([0], ends), ends)))
+        ends   = numpy.frombuffer(ends, dtype = numpy.int64) if len(ends) else numpy.zeros(0, numpy.int64)
+        starts = numpy.concatenate(([0], ends[:-1]))
+        has    = ends > starts
+        mins   = numpy.empty(len(ends))
+        mins.fill(numpy.nan)
+        if has.any():
+            #Rows without words add none, so each row with some ends where the next begins
+            mins[has] = numpy.minimum.reduceat(numpy.frombuffer(self.words, dtype = numpy.float64), starts[has])
+        return mins
+
+    def __iter__(self):
+        for i in xrange(len(self.kind)):
+            yield self[i]
 
 #####--------------------------------
 
 class ParseTools:
+    #Entity references, split out with the text around them. A Python 2 pattern's \w
+    #is ASCII only, so references are always plain ASCII.
+    _entity = re.compile(r'(&#?\w+;)')
+    #Every named entity's text, keyed by its reference. Character references are
+    #added as they are met, as long as there is room: a conversation full of emoji
+    #uses the same few over and over.
+    _entities     = dict(('&%s;' % name, unichr(codepoint)) for name, codepoint in htmlentitydefs.name2codepoint.items())
+    _max_entities = len(_entities) + 4096
+
     @staticmethod
-    #from effbot.org.
+    #reworked from effbot.org's
     def unescape(text):
         '''Unescapes the HTML entities in a block of text'''
-        def fixup(m):
-            text = m.group(0)
-            if text[:2] == "&#":
-                # character reference
-                try:
-                    if text[:3] == "&#x":
-                        return unichr(int(text[3:-1], 16))
-                    else:
-                        return unichr(int(text[2:-1]))
-                except ValueError:
-                    pass
+        if '&' not in text: #the HTML parser has usually decoded them already
+            return text
+        #Odd-numbered parts are the references; resolve them all in one pass
+        parts    = ParseTools._entity.split(text)
+        entities = ParseTools._entities
+        for i in xrange(1, len(parts), 2):
+            ref = parts[i]
+            try:
+                parts[i] = entities[ref]
+            except KeyError:
+                if ref[:2] == "&#":
+                    parts[i] = ParseTools._char_ref(ref)
+                    if len(entities) < ParseTools._max_entities:
+                        entities[ref] = parts[i]
+                #an unknown named entity is left as is
+        return text[:0].join(parts)
+
+    @staticmethod
+    def _char_ref(ref):
+        '''The character a reference like &#39; or &#x1F600; stands for, or the
+        reference itself if it does not stand for one'''
+        try:
+            if ref[:3] == "&#x":
+                return unichr(int(ref[3:-1], 16))
             else:
-                # named entity
-                try:
-                    text = unichr(htmlentitydefs.name2codepoint[text[1:-1]])
-                except KeyError:
-                    pass
-            return text # leave as is
-        return re.sub("&#?\w+;", fixup, text)
+                return unichr(int(ref[2:-1]))
+        except ValueError:
+            return ref
+
+    #The ISO-8601 form GVoice writes in abbr titles, e.g. 2011-07-09T14:12:31.000-04:00
+    _gvoice_date = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?(Z|[+-]\d\d:?\d\d)$')
+    _utc_offsets = {'Z' : datetime.timedelta(0)}
+    date_fallbacks = 0 #How many dates were not in the GVoice form, and went to dateutil
 
     @staticmethod
     def parse_date (datestring):
-        '''Parses a Gvoice-formatted date into a datetime object'''
+        '''Parses a Gvoice-formatted date into a naive UTC datetime object'''
+        stats = Parser.stats
+        if stats is None:
+            return ParseTools._parse_date(datestring)
+        fallbacks = ParseTools.date_fallbacks
+        with stats.timing('date parse'):
+            returntime = ParseTools._parse_date(datestring)
+        if ParseTools.date_fallbacks != fallbacks:
+            stats.add('date parse fallback', 0)
+        return returntime
+
+    @staticmethod
+    def _parse_date (datestring):
+        match = ParseTools._gvoice_date.match(datestring)
+        if match:
+            year, month, day, hour, minute, second, fraction, zone = match.groups()
+            offset = ParseTools._utc_offsets.get(zone)
+            if offset is None:
+                offset = datetime.timedelta(hours = int(zone[1:3]), minutes = int(zone[-2:]))
+                if zone[0] == '-':
+                    offset = -offset
+                ParseTools._utc_offsets[zone] = offset
+            microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+            return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond) - offset
+
+        #Anything else is left to the slow, forgiving parser
+        ParseTools.date_fallbacks += 1
         returntime = dateutil.parser.parse(datestring).astimezone(tz.tzutc())
         return returntime.replace(tzinfo = None)
 
+    _duration = re.compile(r'(\d\d+):(\d\d):(\d\d)')
+    #The first duration on each line of many, for parse_durations
+    _durations = re.compile(r'^.*?(\d\d+):(\d\d):(\d\d)', re.M)
+
     @staticmethod
     def parse_time (timestring):
         '''Parses a duration time-string/tag into a timedelta object'''
-        timestringmatch = re.search('(\d\d+):(\d\d):(\d\d)', timestring)
+        timestringmatch = ParseTools._duration.search(timestring)
         return datetime.timedelta (
             seconds = int(timestringmatch.group(3)),
             minutes = int(timestringmatch.group(2)),
             hours   = int(timestringmatch.group(1))
         )
 
+    @staticmethod
+    def parse_durations(timestrings):
+        '''Parses many duration time-strings at once into a list of whole seconds,
+        with one scan of them all, and NumPy to add up the hours, minutes and seconds
+        if it is installed. Raises as parse_time would if one is not a duration.'''
+        joined  = '\n'.join(timestrings)
+        matches = ParseTools._durations.findall(joined)
+        if len(matches) != len(timestrings) or joined.count('\n') != len(timestrings) - 1:
+            #a line without a duration, or a string of more than one line
+            return [ParseTools.to_seconds(ParseTools.parse_time(t)) for t in timestrings]
+        if numpy is None or not matches:
+            return [int(h) * 3600 + int(m) * 60 + int(s) for h, m, s in matches]
+        return numpy.array(matches, dtype = numpy.int64).dot([3600, 60, 1]).tolist()
+
+    @staticmethod
+    def parse_numbers(strings):
+        '''Turns a list of decimal strings, such as the word confidences of one or
+        many transcripts, into an array of floats with float(). Raises ValueError,
+        as float() does, if one is not a number.'''
+        return array.array('d', map(float, strings))
+
+    ##------------------------------------
+
+    #Compact forms of dates and durations, for storing many records
+    _epoch = datetime.datetime(1970, 1, 1)
+
+    @staticmethod
+    def to_microseconds(date):
+        '''Turns a naive UTC datetime into microseconds since the epoch'''
+        if date is None:
+            return None
+        delta = date - ParseTools._epoch
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+    @staticmethod
+    def from_microseconds(microseconds):
+        '''Turns microseconds since the epoch back into a naive UTC datetime'''
+        if microseconds is None:
+            return None
+        return ParseTools._epoch + datetime.timedelta(microseconds = microseconds)
+
+    @staticmethod
+    def to_seconds(duration):
+        '''Turns a duration timedelta into whole seconds'''
+        return None if duration is None else duration.days * 86400 + duration.seconds
+
+    @staticmethod
+    def from_seconds(seconds):
+        '''Turns whole seconds back into a duration timedelta'''
+        return None if seconds is None else datetime.timedelta(seconds = seconds)
+
     ##------------------------------------
 
     @staticmethod
     #!!! FEATURE: return Inbox, Starred flags
     def get_label(node):
         ''' Gets a category label for the HTML file '''
-        labelNodes = node.findall(Parser.as_xhtml('./div[@class="tags"]/a[@rel="tag"]'))
+        labelNodes = node.findall(Paths.tags)
         validtags = ('placed', 'received', 'missed', 'recorded', 'voicemail') #Valid categories
         for label in (node.attrib['href'].rsplit("#")[1] for node in labelNodes):
             if label in validtags: #last part of label href is valid label
@@ -384,45 +1029,678 @@ class ParseTools:
 
 ##-------------------
 
+class ParserEngine(object):
+    '''Turns an open GVoice file into an element tree. Whatever the backend, the tree
+    must look like the one html5lib builds -- tags in the XHTML namespace -- since that
+    is what the record classes search for.'''
+    name = None
+    def parse(self, f):
+        '''Returns the root element of the document read from the file object f'''
+        raise NotImplementedError
+
+class Html5libEngine(ParserEngine):
+    '''The reference engine: slow, but parses exactly as a browser would'''
+    name = 'html5lib'
+    def parse(self, f):
+        return html5lib.parse(f, encoding="iso-8859-15")
+
+class LxmlEngine(ParserEngine):
+    '''A fast engine built on libxml2's HTML parser. Takeout files are well-formed
+    enough that it builds the same tree as html5lib, once the tags are namespaced.
+    One difference: libxml2 drops the '&#x' of a malformed character reference such
+    as '&#xZZ;', which html5lib keeps, but Takeout escapes every '&' in a message.'''
+    name = 'lxml'
+    def __init__(self):
+        if lxml is None:
+            raise ImportError("The lxml parser engine requires the lxml package")
+        #Plain etree elements: lxml.html's element classes cost a Python-level
+        #class lookup for every node a query returns
+        self.htmlparser = lxml.etree.HTMLParser(encoding="iso-8859-15")
+    def parse(self, f):
+        tree = lxml.etree.parse(f, self.htmlparser).getroot()
+        for node in tree.iter():
+            if isinstance(node.tag, basestring): #skip comments and processing instructions
+                node.tag = XHTML + node.tag
+        return tree
+
+##-------------------
+
+def _read_file(filename):
+    with open(filename, 'rb') as f: #read the file
+        return f.read()
+
+class Source(object):
+    '''Somewhere GVoice files are read from: a directory, or a Takeout archive read in
+    place without unpacking it. Files are known by a name that read() accepts.'''
+    random_access    = True #False if files can only be read efficiently in archive order
+    concurrent_reads = True #False if read() must not be called from two threads at once
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def from_path(path):
+        '''Returns the Source for the directory, .zip or .tgz/.tar at *path*. A Source
+        is passed through unchanged.'''
+        if isinstance(path, Source):
+            return path
+        if os.path.isdir(path):
+            return DirectorySource(path)
+        if zipfile.is_zipfile(path):
+            return ZipSource(path)
+        if tarfile.is_tarfile(path):
+            return TarSource(path)
+        raise IOError("'%s' is not a directory or a zip or tar archive" % path)
+
+    def members(self):
+        '''Returns a list of (name, size, mtime) for each HTML file'''
+        raise NotImplementedError
+
+    def read(self, name):
+        '''Returns the contents of the file *name*'''
+        raise NotImplementedError
+
+    def iter_bytes(self, names):
+        '''Yields (name, contents) for each of *names*, in whatever order is quickest'''
+        for name in names:
+            yield name, self.read(name)
+
+    @staticmethod
+    def key(name):
+        '''The file's name without its directory, which is the same wherever it is read from'''
+        return name.replace('\\', '/').rsplit('/', 1)[-1]
+
+class DirectorySource(Source):
+    '''The HTML files in an unpacked Takeout's Calls directory. Names are paths.'''
+    def members(self):
+        if scandir is None:
+            paths = [os.path.join(self.path, fl) for fl in os.listdir(self.path) if fl.endswith(".html")]
+            return [(path,) + self._size_mtime(os.stat(path)) for path in paths]
+        return [(entry.path,) + self._size_mtime(entry.stat())
+                for entry in scandir(self.path) if entry.name.endswith(".html")]
+
+    @staticmethod
+    def _size_mtime(st):
+        return (st.st_size, st.st_mtime)
+
+    def read(self, name):
+        return _read_file(name)
+
+class ArchiveSource(Source):
+    '''A Takeout archive. The HTML files are those in its Voice/Calls directory, or
+    every HTML file if it has no such directory. Names are archive member names.'''
+    @staticmethod
+    def _select(names):
+        names = [name for name in names if name.endswith(".html")]
+        calls = [name for name in names if '/Calls/' in '/' + name]
+        return calls or names
+
+class ZipSource(ArchiveSource):
+    concurrent_reads = False #members are read through the archive's one file object
+
+    def __init__(self, path):
+        ArchiveSource.__init__(self, path)
+        self.archive = zipfile.ZipFile(path)
+
+    def members(self):
+        infos  = dict((info.filename, info) for info in self.archive.infolist())
+        return [(name, infos[name].file_size, time.mktime(infos[name].date_time + (0, 0, -1)))
+                for name in self._select(infos)]
+
+    def read(self, name):
+        return self.archive.read(name)
+
+class TarSource(ArchiveSource):
+    '''A tar archive, usually gzipped. Reading members out of order means decompressing
+    from the start again, so iter_bytes reads the archive through once instead.'''
+    random_access = False
+
+    def __init__(self, path):
+        ArchiveSource.__init__(self, path)
+        self.archive = tarfile.open(path, 'r:*')
+
+    def members(self):
+        infos = dict((info.name, info) for info in self.archive.getmembers() if info.isfile())
+        return [(name, infos[name].size, float(infos[name].mtime)) for name in self._select(infos)]
+
+    def read(self, name):
+        return self.archive.extractfile(name).read()
+
+    def iter_bytes(self, names):
+        wanted = set(names)
+        with tarfile.open(self.path, 'r|*') as archive: #a forward-only stream
+            for info in archive:
+                if info.name in wanted:
+                    yield info.name, archive.extractfile(info).read()
+
+class _Prefetch(object):
+    '''One file being read ahead by a Prefetcher'''
+    __slots__ = ('read', 'result', 'error', 'done')
+
+    def __init__(self, read):
+        self.read   = read  #called on a reader thread; returns (name, contents)
+        self.result = None  #(name, contents), or None if the stream ran out
+        self.error  = None  #sys.exc_info() if the read failed
+        self.done   = threading.Event()
+
+class Prefetcher(Source):
+    '''Reads the files of another Source ahead of the parser on background threads,
+    so that the next files are already in memory when they are wanted. Worth it when
+    every open and read waits on the network. At most *depth* files, and about
+    *maxbytes* of contents, are held read but not yet used. iter_bytes yields files in
+    the order the wrapped source would; read() is not read ahead. Time spent waiting
+    for a file that is not ready yet is charged to 'prefetch wait' in *stats*.'''
+    random_access = False #files are only read ahead through iter_bytes
+
+    def __init__(self, source, depth = 32, maxbytes = 64 << 20, threads = None, stats = None):
+        Source.__init__(self, source.path)
+        self.source   = source
+        self.depth    = max(1, depth)
+        self.maxbytes = maxbytes
+        self.threads  = threads or min(self.depth, 8)
+        self.stats    = stats
+
+    def members(self):
+        return self.source.members()
+
+    def read(self, name):
+        return self.source.read(name)
+
+    def key(self, name):
+        return self.source.key(name)
+
+    def iter_bytes(self, names):
+        names = list(names)
+        if self.source.random_access:
+            reads   = [self._reader_for(name) for name in names]
+            threads = self.threads if self.source.concurrent_reads else 1
+        else:
+            #One thread takes the files from the archive stream in turn
+            reads   = [self.source.iter_bytes(names).next] * len(names)
+            threads = 1
+
+        tasks   = Queue.Queue()
+        workers = [threading.Thread(target = self._work, args = (tasks,)) for i in range(min(threads, len(names)))]
+        for worker in workers:
+            worker.daemon = True #an abandoned read must not keep the program alive
+            worker.start()
+
+        reads   = iter(reads)
+        pending = collections.deque()
+        try:
+            while True:
+                while not pending or (len(pending) < self.depth and self._held(pending) < self.maxbytes):
+                    read = next(reads, None)
+                    if read is None:
+                        break
+                    pending.append(_Prefetch(read))
+                    tasks.put(pending[-1])
+                if not pending:
+                    return
+                slot = pending.popleft()
+                if not slot.done.is_set():
+                    start = time.time()
+                    while not slot.done.wait(0.1): #a timeout keeps Ctrl-C working
+                        pass
+                    if self.stats:
+                        self.stats.add('prefetch wait', time.time() - start)
+                if slot.error:
+                    raise slot.error[0], slot.error[1], slot.error[2]
+                if slot.result is None:
+                    return
+                yield slot.result
+        finally:
+            for worker in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
+
+    def _reader_for(self, name):
+        return lambda: (name, self.source.read(name))
+
+    @staticmethod
+    def _held(pending):
+        '''Bytes read ahead and not yet handed out'''
+        return sum(len(slot.result[1]) for slot in pending if slot.done.is_set() and slot.result)
+
+    @staticmethod
+    def _work(tasks):
+        '''A reader thread: reads files until given None'''
+        for slot in iter(tasks.get, None):
+            try:
+                slot.result = slot.read()
+            except StopIteration:
+                pass
+            except Exception:
+                slot.error = sys.exc_info()
+            slot.done.set()
+
+##-------------------
+
+class PhaseStats(object):
+    '''Wall time and item counts per phase of a load, plus a histogram of how long
+    each file took and a list of the slowest files. Set Parser.stats to one of these
+    to have the parser fill it in.'''
+    def __init__(self, slowest = 20):
+        self.seconds   = collections.Counter()
+        self.counts    = collections.Counter()
+        self.histogram = collections.Counter() #files per latency bucket, keyed by the bucket's upper bound in ms
+        self.slowest   = []                    #min-heap of (seconds, filename) of the slowest files
+        self.nslowest  = slowest
+
+    def add(self, phase, seconds, count = 1):
+        '''Charges *seconds* and *count* items to *phase*'''
+        self.seconds[phase] += seconds
+        self.counts[phase]  += count
+
+    @contextlib.contextmanager
+    def timing(self, phase, count = 1):
+        '''Charges the time spent in a with block to *phase*'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start, count)
+
+    def add_file(self, filename, seconds):
+        '''Records how long one file took from opening to record'''
+        bucket = 1
+        while bucket < seconds * 1000:
+            bucket *= 2
+        self.histogram[bucket] += 1
+        if len(self.slowest) < self.nslowest:
+            heapq.heappush(self.slowest, (seconds, filename))
+        else:
+            heapq.heappushpop(self.slowest, (seconds, filename))
+
+    def merge(self, other):
+        '''Adds the figures from another PhaseStats, e.g. one from a worker process'''
+        self.seconds.update(other.seconds)
+        self.counts.update(other.counts)
+        self.histogram.update(other.histogram)
+        for item in other.slowest:
+            if len(self.slowest) < self.nslowest:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+
+    def as_dict(self):
+        '''The figures as plain data, ready for json.dump'''
+        return {'phases'    : dict((p, {'seconds': self.seconds[p], 'count': self.counts[p]}) for p in self.counts),
+                'histogram' : dict(('<=%dms' % b, n) for b, n in self.histogram.items()),
+                'slowest'   : [{'seconds': s, 'file': f} for s, f in sorted(self.slowest, reverse = True)]}
+
+    def report(self):
+        '''Prints the figures'''
+        print "%-24s %10s %10s %12s" % ('phase', 'seconds', 'count', 'us/item')
+        for phase in sorted(self.counts):
+            count = self.counts[phase]
+            print "%-24s %10.3f %10d %12.1f" % (phase, self.seconds[phase], count, 1e6 * self.seconds[phase] / count if count else 0)
+        if self.histogram:
+            print "File latency:"
+            for bucket in sorted(self.histogram):
+                print "  <= %6d ms %10d" % (bucket, self.histogram[bucket])
+        if self.slowest:
+            print "Slowest files:"
+            for seconds, filename in sorted(self.slowest, reverse = True):
+                print "  %8.1f ms  %s" % (seconds * 1000, filename)
+
+##-------------------
+
+class ParseCache(object):
+    '''An SQLite file of the records parsed from each GVoice file, keyed by a hash of
+    the file's contents, so that files seen before need not be parsed again. What is
+    kept is what Parser.extract returns, which does not depend on the account's
+    numbers. Once the cache holds more than *maxbytes* of records, the least
+    recently used are evicted by evict().'''
+    missing   = object() #returned by get() for a file that is not in the cache
+    batchsize = 200      #writes are held back until there are this many
+
+    def __init__(self, filename, maxbytes = 256 << 20):
+        self.filename = filename
+        self.maxbytes = maxbytes
+        self.version  = '%d.%d' % (PARSER_VERSION, marshal.version)
+        self.conn     = sqlite3.connect(filename, timeout = 60) #worker processes share it
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, version TEXT,
+                                                               data BLOB, size INTEGER, used REAL)''')
+        self.conn.execute('DELETE FROM records WHERE version!=?', (self.version,))
+        self.conn.commit()
+        self.puts    = []
+        self.touches = []
+
+    @staticmethod
+    def key(data):
+        '''The cache key of a file with contents *data*'''
+        return hashlib.sha1(data).hexdigest()
+
+    def get(self, key):
+        '''Returns what Parser.extract returned for the file with this key, or ParseCache.missing'''
+        row = self.conn.execute('SELECT data FROM records WHERE key=? AND version=?', (key, self.version)).fetchone()
+        if row is None:
+            return self.missing
+        self.touches.append((time.time(), key))
+        if len(self.touches) >= self.batchsize:
+            self.flush()
+        return self.decode(row[0])
+
+    def put(self, key, parts):
+        '''Keeps what Parser.extract returned for the file with this key'''
+        data = self.encode(parts)
+        self.puts.append((key, self.version, buffer(data), len(data), time.time()))
+        if len(self.puts) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        '''Writes out any records and uses held back'''
+        if self.puts:
+            self.conn.executemany('INSERT OR REPLACE INTO records (key,version,data,size,used) VALUES (?,?,?,?,?)', self.puts)
+        if self.touches:
+            self.conn.executemany('UPDATE records SET used=? WHERE key=?', self.touches)
+        self.conn.commit()
+        self.puts    = []
+        self.touches = []
+
+    def evict(self):
+        '''Removes the least recently used records until the rest fit in maxbytes.
+        Returns how many were removed.'''
+        self.flush()
+        total = 0
+        stale = []
+        for key, size in self.conn.execute('SELECT key,size FROM records ORDER BY used DESC'):
+            total += size
+            if total > self.maxbytes:
+                stale.append((key,))
+        self.conn.executemany('DELETE FROM records WHERE key=?', stale)
+        self.conn.commit()
+        return len(stale)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    #Records are stored as marshalled tuples of plain values, which are much smaller
+    #and quicker to load than pickled objects
+    @classmethod
+    def encode(cls, parts):
+        '''Serializes what Parser.extract returned'''
+        if parts is None:
+            fields = (0,)
+        elif isinstance(parts, CallRecord):
+            fields = (1, parts.contact.name, parts.contact.phonenumber, ParseTools.to_microseconds(parts.date),
+                      ParseTools.to_seconds(parts.duration), parts.calltype)
+        elif isinstance(parts, AudioRecord):
+            fields = (2, parts.contact.name, parts.contact.phonenumber, ParseTools.to_microseconds(parts.date),
+                      ParseTools.to_seconds(parts.duration), parts.audiotype, parts.text, parts.confidence, parts.filename,
+                      None if parts.confidences is None else parts.confidences.tostring())
+        else:
+            onewayname, texts = parts
+            fields = (3, onewayname, tuple((t.contact.name, t.contact.phonenumber, ParseTools.to_microseconds(t.date), t.text)
+                                           for t in texts))
+        return zlib.compress(marshal.dumps(fields, 2))
+
+    @classmethod
+    def decode(cls, data):
+        '''Rebuilds what Parser.extract returned from encode()'''
+        fields = marshal.loads(zlib.decompress(data))
+        kind   = fields[0]
+        if kind == 0:
+            return None
+        if kind == 3:
+            return (fields[1], [TextRecord(Contact(number, name), ParseTools.from_microseconds(date), text)
+                                for name, number, date, text in fields[2]])
+        contact  = Contact(fields[2], fields[1])
+        date     = ParseTools.from_microseconds(fields[3])
+        duration = ParseTools.from_seconds(fields[4])
+        if kind == 1:
+            return CallRecord(contact, date, duration, fields[5])
+        confidences = None if fields[9] is None else array.array('d', fields[9])
+        return AudioRecord(contact, date, duration, fields[5], fields[6], fields[7], fields[8], confidences)
+
+##-------------------
+
+class NumberBatch(object):
+    '''The durations and transcript confidences of the records read from many files,
+    converted together. While one is Parser.numbers, the records read leave their
+    numbers' texts to it, and convert() then turns them all into numbers at once and
+    fills in the records. Records read meanwhile are put in Parser.cache by
+    convert(), once they are whole.'''
+    def __init__(self):
+        self.durations   = [] #(record, text) for each call or voicemail with a duration
+        self.transcripts = [] #(record, word count) for each voicemail with a transcript
+        self.words       = [] #the texts of every transcript's word confidences, end to end
+        self.puts        = [] #(cache, key, parts) held back from ParseCache.put
+
+    def add_duration(self, record, text):
+        self.durations.append((record, text))
+
+    def add_confidences(self, record, texts):
+        self.transcripts.append((record, len(texts)))
+        self.words.extend(texts)
+
+    def put(self, cache, key, parts):
+        self.puts.append((cache, key, parts))
+
+    def convert(self):
+        '''Fills in every record's numbers, and puts them in the cache. Raises as
+        ParseTools.parse_time or parse_numbers would if one cannot be read.'''
+        if self.durations:
+            seconds = ParseTools.parse_durations([text for record, text in self.durations])
+            for (record, text), duration in itertools.izip(self.durations, seconds):
+                record.duration = ParseTools.from_seconds(duration)
+        if self.transcripts:
+            words = ParseTools.parse_numbers(self.words)
+            start = 0
+            for record, count in self.transcripts:
+                record.set_confidences(words[start:start + count])
+                start += count
+        for cache, key, parts in self.puts:
+            cache.put(key, parts)
+        self.__init__()
+
 class Parser:
+    engines = {'html5lib' : Html5libEngine, 'lxml' : LxmlEngine}
+    _engine_cache = {}
+    stats = None #a PhaseStats to record timings in, if wanted
+    cache = None #a ParseCache to keep parsed records in, if wanted
+    iterparse_bytes = 1 << 20 #the lxml engine reads text files this big with a ConversationReader
+    stream_texts = False #make those TextConversationStreams, which are not cached, instead of lists
+    numbers = None #a NumberBatch to leave the numbers in records to, if they are to be converted together
+
+    @classmethod
+    def get_engine(cls, engine):
+        '''Returns the ParserEngine registered under the name *engine*. An engine
+        object is passed through unchanged.'''
+        if isinstance(engine, ParserEngine):
+            return engine
+        if engine not in cls._engine_cache:
+            cls._engine_cache[engine] = cls.engines[engine]()
+        return cls._engine_cache[engine]
+
     @staticmethod
     def as_xhtml(path):
         ''' turns a regular xpath expression into an XHTML one'''
-        return re.sub('/(?=\w)', '/{http://www.w3.org/1999/xhtml}', path)
+        return _xhtml_path(path)
 
     @classmethod
-    def process_file(cls, filename, mynumbers):
+    def process_file(cls, filename, mynumbers, engine='html5lib', source=None):
         '''gets the gvoiceParser object from a file location'''
         '''*mynumbers* is a list of the phone numbers the account user uses'''
+        '''*engine* names the ParserEngine that builds the tree; see Parser.engines'''
+        '''*source* is the Source to read *filename* from, if it is not a path on disk'''
         ##BEGIN DEBUG
         #tb = html5lib.getTreeBuilder("etree", implementation=etree.ElementTree)
         #p = html5lib.HTMLParser(tb)
         #with open(filename, 'r') as f: #read the file
         #    tree = p.parse(f, encoding="iso-8859-15")
         ##END DEBUG
-        with open(filename, 'r') as f: #read the file
-            tree = html5lib.parse(f, encoding="iso-8859-15")
-        return cls.process_tree(tree, filename, mynumbers) #do the loading
+        read  = source.read if source else _read_file
+        stats = cls.stats
+        if stats is None:
+            return cls.process_bytes(read(filename), filename, mynumbers, engine)
+
+        start = time.time()
+        with stats.timing('file read'):
+            data = read(filename)
+        record = cls.process_bytes(data, filename, mynumbers, engine)
+        stats.add_file(filename, time.time() - start)
+        return record
+
+    @classmethod
+    def process_bytes(cls, data, filename, mynumbers, engine='html5lib', cachekey=None):
+        '''gets the gvoiceParser object from the contents of a file'''
+        '''*filename* is only used to identify the file in messages, and by classify'''
+        '''*cachekey* is ParseCache.key(data), if the caller has already worked it out'''
+        stats = cls.stats
+        if stats is None:
+            kind = cls.classify(data, filename)
+        else:
+            start = time.time()
+            kind  = cls.classify(data, filename)
+            stats.add('classify %s' % (kind or 'skip'), time.time() - start)
+        if kind is None: #cannot hold a record, so not worth parsing
+            return None
+
+        cache = cls.cache
+        if cache is None:
+            return cls.process_data(data, filename, mynumbers, engine, kind=kind) #do the loading
+
+        start = time.time()
+        key   = cachekey or cache.key(data)
+        parts = cache.get(key)
+        if parts is not ParseCache.missing:
+            record = cls.assemble(parts, filename, mynumbers)
+            if stats is not None:
+                stats.add('cache hit', time.time() - start)
+            return record
+        if stats is not None:
+            stats.add('cache miss', time.time() - start)
+        return cls.process_data(data, filename, mynumbers, engine, key, kind)
+
+    @classmethod
+    def process_data(cls, data, filename, mynumbers, engine='html5lib', cachekey=None, kind=None):
+        '''parses the contents of a file and gets the gvoiceParser object from them'''
+        '''A long conversation is read with a ConversationReader instead of building its
+        tree, when the engine is lxml; see iterparse_bytes and stream_texts'''
+        if kind == 'text' and len(data) >= cls.iterparse_bytes and isinstance(cls.get_engine(engine), LxmlEngine):
+            if cls.stream_texts:
+                record = TextConversationStream.from_bytes(data, filename, mynumbers)
+            else:
+                record = cls.process_conversation(data, filename, mynumbers, cachekey)
+            if record is not None:
+                return record
+        return cls.process_tree(cls.parse_tree(data, engine), filename, mynumbers, cachekey, kind)
+
+    @classmethod
+    def process_conversation(cls, data, filename, mynumbers, cachekey=None):
+        '''gets the TextConversationList from the contents of a file with a ConversationReader,
+        or None if it has no texts'''
+        stats = cls.stats
+        start = time.time()
+        reader = ConversationReader(data)
+        texts  = list(reader.messages())
+        if not texts:
+            return None
+        parts = (TextConversationList.onewayname(reader.title), texts)
+        if cachekey is not None:
+            cls.cache.put(cachekey, parts)
+        record = cls.assemble(parts, filename, mynumbers)
+        if stats is not None:
+            stats.add('lxml incremental text', time.time() - start)
+        return record
+
+    #The kind of record Takeout names each file for, e.g. "Jane Doe - Voicemail - 2011-07-09T14_12_31Z.html"
+    _filename_kind  = re.compile(r' - (Text|Placed|Received|Missed|Voicemail|Recorded) - ')
+    _filename_kinds = {'Text' : 'text', 'Placed' : 'call', 'Received' : 'call', 'Missed' : 'call',
+                       'Voicemail' : 'audio', 'Recorded' : 'audio'}
+
+    @classmethod
+    def classify(cls, data, filename):
+        '''guesses the kind of record in a file from its name and a scan of its bytes,
+        without parsing it: 'text', 'call', 'audio', or None if it cannot hold a record.
+        A conversation needs an hChatLog div and a call or voicemail an haudio div, so
+        a file with neither is None. Between a call and a voicemail the guess only
+        decides which extract tries first.'''
+        if 'hChatLog' in data:
+            return 'text'
+        if 'haudio' not in data:
+            return None
+        match = cls._filename_kind.search(filename)
+        if match:
+            kind = cls._filename_kinds[match.group(1)]
+            if kind != 'text':
+                return kind
+        return 'audio' if '<audio' in data else 'call'
+
+    @classmethod
+    def parse_tree(cls, data, engine='html5lib'):
+        '''builds the element tree of a file from its contents'''
+        engine = cls.get_engine(engine)
+        stats  = cls.stats
+        if stats is None:
+            return engine.parse(io.BytesIO(data))
+        with stats.timing('%s parse' % engine.name):
+            return engine.parse(io.BytesIO(data))
 
     @staticmethod
-    def process_tree(tree, filename, mynumbers):
+    def process_tree(tree, filename, mynumbers, cachekey=None, kind=None):
         '''gets the gvoiceParser object from an element tree'''
         '''*mynumbers* is a list of the phone numbers the account user uses'''
-        #TEXTS
-        #print filename
-        onewayname = tree.findtext(Parser.as_xhtml('.//title'));
-        onewayname = onewayname[6::] if onewayname.startswith("Me to") else None
-        #process the text files
-        obj = TextConversationList.from_node(tree, onewayname, filename, mynumbers)
-        if obj: #if text, then done
-            return obj
-        #CALLS
-        obj = CallRecord.from_node(tree)
-        if obj: #if text, then done
-            return obj
-        #AUDIO
-        obj = AudioRecord.from_node(tree)
-        if obj: #if text, then done
-            return obj
+        '''*cachekey* is the key to keep the record under in Parser.cache, if any'''
+        '''*kind* is what classify made of the file, if it was asked; see extract'''
+        stats = Parser.stats
+        if stats is None:
+            return Parser._process_tree(tree, filename, mynumbers, cachekey, kind)
+        start  = time.time()
+        record = Parser._process_tree(tree, filename, mynumbers, cachekey, kind)
+        kind   = {TextConversationList : 'text', CallRecord : 'call', AudioRecord : 'audio'}.get(type(record), 'nothing')
+        stats.add('extract %s' % kind, time.time() - start)
+        return record
+
+    @staticmethod
+    def _process_tree(tree, filename, mynumbers, cachekey=None, kind=None):
+        parts = Parser.extract(tree, kind)
+        if cachekey is not None:
+            if Parser.numbers is None:
+                Parser.cache.put(cachekey, parts)
+            else:
+                Parser.numbers.put(Parser.cache, cachekey, parts)
+        return Parser.assemble(parts, filename, mynumbers)
+
+    @staticmethod
+    def extract(tree, kind=None):
+        '''reads the record in an element tree, without the account user's numbers.
+        Returns a CallRecord or AudioRecord, or (onewayname, texts) for a text
+        conversation to be finished by assemble, or None.'''
+        '''*kind* is what classify made of the file. Unless it is 'text' or None the
+        search for a conversation is skipped, and a voicemail is looked for first if it
+        is 'audio'.'''
+        if kind is None or kind == 'text':
+            #TEXTS
+            #print filename
+            onewayname = TextConversationList.onewayname(tree.findtext(Paths.title))
+            #process the text files
+            texts = TextConversationList.texts_from_node(tree)
+            if texts: #if text, then done
+                return (onewayname, texts)
+        #CALLS and AUDIO. A node is one or the other, depending on whether it has
+        #audio, so which is tried first does not change the result.
+        for record_class in ((AudioRecord, CallRecord) if kind == 'audio' else (CallRecord, AudioRecord)):
+            obj = record_class.from_node(tree)
+            if obj: #if call or audio, then done
+                return obj
         #should not get this far
-        return None
\ No newline at end of file
+        return None
+
+    @staticmethod
+    def assemble(parts, filename, mynumbers):
+        '''gets the gvoiceParser object from what extract returned'''
+        '''*mynumbers* is a list of the phone numbers the account user uses'''
+        if isinstance(parts, tuple):
+            onewayname, texts = parts
+            return TextConversationList.from_texts(texts, onewayname, filename, mynumbers)
+        if parts is not None:
+            PhoneNumbers.for_account(mynumbers).fix(parts.contact)
+        return parts
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+#Benchmark gvParserLib and gvproc.py against a synthetic Google Voice Takeout
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import argparse
+import resource
+import re
+import htmlentitydefs
+import gvParserLib
+import gvproc
+
+MYNUMBER = '+15550000000'
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>%s</title></head><body>
+'''
+FOOTER = '</body></html>\n'
+
+TAGS = '<div class="tags">Labels: <a rel="tag" href="http://www.google.com/voice#inbox">Inbox</a>, <a rel="tag" href="http://www.google.com/voice#%s">%s</a></div>\n'
+
+TEL = '<a class="tel" href="tel:%s"><span class="fn">%s</span></a>'
+
+MESSAGE = '''<div class="message"><abbr class="dt" title="%s">%s</abbr>:
+<cite class="sender vcard">%s</cite>:
+<q>%s</q>
+</div>
+'''
+
+CALL = '''<div class="haudio">
+<span class="fn">%s</span>
+<div class="contributor vcard">%s
+%s</div>
+<abbr class="published" title="%s">%s</abbr>
+%s%s</div>
+'''
+
+VOICEMAIL = '''<div class="haudio">
+<span class="fn">%s</span>
+<div class="contributor vcard">%s
+%s</div>
+<abbr class="published" title="%s">%s</abbr>
+<br />
+%s
+<br />
+<abbr class="duration" title="PT%dS">(%s)</abbr>
+<audio controls="controls" src="%s"><a rel="enclosure" href="%s">Download</a></audio>
+%s</div>
+'''
+
+TEXT_BODIES = [
+  "On my way",
+  "Can you call me when you get a chance?",
+  "Sounds good &amp; see you at 7",
+  "I&#39;ll be there in 5",
+  "Caf&eacute; at noon? &#9749;",
+  "lol",
+  "Don&#39;t forget the &quot;thing&quot; &lt;3"
+]
+
+TRANSCRIPT_WORDS = "hey it is me just calling to see if you wanted to get dinner tonight give me a call back".split()
+
+class SyntheticTakeout(object):
+  '''Writes Takeout-style HTML files with the markup gvParserLib expects'''
+  def __init__(self, directory, contacts=200, seed=1):
+    self.directory = directory
+    self.random    = random.Random(seed)
+    self.people    = [('Person %d' % i, '+1555%07d' % (i+1)) for i in range(contacts)]
+    self.when      = 1293840000 #2011-01-01
+    self.files     = 0
+
+  def _tick(self):
+    '''Returns the title and display forms of a timestamp a little after the last'''
+    self.when += self.random.randint(1,3600)
+    stamp = time.gmtime(self.when)
+    return [time.strftime('%Y-%m-%dT%H:%M:%S.000Z', stamp), time.strftime('%b %d, %Y %I:%M:%S %p', stamp)]
+
+  def _write(self, name, kind, title, body):
+    filename = '%s - %s - %s.html' % (name, kind, time.strftime('%Y-%m-%dT%H_%M_%SZ', time.gmtime(self.when)))
+    with open(os.path.join(self.directory, filename), 'w') as f:
+      f.write(HEADER % title)
+      f.write(body)
+      f.write(FOOTER)
+    self.files += 1
+
+  def conversation(self, messages, multiway=False):
+    name, number = self.random.choice(self.people)
+    others = [(name, number)]
+    if multiway:
+      others.append(self.random.choice(self.people))
+    body = ['<div class="hChatLog hfeed">\n']
+    for i in range(messages):
+      title, shown = self._tick()
+      if self.random.random()<0.5:
+        sender = TEL % (MYNUMBER, 'Me')
+      else:
+        sender_name, sender_number = self.random.choice(others)
+        sender = TEL % (sender_number, sender_name)
+      body.append(MESSAGE % (title, shown, sender, self.random.choice(TEXT_BODIES)))
+    body.append('</div>\n')
+    body.append(TAGS % ('sms', 'Text'))
+    self._write(name, 'Text', name, ''.join(body))
+
+  def call(self):
+    name, number = self.random.choice(self.people)
+    calltype     = self.random.choice(['placed', 'received', 'missed'])
+    title, shown = self._tick()
+    duration     = ''
+    if calltype!='missed':
+      seconds  = self.random.randint(1,3600)
+      duration = '<br />\n<abbr class="duration" title="PT%dS">(%s)</abbr>\n' % (seconds, time.strftime('%H:%M:%S', time.gmtime(seconds)))
+    heading = '%s call %s' % (calltype.capitalize(), name)
+    body    = CALL % (heading, heading, TEL % (number, name), title, shown, duration, TAGS % (calltype, calltype.capitalize()))
+    self._write(name, calltype.capitalize(), name, body)
+
+  def voicemail(self, words, confidences=True):
+    '''Writes a voicemail with a transcript of words words, with or without their confidences'''
+    name, number = self.random.choice(self.people)
+    title, shown = self._tick()
+    seconds      = self.random.randint(1,120)
+    spoken       = [self.random.choice(TRANSCRIPT_WORDS) for i in range(words)]
+    description  = '<span class="description"><span class="full-text">%s</span>%s</span>' % (
+      ' '.join(spoken),
+      ' '.join('<span><span class="confidence">%0.3f</span>%s</span>' % (self.random.random(), w) for w in spoken) if confidences else '')
+    audiofile = '%s - Voicemail - %s.mp3' % (name, time.strftime('%Y-%m-%dT%H_%M_%SZ', time.gmtime(self.when)))
+    heading   = 'Voicemail from %s' % name
+    body      = VOICEMAIL % (heading, heading, TEL % (number, name), title, shown, description, seconds,
+                             time.strftime('%H:%M:%S', time.gmtime(seconds)), audiofile, audiofile, TAGS % ('voicemail', 'Voicemail'))
+    self._write(name, 'Voicemail', name, body)
+
+def GenerateTakeout(directory, conversations=1000, messages=20, calls=1000, voicemails=300, words=40, multiway=20, contacts=200, seed=1):
+  '''Fill directory with a synthetic Takeout. Returns the number of files written.'''
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  takeout = SyntheticTakeout(directory, contacts, seed)
+  jobs    = ['conversation']*conversations + ['multiway']*multiway + ['call']*calls + ['voicemail']*voicemails
+  takeout.random.shuffle(jobs)
+  for job in jobs:
+    if job=='conversation':
+      takeout.conversation(takeout.random.randint(1, 2*messages))
+    elif job=='multiway':
+      takeout.conversation(takeout.random.randint(2, 2*messages), multiway=True)
+    elif job=='call':
+      takeout.call()
+    else:
+      takeout.voicemail(words)
+  return takeout.files
+
+def PeakRSS():
+  '''Peak resident set size so far, in MB, of this process and its waited-for children'''
+  scale = 1024.0*1024.0 if sys.platform=='darwin' else 1024.0 #ru_maxrss is bytes on OS X, KB elsewhere
+  peak  = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  return peak/scale
+
+class PhaseTimer(object):
+  '''Collects the wall time, throughput and peak memory of each benchmark phase'''
+  def __init__(self, quiet=True):
+    self.phases = []
+    self.quiet  = quiet
+
+  def run(self, name, func, units=None):
+    '''Run func(), recording it under name. units(result) gives the number of
+       [files,records] handled, for the throughput columns.'''
+    stdout = sys.stdout
+    if self.quiet: #gvproc's progress messages would swamp the report
+      sys.stdout = open(os.devnull, 'w')
+    try:
+      start   = time.time()
+      result  = func()
+      elapsed = time.time()-start
+    finally:
+      sys.stdout = stdout
+    [files,records] = units(result) if units else [None,None]
+    self.phases.append({'phase':name, 'seconds':elapsed, 'files':files, 'records':records, 'peak_rss_mb':PeakRSS()})
+    return result
+
+  def report(self):
+    print "%-14s %9s %11s %13s %12s" % ('phase', 'seconds', 'files/sec', 'records/sec', 'peak RSS MB')
+    for p in self.phases:
+      files   = '%11.1f' % (p['files']/p['seconds'])   if p['files']   and p['seconds'] else '%11s' % '-'
+      records = '%13.1f' % (p['records']/p['seconds']) if p['records'] and p['seconds'] else '%13s' % '-'
+      print "%-14s %9.3f %s %s %12.1f" % (p['phase'], p['seconds'], files, records, p['peak_rss_mb'])
+
+RECORD_FIELDS = ['contact', 'receiver', 'date', 'duration', 'calltype', 'audiotype', 'text', 'confidence', 'filename']
+
+def RecordFields(record):
+  '''Everything a parsed record holds, as plain values that compare equal
+     across engines (dump() would also compare u'' against '')'''
+  if record is None:
+    return None
+  if isinstance(record, gvParserLib.TextConversationList):
+    return [RecordFields(record.contact), [RecordFields(r) for r in record]]
+  if isinstance(record, gvParserLib.Contact):
+    return (record.name, record.phonenumber)
+  fields = [getattr(record, f, None) for f in RECORD_FIELDS]
+  return [record.__class__.__name__] + [RecordFields(f) if isinstance(f, gvParserLib.Contact) else f for f in fields]
+
+def CompareEngines(directory, mynumbers):
+  '''Parse every file with each registered engine and report files whose records differ'''
+  engines = sorted(gvParserLib.Parser.engines)
+  differ  = 0
+  for fl in gvproc.ListGVoiceFiles(directory):
+    path    = os.path.join(directory, fl)
+    records = [RecordFields(gvParserLib.Parser.process_file(path, mynumbers, engine)) for engine in engines]
+    if any(r!=records[0] for r in records):
+      differ += 1
+      print "Engines disagree on %s" % (fl)
+  print "%d files differ between engines %s." % (differ, ', '.join(engines))
+  return differ
+
+def EffbotUnescape(text):
+  '''ParseTools.unescape as it was first written, for checking the current one against'''
+  def fixup(m):
+    text = m.group(0)
+    if text[:2] == "&#":
+      try:
+        if text[:3] == "&#x":
+          return unichr(int(text[3:-1], 16))
+        else:
+          return unichr(int(text[2:-1]))
+      except ValueError:
+        pass
+    else:
+      try:
+        text = unichr(htmlentitydefs.name2codepoint[text[1:-1]])
+      except KeyError:
+        pass
+    return text
+  return re.sub("&#?\w+;", fixup, text)
+
+def UnescapeBodies(count=2000, seed=1):
+  '''Message bodies as they come out of the HTML parser: plain ones, ones still
+     full of named and numeric entities, and ones full of emoji references'''
+  rnd    = random.Random(seed)
+  emoji  = [u'&#%d;' % rnd.randint(0x1F600, 0x1F64F) for i in range(40)] + [u'&#x%x;' % rnd.randint(0x2600, 0x26FF) for i in range(10)]
+  named  = [u'&amp;', u'&quot;', u'&lt;', u'&gt;', u'&eacute;', u'&nbsp;', u'&#39;', u'&bogus;', u'&#xZZ;']
+  words  = TRANSCRIPT_WORDS
+  bodies = []
+  for i in range(count):
+    kind = i % 3
+    if kind==0:
+      bodies.append(u' '.join(rnd.choice(words) for j in range(12)))
+    elif kind==1:
+      bodies.append(u' '.join(rnd.choice(words) + rnd.choice(named) for j in range(12)))
+    else:
+      bodies.append(u' '.join(rnd.choice(words) + u''.join(rnd.choice(emoji) for k in range(rnd.randint(1,4))) for j in range(12)))
+  return bodies
+
+def BenchmarkUnescape(repeat=5):
+  '''Time ParseTools.unescape against the original on UnescapeBodies, checking
+     that both give the same text. Returns [original,current] in microseconds per body.'''
+  bodies = UnescapeBodies()
+  for body in bodies:
+    [expected,got] = [EffbotUnescape(body),gvParserLib.ParseTools.unescape(body)]
+    if expected!=got or type(expected)!=type(got):
+      raise AssertionError("unescape differs on %r" % body)
+  times = []
+  for func in (EffbotUnescape, gvParserLib.ParseTools.unescape):
+    best = None
+    for i in range(repeat):
+      start = time.time()
+      for body in bodies:
+        func(body)
+      elapsed = time.time()-start
+      best    = elapsed if best is None else min(best,elapsed)
+    times.append(1e6*best/len(bodies))
+  print "unescape: %0.2fus per body before, %0.2fus now (%0.1fx)" % (times[0], times[1], times[0]/times[1])
+  return times
+
+class RewritingPaths(object):
+  '''gvParserLib.Paths as it was before the registry: each query is turned into
+     XHTML with Parser.as_xhtml every time it is made'''
+  def __init__(self, paths=gvParserLib.Paths):
+    self.plain = dict((name, getattr(paths, name)) for name in dir(paths) if not name.startswith('_'))
+    self.plain = dict((name, dict((k, v.replace(gvParserLib.XHTML, '')) for k, v in value.items()) if isinstance(value, dict)
+                             else value.replace(gvParserLib.XHTML, ''))
+                      for name, value in self.plain.items())
+
+  @staticmethod
+  def _rewrite(path):
+    if '/' not in path: #a tag name
+      return gvParserLib.XHTML + path
+    return gvParserLib.Parser.as_xhtml(path)
+
+  def __getattr__(self, name):
+    plain = self.plain[name]
+    if isinstance(plain, dict):
+      return RewritingLookup(plain, self._rewrite)
+    return self._rewrite(plain)
+
+class RewritingLookup(object):
+  '''A dictionary of paths, rewritten as they are looked up'''
+  def __init__(self, plain, rewrite):
+    self.plain   = plain
+    self.rewrite = rewrite
+
+  def __getitem__(self, key):
+    return self.rewrite(self.plain[key])
+
+def BenchmarkPaths(directory, mynumbers, engines=None, files=300, repeat=5):
+  '''Time Parser.process_tree on trees already parsed from the first files of
+     directory, looking its queries up in gvParserLib.Paths against rewriting
+     them on every lookup, and check that both give the same records. Returns
+     {engine:[rewriting,registry]} in microseconds per file.'''
+  names   = sorted(gvproc.ListGVoiceFiles(directory))[:files]
+  results = {}
+  for engine in engines or sorted(gvParserLib.Parser.engines):
+    trees = [(name, gvParserLib.Parser.parse_tree(gvParserLib._read_file(os.path.join(directory, name)), engine)) for name in names]
+    times = []
+    found = []
+    for paths in (RewritingPaths(), gvParserLib.Paths):
+      registry = gvParserLib.Paths
+      stdout   = sys.stdout
+      gvParserLib.Paths = paths
+      sys.stdout = open(os.devnull, 'w') #multiway conversations are reported as they are read
+      try:
+        found.append([RecordFields(gvParserLib.Parser.process_tree(tree, name, mynumbers)) for name, tree in trees])
+        best = None
+        for i in range(repeat):
+          start = time.time()
+          for name, tree in trees:
+            gvParserLib.Parser.process_tree(tree, name, mynumbers)
+          elapsed = time.time()-start
+          best    = elapsed if best is None else min(best, elapsed)
+      finally:
+        gvParserLib.Paths = registry
+        sys.stdout = stdout
+      times.append(1e6*best/len(trees))
+    if found[0]!=found[1]:
+      raise AssertionError("Paths change the records read by %s" % engine)
+    print "paths (%s): %0.1fus per file rewriting, %0.1fus with the registry (%0.2fx)" % (engine, times[0], times[1], times[0]/times[1])
+    results[engine] = times
+  return results
+
+def Benchmark(directory, mynumbers, engine='html5lib', jobs=1, batchsize=5000, quiet=True):
+  '''Time each phase of a gvproc.py load of directory into a scratch database'''
+  timer    = PhaseTimer(quiet)
+  nfiles   = len(gvproc.ListGVoiceFiles(directory))
+  records  = timer.run('parse', lambda: gvproc.ReadGVoiceRecords(directory, mynumbers, jobs, engine=engine),
+                       lambda r: [nfiles, len(r)])
+  records  = timer.run('batch', lambda: gvParserLib.RecordBatch(records),
+                       lambda r: [None, len(r)])
+  fixed    = timer.run('contact-fix', lambda: gvproc.FixContactNumbers(records, None, mynumbers),
+                       lambda r: [None, len(r[0])])
+  records  = fixed[0]
+
+  scratch = tempfile.mkdtemp(prefix='gvbench')
+  try:
+    def Write():
+      [conn,cur] = gvproc.OpenDatabase(os.path.join(scratch, 'bench.db'), False)
+      gvproc.WriteRecordsToSQL(cur, records, batchsize)
+      conn.commit()
+      conn.close()
+    timer.run('sql-write', Write, lambda r: [None, len(records)])
+  finally:
+    shutil.rmtree(scratch)
+  return timer
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark Google Voice parsing and loading on a synthetic Takeout.')
+  parser.add_argument('--corpus', action='store', default=None, help='Directory to keep the synthetic Takeout in. It is generated only if the directory does not exist. Default: a temporary directory.')
+  parser.add_argument('--conversations', action='store', type=int, default=1000, help='Number of text conversations to generate.')
+  parser.add_argument('--messages', action='store', type=int, default=20, help='Average number of messages per conversation.')
+  parser.add_argument('--calls', action='store', type=int, default=1000, help='Number of placed, received and missed calls to generate.')
+  parser.add_argument('--voicemails', action='store', type=int, default=300, help='Number of transcribed voicemails to generate.')
+  parser.add_argument('--words', action='store', type=int, default=40, help='Number of transcribed words per voicemail.')
+  parser.add_argument('--multiway', action='store', type=int, default=20, help='Number of multiway conversations to generate.')
+  parser.add_argument('--contacts', action='store', type=int, default=200, help='Number of distinct people in the Takeout.')
+  parser.add_argument('--seed', action='store', type=int, default=1, help='Random seed for the synthetic Takeout.')
+  parser.add_argument('--engine', action='store', default='html5lib', choices=sorted(gvParserLib.Parser.engines), help='HTML parser to benchmark.')
+  parser.add_argument('--jobs', '-j', action='store', type=int, default=1, help='Number of processes to parse with.')
+  parser.add_argument('--batchsize', action='store', type=int, default=5000, help='Rows per statement when writing to SQLite.')
+  parser.add_argument('--unescape', help='Also time entity unescaping on bodies full of entities and emoji, against the original version.', action='store_const', const=True, default=False)
+  parser.add_argument('--paths', help='Also time the record classes\' tree queries with the precomputed gvParserLib.Paths, against rewriting each path on every lookup as before.', action='store_const', const=True, default=False)
+  parser.add_argument('--compare', help='Also check that every parser engine gives the same records.', action='store_const', const=True, default=False)
+  parser.add_argument('--verbose', '-v', help="Show gvproc's own messages while benchmarking.", action='store_const', const=True, default=False)
+  parser.add_argument('--json', action='store', default=None, help='File to write the results to as JSON, for comparing runs.')
+  args = parser.parse_args()
+
+  corpus = args.corpus or tempfile.mkdtemp(prefix='gvtakeout')
+  try:
+    if not args.corpus or not os.path.isdir(corpus):
+      start = time.time()
+      files = GenerateTakeout(corpus, args.conversations, args.messages, args.calls, args.voicemails,
+                              args.words, args.multiway, args.contacts, args.seed)
+      print "Generated %d files in %0.1fs." % (files, time.time()-start)
+
+    mynumbers = [MYNUMBER.lstrip('+')]
+    if args.compare:
+      CompareEngines(corpus, mynumbers)
+
+    unescape = None
+    if args.unescape:
+      unescape = BenchmarkUnescape()
+
+    paths = None
+    if args.paths:
+      paths = BenchmarkPaths(corpus, mynumbers)
+
+    timer = Benchmark(corpus, mynumbers, args.engine, args.jobs, args.batchsize, not args.verbose)
+    timer.report()
+
+    if args.json:
+      results = {'engine':args.engine, 'jobs':args.jobs, 'phases':timer.phases}
+      if unescape:
+        results['unescape_us'] = {'original':unescape[0], 'current':unescape[1]}
+      if paths:
+        results['paths_us'] = dict((engine, {'rewriting':t[0], 'registry':t[1]}) for engine, t in paths.items())
+      with open(args.json, 'w') as f:
+        json.dump(results, f, indent=2)
+  finally:
+    if not args.corpus:
+      shutil.rmtree(corpus)
+
+if __name__=='__main__':
+  main()
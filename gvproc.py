@@ -1,41 +1,629 @@
 #!/usr/bin/env python
 #Author: Richard Barnes (rbarnes@umn.edu)
 import os
+import time
 import gvParserLib
 import sys
 import sqlite3
 import csv
 import collections
 import argparse
+import multiprocessing
+import itertools
+import hashlib
+import struct
+import array
+import bisect
+import heapq
+import contextlib
+import json
+import cProfile
+import shutil
+import tempfile
+import select
+import signal
+import ctypes
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError: #only needed for --parquet
+  pyarrow = None
+try:
+  import numpy
+except ImportError: #only used to check --fingerprints a batch at a time
+  numpy = None
+
+CONTACTS_TABLE = '''CREATE TABLE contacts (id INTEGER PRIMARY KEY, name TEXT, number TEXT UNIQUE, notes TEXT)'''
 
 def NewDatabase(cur):
-  cur.execute('''CREATE TABLE texts (time DATETIME, number TEXT, message TEXT, texttype TEXT)''')
-  cur.execute('''CREATE TABLE audio (time DATETIME, number TEXT, duration INTEGER, type TEXT, text TEXT, confidence REAL, filename TEXT)''')
-  cur.execute('''CREATE TABLE calls (time DATETIME, number TEXT, duration INTEGER, calltype TEXT)''')
-  cur.execute('''CREATE TABLE contacts (name TEXT, number TEXT UNIQUE, notes TEXT)''')
-
-def ReadGVoiceRecords(directory,mynumbers):
-  records         = []
-  files_processed = 0
-  for fl in os.listdir(directory):
-    if fl.endswith(".html"):
-      record = gvParserLib.Parser.process_file(os.path.join(directory, fl),mynumbers)
+  cur.execute(CONTACTS_TABLE)
+  cur.execute('''CREATE TABLE texts (time DATETIME, number TEXT, message TEXT, texttype TEXT, contact_id INTEGER REFERENCES contacts(id))''')
+  cur.execute('''CREATE TABLE audio (time DATETIME, number TEXT, duration INTEGER, type TEXT, text TEXT, confidence REAL, filename TEXT, contact_id INTEGER REFERENCES contacts(id))''')
+  cur.execute('''CREATE TABLE calls (time DATETIME, number TEXT, duration INTEGER, calltype TEXT, contact_id INTEGER REFERENCES contacts(id))''')
+
+#Natural key of each record table. Numbers can be missing, and SQLite never
+#treats two NULLs as equal, so keys compare a missing number as ''.
+RECORD_KEYS = [
+  ('texts', 'texts_key', "time, IFNULL(number,''), texttype, message"),
+  ('calls', 'calls_key', "time, IFNULL(number,''), calltype"),
+  ('audio', 'audio_key', "time, IFNULL(number,''), type")
+]
+
+#Indexes for looking records up by number, contact, type and time range
+RECORD_INDEXES = [
+  ('texts', 'texts_number',  "number, time"),
+  ('texts', 'texts_contact', "contact_id, time"),
+  ('calls', 'calls_number',  "number, time"),
+  ('calls', 'calls_contact', "contact_id, time"),
+  ('calls', 'calls_type',    "calltype, time"),
+  ('calls', 'calls_stats',   "number, calltype, duration"),
+  ('audio', 'audio_number',  "number, time"),
+  ('audio', 'audio_contact', "contact_id, time"),
+  ('audio', 'audio_type',    "type, time")
+]
+
+def CreateRecordKeys(cur):
+  '''Create the unique index on each record table's natural key, removing any
+     duplicate records that got in while it was missing, and the lookup
+     indexes'''
+  for table,index,columns in RECORD_INDEXES:
+    cur.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (index,table,columns))
+  removed = False
+  for table,index,key in RECORD_KEYS:
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (index,))
+    if cur.fetchone():
+      continue
+    try:
+      cur.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (index,table,key))
+    except sqlite3.IntegrityError:
+      cur.execute('DELETE FROM %s WHERE rowid NOT IN (SELECT MIN(rowid) FROM %s GROUP BY %s)' % (table,table,key))
+      print "Removed %d duplicate records from %s." % (cur.rowcount,table)
+      cur.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (index,table,key))
+      removed = True
+  #The duplicates were counted as they went in
+  if removed and HasContactStats(cur):
+    RebuildContactStats(cur)
+
+def DropRecordKeys(cur):
+  '''Drop the natural-key and lookup indexes so a bulk load need not maintain
+     them row by row. Until CreateRecordKeys is called, duplicates are not
+     caught.'''
+  for table,index,key in RECORD_KEYS+RECORD_INDEXES:
+    cur.execute('DROP INDEX IF EXISTS %s' % (index))
+
+def TableColumns(cur,table):
+  cur.execute('PRAGMA table_info(%s)' % (table))
+  return [row[1] for row in cur.fetchall()]
+
+def UpgradeContacts(cur):
+  '''Give the contacts of a database made by an older version integer ids, and
+     its records a contact_id column to refer to them by'''
+  if 'id' not in TableColumns(cur,'contacts'):
+    #SQLite cannot add a primary key to a table, so copy it into a new one
+    cur.execute('ALTER TABLE contacts RENAME TO contacts_old')
+    cur.execute(CONTACTS_TABLE)
+    cur.execute('INSERT INTO contacts (name,number,notes) SELECT name,number,notes FROM contacts_old ORDER BY rowid')
+    cur.execute('DROP TABLE contacts_old')
+  added = False
+  for table in RECORD_COLUMNS:
+    if 'contact_id' not in TableColumns(cur,table):
+      cur.execute('ALTER TABLE %s ADD COLUMN contact_id INTEGER REFERENCES contacts(id)' % (table))
+      added = True
+  if added:
+    LinkContacts(cur)
+
+def LastRowids(cur):
+  '''The last rowid of each record table and of contacts, or 0 if it is empty.
+     Rows added after this have greater ones.'''
+  return dict((table,cur.execute('SELECT IFNULL(MAX(rowid),0) FROM %s' % (table)).fetchone()[0])
+              for table in list(RECORD_COLUMNS)+['contacts'])
+
+def LinkContacts(cur,since=None):
+  '''Set the contact_id of each record whose number has become a contact. If
+     since, what LastRowids gave before a load, is given, only the records the
+     load added and the records of the contacts it added are looked at, rather
+     than every record that has no contact.'''
+  link = '''UPDATE %s SET contact_id=(SELECT id FROM contacts WHERE contacts.number=%s.number)
+            WHERE '''
+  for table in RECORD_COLUMNS:
+    if since is None:
+      cur.execute(link % (table,table)+'contact_id IS NULL AND number IN (SELECT number FROM contacts)')
+      continue
+    #The unary +s keep SQLite from looking the rows up by contact_id or number,
+    #which would visit every record, instead of by rowid or the new numbers
+    cur.execute(link % (table,table)+'rowid>? AND +contact_id IS NULL AND +number IN (SELECT number FROM contacts)',(since[table],))
+    if since[table] and cur.execute('SELECT 1 FROM contacts WHERE id>?',(since['contacts'],)).fetchone():
+      cur.execute(link % (table,table)+'number IN (SELECT number FROM contacts WHERE id>?) AND +contact_id IS NULL AND rowid<=?',
+                  (since['contacts'],since[table]))
+
+#Full-text indexes over message text and voicemail transcripts, kept up to date
+#by triggers once created
+TEXT_SEARCH = [('texts', 'texts_fts', 'message'), ('audio', 'audio_fts', 'text')]
+
+def CreateTextSearch(cur):
+  '''Create the FTS5 full-text indexes, if this SQLite has FTS5. Returns
+     whether they exist.'''
+  for table,fts,column in TEXT_SEARCH:
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name=?", (fts,))
+    if cur.fetchone():
+      continue
+    try:
+      cur.execute("CREATE VIRTUAL TABLE %s USING fts5(%s, content='%s', content_rowid='rowid')" % (fts,column,table))
+    except sqlite3.OperationalError:
+      print "This SQLite has no FTS5; not creating full-text indexes."
+      return False
+    values = {'table':table, 'fts':fts, 'column':column}
+    cur.execute('''CREATE TRIGGER %(fts)s_insert AFTER INSERT ON %(table)s BEGIN
+                     INSERT INTO %(fts)s (rowid,%(column)s) VALUES (new.rowid,new.%(column)s);
+                   END''' % values)
+    cur.execute('''CREATE TRIGGER %(fts)s_delete AFTER DELETE ON %(table)s BEGIN
+                     INSERT INTO %(fts)s (%(fts)s,rowid,%(column)s) VALUES ('delete',old.rowid,old.%(column)s);
+                   END''' % values)
+    cur.execute('''CREATE TRIGGER %(fts)s_update AFTER UPDATE OF %(column)s ON %(table)s BEGIN
+                     INSERT INTO %(fts)s (%(fts)s,rowid,%(column)s) VALUES ('delete',old.rowid,old.%(column)s);
+                     INSERT INTO %(fts)s (rowid,%(column)s) VALUES (new.rowid,new.%(column)s);
+                   END''' % values)
+    cur.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (fts,fts))
+  return True
+
+#Per-number summaries of the records, overall and per month, kept up to date
+#by triggers once created. What each record table adds to its number's row.
+CONTACT_STATS = [
+  ('texts', "texts=texts+1"),
+  ('calls', "calls=calls+1, call_seconds=call_seconds+IFNULL(new.duration,0)"),
+  ('audio', "voicemails=voicemails+(new.type='voicemail')")
+]
+
+#The same, for a GROUP BY over a whole record table
+CONTACT_STATS_COLUMNS = ['texts','calls','call_seconds','voicemails']
+CONTACT_STATS_SUMS    = {
+  'texts' : ["COUNT(*)", "0", "0", "0"],
+  'calls' : ["0", "COUNT(*)", "IFNULL(SUM(duration),0)", "0"],
+  'audio' : ["0", "0", "0", "SUM(type='voicemail')"]
+}
+
+def HasContactStats(cur):
+  cur.execute("SELECT 1 FROM sqlite_master WHERE name='contact_stats'")
+  return cur.fetchone() is not None
+
+def CreateContactStats(cur):
+  '''Create the contact_stats and contact_month_stats tables, of the texts,
+     calls, call seconds, voicemails and first and last record with each
+     number, overall and per month, along with the triggers that add each
+     record inserted from then on, and fill them in'''
+  if HasContactStats(cur):
+    return
+  columns = '''texts INTEGER NOT NULL DEFAULT 0, calls INTEGER NOT NULL DEFAULT 0, call_seconds INTEGER NOT NULL DEFAULT 0,
+               voicemails INTEGER NOT NULL DEFAULT 0, first_time DATETIME, last_time DATETIME'''
+  cur.execute('CREATE TABLE contact_stats (number TEXT PRIMARY KEY, %s)' % (columns))
+  cur.execute('CREATE TABLE contact_month_stats (number TEXT, month TEXT, %s, PRIMARY KEY (number,month))' % (columns))
+  for table,update in CONTACT_STATS:
+    #Rows that INSERT OR IGNORE skips as duplicates do not fire these
+    values = {'table':table, 'update':update, 'times':"first_time=MIN(IFNULL(first_time,new.time),new.time), last_time=MAX(IFNULL(last_time,new.time),new.time)"}
+    cur.execute('''CREATE TRIGGER %(table)s_contact_stats AFTER INSERT ON %(table)s BEGIN
+                     INSERT OR IGNORE INTO contact_stats (number) VALUES (IFNULL(new.number,''));
+                     UPDATE contact_stats SET %(update)s, %(times)s WHERE number=IFNULL(new.number,'');
+                     INSERT OR IGNORE INTO contact_month_stats (number,month) VALUES (IFNULL(new.number,''),strftime('%%Y-%%m',new.time));
+                     UPDATE contact_month_stats SET %(update)s, %(times)s WHERE number=IFNULL(new.number,'') AND month=strftime('%%Y-%%m',new.time);
+                   END''' % values)
+  RebuildContactStats(cur)
+
+def RebuildContactStats(cur):
+  '''Work the contact_stats and contact_month_stats tables out again from the
+     record tables, for when records have been removed or changed'''
+  for stats,keys in (('contact_stats',       [("IFNULL(number,'')",'number')]),
+                     ('contact_month_stats', [("IFNULL(number,'')",'number'), ("strftime('%Y-%m',time)",'month')])):
+    names = ', '.join(name for expr,name in keys)
+    parts = ' UNION ALL '.join('SELECT %s, %s, MIN(time) AS first_time, MAX(time) AS last_time FROM %s GROUP BY %s' % (
+                                 ', '.join('%s AS %s' % key for key in keys),
+                                 ', '.join('%s AS %s' % sums for sums in zip(CONTACT_STATS_SUMS[table],CONTACT_STATS_COLUMNS)),
+                                 table, ', '.join(expr for expr,name in keys))
+                               for table,update in CONTACT_STATS)
+    cur.execute('DELETE FROM %s' % (stats))
+    cur.execute('INSERT INTO %s (%s, %s, first_time, last_time) SELECT %s, %s, MIN(first_time), MAX(last_time) FROM (%s) GROUP BY %s' % (
+                  stats, names, ', '.join(CONTACT_STATS_COLUMNS),
+                  names, ', '.join('SUM(%s)' % (column) for column in CONTACT_STATS_COLUMNS), parts, names))
+
+def UpgradeDatabase(cur):
+  '''Add the tables and keys that databases created by older versions of this
+     program lack. Such databases may hold duplicate records from appending;
+     these are removed before the keys are created.'''
+  cur.execute('''CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)''')
+  cur.execute('''CREATE TABLE IF NOT EXISTS contact_index (name TEXT, number TEXT, count INTEGER)''')
+  cur.execute('''CREATE INDEX IF NOT EXISTS contact_index_pair ON contact_index (name,number)''')
+  cur.execute('''CREATE TABLE IF NOT EXISTS fingerprint_index (id INTEGER PRIMARY KEY CHECK (id=0), records INTEGER, hashes INTEGER, bloom BLOB, fingerprints BLOB)''')
+  cur.execute('''CREATE TABLE IF NOT EXISTS fingerprint_runs (id INTEGER PRIMARY KEY, fingerprints BLOB)''')
+  cur.execute('''CREATE TABLE IF NOT EXISTS number_format (id INTEGER PRIMARY KEY CHECK (id=0), country TEXT)''')
+  UpgradeContacts(cur)
+  CreateRecordKeys(cur)
+
+def TuneDatabase(cur,journalmode=None,synchronous=None):
+  '''Set SQLite's journal mode and sync level. WAL and synchronous=OFF make a
+     bulk load much faster; OFF risks a corrupt database if the machine (not
+     just this program) dies mid-load.'''
+  if journalmode:
+    cur.execute('PRAGMA journal_mode=%s' % (journalmode))
+  if synchronous:
+    cur.execute('PRAGMA synchronous=%s' % (synchronous))
+
+def OpenDatabase(filename,clear):
+  '''Connect to the database, creating its tables if it is new and emptying
+     the record tables, file manifest and contact index if clear is set.
+     Returns [conn,cur].'''
+  db_existed = os.path.isfile(filename)
+
+  conn = sqlite3.connect(filename)
+  cur  = conn.cursor()
+
+  if not db_existed:
+    NewDatabase(cur)
+  UpgradeDatabase(cur)
+
+  if clear:
+    cur.execute('DELETE FROM texts;')
+    cur.execute('DELETE FROM audio;')
+    cur.execute('DELETE FROM calls;')
+    cur.execute('DELETE FROM files;')
+    cur.execute('DELETE FROM contact_index;')
+    cur.execute('DELETE FROM fingerprint_index;')
+    cur.execute('DELETE FROM fingerprint_runs;')
+    if HasContactStats(cur):
+      cur.execute('DELETE FROM contact_stats;')
+      cur.execute('DELETE FROM contact_month_stats;')
+
+  return [conn,cur]
+
+#Older versions kept the first run of digits in a number, so misread one written
+#with spaces or dashes as its country or area code: never more than four digits.
+MISREAD_NUMBER = "number NOT GLOB '*[^0-9]*' AND length(number) BETWEEN 1 AND 4"
+
+def CanonicalNumbers(cur,numbers):
+  '''Put the numbers of a database loaded before numbers were made canonical
+     into the canonical form of numbers, a gvParserLib.PhoneNumbers. Records
+     and contacts that turn out to be duplicates once their numbers match are
+     removed. Only done once; the country it was done for is kept in the
+     number_format table. Numbers the older parser misread, such as '1' for
+     '+1 555-123-4567', cannot be put right, so the records they are on stay
+     beside the ones read correctly later; if there are any, a warning says to
+     load again with --clear.'''
+  if cur.execute('SELECT country FROM number_format WHERE id=0').fetchone():
+    return
+  misread = sum(cur.execute('SELECT COUNT(*) FROM %s WHERE %s' % (table,MISREAD_NUMBER)).fetchone()[0] for table in sorted(RECORD_COLUMNS))
+  cur.connection.create_function('canonical_number',1,numbers.canonical)
+  changed = 0
+  for table in sorted(RECORD_COLUMNS)+['contacts']:
+    #Rows whose canonical form is already there stay behind, and are dropped
+    cur.execute('UPDATE OR IGNORE %s SET number=canonical_number(number) WHERE number!=canonical_number(number)' % (table))
+    changed += cur.rowcount
+    if table=='contacts':
+      for records in RECORD_COLUMNS:
+        cur.execute('''UPDATE %s SET contact_id=NULL WHERE contact_id IN
+                         (SELECT id FROM contacts WHERE number!=canonical_number(number))''' % (records))
+    cur.execute('DELETE FROM %s WHERE number!=canonical_number(number)' % (table))
+    if cur.rowcount:
+      print "Removed %d %s that were duplicates once their numbers were made canonical." % (cur.rowcount,table)
+  cur.execute('UPDATE contact_index SET number=canonical_number(number) WHERE number!=canonical_number(number)')
+  if cur.rowcount:
+    #Pairs that now match are merged into the first, since each is saved by itself
+    cur.execute('''UPDATE contact_index SET count=(SELECT SUM(count) FROM contact_index AS pair
+                                                    WHERE pair.name IS contact_index.name AND pair.number IS contact_index.number)
+                   WHERE rowid IN (SELECT MIN(rowid) FROM contact_index GROUP BY name,number HAVING COUNT(*)>1)''')
+    cur.execute('DELETE FROM contact_index WHERE rowid NOT IN (SELECT MIN(rowid) FROM contact_index GROUP BY name,number)')
+  if changed:
+    cur.execute('DELETE FROM fingerprint_index')
+    cur.execute('DELETE FROM fingerprint_runs')
+    LinkContacts(cur)
+    if HasContactStats(cur):
+      RebuildContactStats(cur)
+    print "Made %d numbers canonical." % (changed)
+  cur.execute('INSERT INTO number_format (id,country) VALUES (0,?)',(numbers.country,))
+  if misread:
+    print "Warning: %d records in this database have numbers an older version misread, such as '1' for '+1 555-123-4567'. They are not fixed, and will be duplicated by loading the same files again. Load the files again with --clear to replace them; contacts with misread numbers are kept by --clear, and have to be deleted by hand." % (misread)
+
+def ListGVoiceFiles(directory):
+  '''Names of the Google Voice HTML files in directory'''
+  return [fl for fl in os.listdir(directory) if fl.endswith(".html")]
+
+def ChangedGVoiceFiles(cur,directory,members=None):
+  '''Find the Google Voice files in directory (a path to a directory or
+     Takeout archive, or a gvParserLib.Source) that are missing from the
+     database's file manifest or differ from the copy loaded before. Returns
+     [changed,files]: the names of those files, and what RecordFiles is to put
+     in the manifest once they are loaded, a dictionary of name and
+     (size,mtime,hash). A file whose size and modification time match its
+     manifest entry is taken to be unchanged without reading it. Only a file
+     whose size matches but whose modification time does not is read here, to
+     see whether its contents are the same; if they are, only its new
+     modification time is in files. A new file, or one whose size has
+     changed, is only read by the parser, and its hash comes from there.
+     Files are known to the manifest by name alone, so a Takeout loaded
+     unpacked is recognised when loaded again as an archive. If members, a
+     list of (name,size,mtime), is given only those files are checked.'''
+  source = gvParserLib.Source.from_path(directory)
+  if members is None:
+    members = source.members()
+    cur.execute('SELECT path,size,mtime,hash FROM files')
+    manifest = dict((row[0],row[1:]) for row in cur)
+  else:
+    manifest = {}
+    for name,size,mtime in members:
+      row = cur.execute('SELECT size,mtime,hash FROM files WHERE path=?',(source.key(name),)).fetchone()
+      if row:
+        manifest[source.key(name)] = row
+
+  changed = []
+  files   = collections.OrderedDict()
+  tohash  = []
+  for name,size,mtime in members:
+    known = manifest.get(source.key(name))
+    if known and known[0]==size and known[1]==mtime:
+      continue
+    if known and known[0]==size:
+      tohash.append(name)
+    files[name] = (size,mtime,None)
+    changed.append(name)
+
+  touched = set()
+  for name,data in source.iter_bytes(tohash):
+    digest      = hashlib.sha1(data).hexdigest()
+    files[name] = files[name][:2]+(digest,)
+    if manifest[source.key(name)][2]==digest: #Touched, but not changed
+      touched.add(name)
+  if touched:
+    changed = [name for name in changed if name not in touched]
+
+  print "%d of %d files are new or changed." % (len(changed),len(members))
+  return [changed,files]
+
+def RecordFiles(cur,source,files,digests):
+  '''Put files, as returned by ChangedGVoiceFiles, in the file manifest, with
+     the hash of each file the parser read from digests, a dictionary of file
+     names and the SHA-1 of their contents as filled in by IterGVoiceRecords.
+     Do this after writing the files' records, in the same transaction, so
+     that a load that stops part way leaves none of its files in the manifest
+     to be skipped by the next.'''
+  cur.executemany('INSERT OR REPLACE INTO files (path,size,mtime,hash) VALUES (?,?,?,?)',
+                  ((source.key(name),size,mtime,digests.get(name,digest)) for name,(size,mtime,digest) in files.iteritems()))
+
+@contextlib.contextmanager
+def Timing(stats,phase,count=1):
+  '''Charge the time spent in a with block to phase, if stats are being kept'''
+  if stats is None:
+    yield
+  else:
+    with stats.timing(phase,count):
+      yield
+
+def _InitParseWorker(mynumbers,country,engine,keep_stats,source,cache,shards=None,incremental=False,skip=False):
+  '''Pool initializer: give each worker process the account's numbers, their
+     country, and the parser engine once, rather than pickling them along with
+     every file name.
+     source is the path of the directory or archive files are read from, which
+     each worker opens for itself, or None if files are sent already read.
+     cache is the filename of the parse cache, if there is one. shards is the
+     directory to make the worker's ShardWriter database in, if records are to
+     be written by the workers. incremental sets gvParserLib.Parser.stream_texts.
+     skip is passed to _ParseItems.'''
+  global _worker_mynumbers, _worker_engine, _worker_keep_stats, _worker_source, _worker_shard, _worker_skip
+  _worker_mynumbers  = mynumbers
+  #The worker's parser finds the account's PhoneNumbers by its numbers
+  gvParserLib.PhoneNumbers.for_account(mynumbers,country)
+  _worker_engine     = engine
+  _worker_keep_stats = keep_stats
+  _worker_source     = source and gvParserLib.Source.from_path(source)
+  _worker_shard      = None
+  _worker_skip       = skip
+  gvParserLib.Parser.stream_texts = incremental
+  if cache:
+    gvParserLib.Parser.cache = gvParserLib.ParseCache(cache)
+    #Write out the worker's last few records when the pool shuts it down
+    multiprocessing.util.Finalize(gvParserLib.Parser.cache,gvParserLib.Parser.cache.close,exitpriority=10)
+  if shards:
+    _worker_shard = ShardWriter(os.path.join(shards,'shard-%d.db' % (os.getpid())))
+    multiprocessing.util.Finalize(_worker_shard,_worker_shard.close,exitpriority=10)
+
+def _ParseItem(item,mynumbers,engine,source):
+  '''Parse one file: either a name to read from source, or a (name,contents)
+     pair that has already been read. Returns [name,record,digest], where
+     digest is the SHA-1 of the file's contents, for the file manifest. It is
+     also the file's key in the parse cache, so it is only worked out once.'''
+  stats = gvParserLib.Parser.stats
+  start = time.time()
+  if isinstance(item,tuple):
+    [name,data] = item
+  else:
+    name = item
+    with Timing(stats,'file read'):
+      data = source.read(name)
+  digest = gvParserLib.ParseCache.key(data)
+  record = gvParserLib.Parser.process_bytes(data,name,mynumbers,engine,digest)
+  if stats:
+    stats.add_file(name,time.time()-start)
+  return [name,record,digest]
+
+def _ParseItems(items,mynumbers,engine,source,skip=False):
+  '''Parse a chunk of files with _ParseItem, returning a list of
+     [name,record,digest,error] for each, where error is None. The durations
+     and confidences of all their records are converted together once the
+     files are read; see gvParserLib.NumberBatch. If a file cannot be parsed,
+     or they cannot be converted, the files are parsed again one at a time,
+     so that the error is raised for the file it is in. With skip it is not
+     raised: that file's record and digest are None instead, and error says
+     what went wrong.'''
+  numbers = gvParserLib.Parser.numbers = gvParserLib.NumberBatch()
+  try:
+    parsed = [_ParseItem(item,mynumbers,engine,source)+[None] for item in items]
+    with Timing(gvParserLib.Parser.stats,'number conversion',len(items)):
+      numbers.convert()
+  except Exception:
+    if len(items)==1 and not skip:
+      raise
+    gvParserLib.Parser.numbers = None
+    parsed = [_TryParseItem(item,mynumbers,engine,source,skip) for item in items]
+  finally:
+    gvParserLib.Parser.numbers = None
+  return parsed
+
+def _TryParseItem(item,mynumbers,engine,source,skip):
+  '''_ParseItem, giving what _ParseItems does for the file'''
+  try:
+    return _ParseItem(item,mynumbers,engine,source)+[None]
+  except Exception as e:
+    if not skip:
+      raise
+    name = item[0] if isinstance(item,tuple) else item
+    return [name,None,None,'%s: %s' % (e.__class__.__name__,e)]
+
+def _ParseWorker(items):
+  '''Parse a chunk of files inside a pool worker. Returns a list of
+     [name,record,digest,error,stats] (see _ParseItems) for each, where stats
+     are the chunk's own gvParserLib.PhaseStats, given with its first file, or
+     None if not kept.
+     If the worker has a shard, what ShardWriter.take returns is sent back in
+     place of each record.'''
+  stats = None
+  if _worker_keep_stats:
+    stats = gvParserLib.PhaseStats(slowest=len(items))
+    gvParserLib.Parser.stats = stats
+  parsed = []
+  for name,record,digest,error in _ParseItems(items,_worker_mynumbers,_worker_engine,_worker_source,_worker_skip):
+    if record and _worker_shard:
+      record = _worker_shard.take(record,stats)
+    parsed.append([name,record,digest,error,None])
+  if parsed:
+    parsed[0][4] = stats
+  return parsed
+
+def _Chunks(items,chunksize):
+  '''Lists of chunksize of items at a time'''
+  items = iter(items)
+  while True:
+    chunk = list(itertools.islice(items,chunksize))
+    if not chunk:
+      return
+    yield chunk
+
+def _WindowedImap(imap,func,items,chunksize,window):
+  '''Like imap(func,items,chunksize), but only window items are queued on the
+     pool at a time. Pool.imap dispatches everything up front and buffers any
+     results the caller has not consumed yet, which defeats streaming.'''
+  for batch in _Chunks(items,window):
+    for result in imap(func,batch,chunksize):
+      yield result
+
+def IterGVoiceRecords(directory,mynumbers,jobs=1,chunksize=None,ordered=True,window=None,engine='html5lib',filenames=None,stats=None,cache=None,prefetch=0,prefetchbytes=64<<20,shards=None,incremental=False,country=None,digests=None,failed=None):
+  '''Parse every HTML file in directory, or just the files named in filenames
+     if it is given, yielding each record as it is read. directory may also be
+     a Takeout .zip or .tgz, which is read without unpacking it, or a
+     gvParserLib.Source.
+     With jobs>1 the files are parsed by a pool of worker processes, handed out
+     chunksize files at a time. If ordered is False records are yielded as soon
+     as any worker finishes them. If window is given, at most that many files
+     are in flight in the pool, which bounds memory when the consumer is slow.
+     engine names the gvParserLib.ParserEngine to parse with. Parsing timings
+     are added to stats, a gvParserLib.PhaseStats, if it is given. Files
+     already in cache, a gvParserLib.ParseCache, are not parsed again.
+     With prefetch, up to that many of the next files, and about prefetchbytes
+     of them, are read on background threads while earlier ones are parsed;
+     worker processes are then handed them already read.
+     With jobs>1 and shards, a directory, each worker process writes the
+     records it parses to a database of its own there, and [contacts,deferred]
+     (see ShardWriter.take) is yielded for each file in place of its record.
+     MergeShards copies the records into the main database.
+     With incremental, long conversations are yielded as
+     gvParserLib.TextConversationStreams, read as they are iterated over, for
+     a consumer that uses each text once; see Parser.stream_texts. Records
+     parsed by a pool without shards are sent back whole.
+     country is the calling code of numbers written without one, as given by
+     gvParserLib.PhoneNumbers.for_account for the account; pass it if
+     mynumbers are already canonical. If digests, a dictionary, is given, the
+     SHA-1 of each file's contents is put in it under the file's name as the
+     file is parsed, for RecordFiles. If failed, a dictionary, is given, a
+     file that cannot be parsed is put in it under its name, with what went
+     wrong, and the rest are still parsed; otherwise the error is raised.'''
+  source = gvParserLib.Source.from_path(directory)
+  if prefetch:
+    source = gvParserLib.Prefetcher(source,prefetch,prefetchbytes,stats=stats)
+  country = gvParserLib.PhoneNumbers.for_account(mynumbers,country).country
+  if filenames is None:
+    filenames = [name for name,size,mtime in source.members()]
+
+  #Workers open a random access source for themselves. Anything else is read
+  #through once here, and the contents handed out.
+  items = filenames if source.random_access else source.iter_bytes(filenames)
+
+  pool = None
+  if jobs>1:
+    if not chunksize:
+      #Same heuristic as Pool.map: about four chunks per worker, but keep chunks
+      #small enough that progress is reported regularly
+      chunksize = max(1, min(256, len(filenames)//(jobs*4)))
+    #A stream would be pickled with the file's contents, and parsed here
+    pool = multiprocessing.Pool(jobs, _InitParseWorker, (mynumbers,country,engine,stats is not None,source.random_access and source.path,cache and cache.filename,shards,incremental and bool(shards),failed is not None))
+    imap = pool.imap if ordered else pool.imap_unordered
+    #Each worker is handed a chunk at a time as a list, to convert the numbers of
+    #its records together
+    if window:
+      chunks = _WindowedImap(imap, _ParseWorker, _Chunks(items,chunksize), 1, max(window//chunksize,2*jobs))
+    else:
+      chunks = imap(_ParseWorker, _Chunks(items,chunksize), 1)
+    parsed = itertools.chain.from_iterable(chunks)
+  else:
+    gvParserLib.Parser.stats = stats
+    gvParserLib.Parser.cache = cache
+    gvParserLib.Parser.stream_texts = incremental
+    parsed = (result+[None] for chunk in _Chunks(items,chunksize or 64)
+              for result in _ParseItems(chunk,mynumbers,engine,source,failed is not None))
 
+  try:
+    files_processed = 0
+    for name,record,digest,error,filestats in parsed:
+      if error is not None:
+        failed[name] = error
+      elif digests is not None:
+        digests[name] = digest
+      if filestats:
+        stats.merge(filestats)
       files_processed+=1
       if files_processed%100==0:
         print "Processed %d files." % (files_processed)
 
       if record:
-        records.append(record)
+        yield record
+  except:
+    #A worker failed or the consumer stopped early: files still queued on the
+    #pool are not wanted, so stop the workers rather than wait for them
+    if pool:
+      pool.terminate()
+      pool.join()
+      pool = None
+    raise
+  finally:
+    gvParserLib.Parser.stats = None
+    gvParserLib.Parser.cache = None
+    gvParserLib.Parser.stream_texts = False
+    if pool:
+      pool.close()
+      pool.join()
+    if cache:
+      cache.flush()
 
-  return records
+def ReadGVoiceRecords(directory,mynumbers,jobs=1,chunksize=None,ordered=True,engine='html5lib',filenames=None,stats=None,cache=None,prefetch=0,prefetchbytes=64<<20,country=None):
+  '''Parse every HTML file in directory into a list of records. See
+     IterGVoiceRecords for the meaning of the options.'''
+  return list(IterGVoiceRecords(directory,mynumbers,jobs,chunksize,ordered,engine=engine,filenames=filenames,stats=stats,cache=cache,prefetch=prefetch,prefetchbytes=prefetchbytes,country=country))
 
-def ReadContactsFile(filename):
-  '''Return a dictionary of names and the numbers associated with them'''
+def ReadContactsFile(filename,numbers=None):
+  '''Return a dictionary of names and the numbers associated with them. If
+     numbers, a gvParserLib.PhoneNumbers, is given, the numbers are put in its
+     canonical form, so that however they are written they match the records'.'''
   fin      = csv.DictReader(open(filename,'r'))
   contacts = [x for x in fin]
   cdict    = {}
   notedict = {}
+  if numbers:
+    for c in contacts:
+      c['Number'] = numbers.canonical(c['Number'])
 
   #Ensure that each number is unique
   non_unique = collections.Counter(x['Number'] for x in contacts)
@@ -52,70 +640,137 @@ def ReadContactsFile(filename):
 
   return [cdict,notedict]
 
-def FixContactNumbers(records,csvcontacts,mynumbers):
-  '''Go through each record and use it to build a database of names and numbers.
-     Use this database to fill in missing information for contacts.'''
-  contacts = [x.contact for x in records]
+#The records that are a conversation's texts rather than a record of their own
+TEXT_CONVERSATIONS = (gvParserLib.TextConversationList,gvParserLib.TextConversationStream)
 
-  names_to_numbers = {}
-  numbers_to_names = {}
+class ContactIndex(object):
+  '''Everything contact resolution needs to know about the records, kept up to
+     date as records are added: how often each name and number occurs, and for
+     each name the numbers seen with it (and vice versa), in the order they
+     were first seen. It is much smaller than the records themselves, so it can
+     be built while records stream past and saved between runs; only the pairs
+     counted since it was last saved are written.'''
+  def __init__(self):
+    self.number_freq      = collections.Counter()
+    self.name_freq        = collections.Counter()
+    self.pair_freq        = collections.OrderedDict() #(name,number) -> count, in first-seen order
+    self.changed          = collections.OrderedDict() #pairs counted since saving -> whether they are new
+    self.numbers_for_name = {}                        #name   -> OrderedDict of numbers
+    self.names_for_number = {}                        #number -> OrderedDict of names
+    self.ambiguities      = []                        #filled in by tables()
 
-  #Get frequency counts of numbers to resolve ambiguities
-  number_freq = collections.Counter(x.contact.phonenumber for x in records)
-  name_freq   = collections.Counter(x.contact.name for x in records)
+  def add(self,contact,count=1):
+    '''Count one sighting of a Contact'''
+    self.add_pair(contact.name,contact.phonenumber,count)
 
-  #Construct tables of names and numbers based on information found in the database
-  for i in contacts:
-    #Incomplete data. Can't use this.
-    if not (i.phonenumber and i.name):
-      continue
+  def add_pair(self,name,number,count=1):
+    self.number_freq[number] += count
+    self.name_freq[name]     += count
+    key = (name,number)
+    if key in self.pair_freq:
+      self.pair_freq[key] += count
+      self.changed.setdefault(key,False)
+      return
+    self.pair_freq[key] = count
+    self.changed[key]   = True
+    #Incomplete data. Can't use this to link names and numbers.
+    if number and name:
+      self.numbers_for_name.setdefault(name,collections.OrderedDict())[number] = None
+      self.names_for_number.setdefault(number,collections.OrderedDict())[name] = None
 
-    if i.name in names_to_numbers and i.phonenumber!=names_to_numbers[i.name]:
-      print "Ambiguity %s has number '%s' and '%s'. " % (i.name,i.phonenumber,names_to_numbers[i.name]),
-      if number_freq[i.phonenumber]>number_freq[names_to_numbers[i.name]]:
-        print "Using %s." % (i.phonenumber)
-        names_to_numbers[i.name] = i.phonenumber
-      else:
-        print "Using %s." % (names_to_numbers[i.name])
+  def add_record(self,record):
+    '''Count the contacts of a parsed record, or of each text in a conversation'''
+    if isinstance(record,TEXT_CONVERSATIONS):
+      for i in record:
+        self.add(i.contact)
     else:
-      names_to_numbers[i.name] = i.phonenumber
+      self.add(record.contact)
 
+  def _choose(self,kind,key,candidates,freq):
+    '''The most frequent candidate, the first seen winning ties. Choices
+       between several candidates are noted in self.ambiguities.'''
+    chosen = max(candidates,key=lambda x: freq[x])
+    if len(candidates)>1:
+      self.ambiguities.append({'kind':kind, 'key':key, 'chosen':chosen,
+                               'candidates':[(x,freq[x]) for x in candidates]})
+    return chosen
 
-    if i.phonenumber in numbers_to_names and i.name!=numbers_to_names[i.phonenumber]:
-      print "Ambiguity %s has names '%s' and '%s'. " % (i.phonenumber,i.name,numbers_to_names[i.phonenumber]),
-      if name_freq[i.name]>name_freq[numbers_to_names[i.phonenumber]]:
-        print "Using %s." % (i.name)
-        numbers_to_names[i.phonenumber] = i.name
-      else:
-        print "Using %s." % (numbers_to_names[i.phonenumber])
-    else:
-      numbers_to_names[i.phonenumber] = i.name
+  def tables(self,csvcontacts,mynumbers):
+    '''Build tables of names and numbers from the records, filling gaps from
+       the contacts CSV. Returns [names_to_numbers,numbers_to_names].'''
+    number_freq      = self.number_freq
+    self.ambiguities = []
+
+    #The number for each name, and the name for each number, is whichever was
+    #seen most often
+    names_to_numbers = dict((name,self._choose('name',name,list(numbers),self.number_freq))
+                            for name,numbers in self.numbers_for_name.iteritems())
+    numbers_to_names = dict((number,self._choose('number',number,list(names),self.name_freq))
+                            for number,names in self.names_for_number.iteritems())
 
-  names_to_numbers['###ME###'] = mynumbers[0]
+    names_to_numbers['###ME###'] = mynumbers[0]
 
-  #Where our contacts database has information not in the GV dataset, fill the
-  #gaps
-  if csvcontacts:
-    for c in csvcontacts:
-      #contacts is a dictionary of names and lists of numbers associated with
-      #them. Let us use the number frequency of the GV dataset to extract the
-      #most appropriate number to use if a name does not have a number
-      #associated with it
+    #Where our contacts database has information not in the GV dataset, fill the
+    #gaps
+    if csvcontacts:
+      for c in csvcontacts:
+        #contacts is a dictionary of names and lists of numbers associated with
+        #them. Let us use the number frequency of the GV dataset to extract the
+        #most appropriate number to use if a name does not have a number
+        #associated with it
 
-      #Loop through all of the numbers and add associated names to database
-      for n in csvcontacts[c]:
-        numbers_to_names[n] = c
+        #Loop through all of the numbers and add associated names to database
+        for n in csvcontacts[c]:
+          numbers_to_names[n] = c
 
-      #Loop through all names and add an associated number to the database
-      csvcontacts[c].sort(key=lambda x: number_freq[x])
-      csvcontacts[c] = csvcontacts[c][0]
+        #Loop through all names and add an associated number to the database
+        csvcontacts[c].sort(key=lambda x: number_freq[x])
+        csvcontacts[c] = csvcontacts[c][0]
 
-      #Fill the gaps
-      if not c in names_to_numbers:
-        names_to_numbers[c] = csvcontacts[c]
-      if not csvcontacts[c] in numbers_to_names:
-        numbers_to_names[c] = csvcontacts[c]
+        #Fill the gaps
+        if not c in names_to_numbers:
+          names_to_numbers[c] = csvcontacts[c]
+        if not csvcontacts[c] in numbers_to_names:
+          numbers_to_names[c] = csvcontacts[c]
 
+    return [names_to_numbers,numbers_to_names]
+
+  def report(self,filename=None):
+    '''Summarise the ambiguities found by tables(), writing each one to the
+       CSV filename if given'''
+    names   = sum(1 for x in self.ambiguities if x['kind']=='name')
+    numbers = len(self.ambiguities)-names
+    if not self.ambiguities:
+      return
+    print "%d names had several numbers and %d numbers had several names; the most frequent was used." % (names,numbers)
+    if filename:
+      fout = csv.writer(open(filename,'w'))
+      fout.writerow(['Kind','Key','Chosen','Candidates'])
+      for x in self.ambiguities:
+        fout.writerow( (x['kind'],x['key'],x['chosen'],'; '.join('%s (%d)' % c for c in x['candidates'])) )
+
+def LoadContactIndex(cur):
+  '''Read the ContactIndex saved by an earlier run'''
+  index = ContactIndex()
+  cur.execute('''SELECT name,number,count FROM contact_index ORDER BY rowid''')
+  for name,number,count in cur:
+    index.add_pair(name,number,count)
+  index.changed.clear()
+  return index
+
+def SaveContactIndex(cur,index):
+  '''Save the pairs of a ContactIndex counted since it was loaded or last
+     saved, so a later run can resolve contacts across every file loaded so far
+     and not just the ones it parses'''
+  pair_freq = index.pair_freq
+  cur.executemany('''UPDATE contact_index SET count=? WHERE name IS ? AND number IS ?''',
+                  ((pair_freq[key],)+key for key,new in index.changed.iteritems() if not new))
+  cur.executemany('''INSERT INTO contact_index (name,number,count) VALUES (?,?,?)''',
+                  (key+(pair_freq[key],) for key,new in index.changed.iteritems() if new))
+  index.changed.clear()
+
+def FillContacts(records,names_to_numbers,numbers_to_names):
+  '''Fill in missing names and numbers on records from the contact tables'''
   for i in records:
     if not i.contact.name and i.contact.phonenumber in numbers_to_names:
       i.contact.name = numbers_to_names[i.contact.phonenumber]
@@ -128,33 +783,578 @@ def FixContactNumbers(records,csvcontacts,mynumbers):
       elif not i.receiver.phonenumber and i.receiver.name in names_to_numbers:
         i.receiver.phonenumber = names_to_numbers[i.receiver.name]
 
+def FixContactNumbers(records,csvcontacts,mynumbers,index=None):
+  '''Go through each record and use it to build a database of names and numbers.
+     Use this database to fill in missing information for contacts. records may
+     be a list or a gvParserLib.RecordBatch. If the records were already added
+     to a ContactIndex as they were read, pass it as index to skip that pass.'''
+  batch = isinstance(records,gvParserLib.RecordBatch)
+  if index is None:
+    index = ContactIndex()
+    if batch:
+      for name,number in records.contacts():
+        index.add_pair(name,number)
+    else:
+      for i in records:
+        index.add(i.contact)
+
+  [names_to_numbers,numbers_to_names] = index.tables(csvcontacts,mynumbers)
+  if batch:
+    records.fill_contacts(names_to_numbers,numbers_to_names)
+  else:
+    FillContacts(records,names_to_numbers,numbers_to_names)
+
   return [records,numbers_to_names]
 
-def WriteRecordsToSQL(cur,records):
+def IterIndexRecords(records,index):
+  '''Add each record to a ContactIndex as it is read, passing it along'''
   for i in records:
-    if isinstance(i,gvParserLib.TextRecord):
-      if i.contact.name=="###ME###":
+    index.add_record(i)
+    yield i
+
+def StreamFixContactNumbers(records,index,deferred):
+  '''Add the contact of each record to a ContactIndex as it streams past. A
+     record whose database number is already known is passed straight on,
+     since resolution cannot change it. The rest are appended to deferred, a
+     list or gvParserLib.RecordBatch, until the index is complete; fill in
+     their contacts then.'''
+  for i in records:
+    index.add(i.contact)
+    if RecordNumber(i):
+      yield i
+    else:
+      deferred.append(i)
+
+def RecordNumber(record):
+  '''The number a record is filed under in the database: the other party's'''
+  if isinstance(record,gvParserLib.TextRecord) and record.contact.name=="###ME###":
+    return record.receiver.phonenumber
+  return record.contact.phonenumber
+
+#The columns of each record table, in the order RecordRow gives them
+RECORD_COLUMNS = {
+  'texts' : ['time','number','message','texttype'],
+  'audio' : ['time','number','duration','type','text','confidence','filename'],
+  'calls' : ['time','number','duration','calltype']
+}
+
+RECORD_INSERTS = dict((table,'''INSERT OR IGNORE INTO %s (%s) VALUES (%s)''' % (table,','.join(columns),','.join('?'*len(columns))))
+                      for table,columns in RECORD_COLUMNS.items())
+
+def RecordRow(i):
+  '''Returns [table,row]: the table a record is stored in and its row there,
+     or None for anything that is not stored. Times are left as datetimes,
+     which sqlite3 stores in the same form as str() gives. Durations are
+     whole seconds, as in BatchRows.'''
+  if isinstance(i,gvParserLib.TextRecord):
+    number = RecordNumber(i)
+    if i.contact.name=="###ME###":
+      texttype = 'out'
+      if not number:
+        print "No number for %s" % (i.receiver.name)
+    else:
+      texttype = 'in'
+      if not number:
+        print "No number for %s" % (i.contact.name)
+    return ['texts',(i.date,number,i.text,texttype)]
+  elif isinstance(i,gvParserLib.AudioRecord):
+    return ['audio',(i.date,i.contact.phonenumber,gvParserLib.ParseTools.to_seconds(i.duration),i.audiotype,i.text,i.confidence,i.filename)]
+  elif isinstance(i,gvParserLib.CallRecord):
+    if i.calltype=="missed":
+      duration = None
+    else:
+      duration = gvParserLib.ParseTools.to_seconds(i.duration)
+    return ['calls',(i.date,i.contact.phonenumber,duration,i.calltype)]
+  return None
+
+def BatchRows(batch):
+  '''RecordRow for each row of a gvParserLib.RecordBatch, read straight from
+     its columns without building record objects'''
+  strings = batch.pool.strings
+  me      = batch.pool.ids.get("###ME###",-1)
+  for r in xrange(len(batch)):
+    kind   = batch.kind[r]
+    number = strings[batch.number[r]]
+    if kind==batch.TEXT:
+      if batch.name[r]==me:
         texttype = 'out'
-        number   = i.receiver.phonenumber
+        number   = strings[batch.rnumber[r]]
         if not number:
-          print "No number for %s" % (i.receiver.name)
+          print "No number for %s" % (strings[batch.rname[r]])
       else:
         texttype = 'in'
-        number   = i.contact.phonenumber
         if not number:
-          print "No number for %s" % (i.contact.name)
-      record = (str(i.date),number,i.text,texttype)
-      cur.execute('INSERT INTO texts (time,number,message,texttype) VALUES (?,?,?,?)',record)
-    elif isinstance(i,gvParserLib.AudioRecord):
-      record = (str(i.date),i.contact.phonenumber,i.duration.total_seconds(),i.audiotype,i.text,i.confidence,i.filename)
-      cur.execute('''INSERT INTO audio (time, number, duration, type, text, confidence, filename) VALUES (?,?,?,?,?,?,?)''',record)
-    elif isinstance(i,gvParserLib.CallRecord):
-      if i.calltype=="missed":
+          print "No number for %s" % (strings[batch.name[r]])
+      yield ['texts',(batch.date(r),number,batch.text[r],texttype)]
+      continue
+
+    duration = batch.duration[r]
+    if duration<0:
+      duration = None
+    if kind==batch.AUDIO:
+      confidence = batch.confidence[r]
+      if confidence!=confidence: #NaN: there is none
+        confidence = None
+      yield ['audio',(batch.date(r),number,duration,strings[batch.label[r]],batch.text[r],confidence,batch.filename[r])]
+    else:
+      calltype = strings[batch.label[r]]
+      if calltype=="missed":
         duration = None
+      yield ['calls',(batch.date(r),number,duration,calltype)]
+
+class RecordSink(object):
+  '''Somewhere the rows of records are written, a batch of one table's rows at
+     a time. Rows are as RecordRow gives them.'''
+  phase = None #what the time spent writing is called in --stats
+  def write(self,table,rows):
+    raise NotImplementedError
+  def flush(self):
+    '''Make everything written so far readable, leaving the sink open'''
+    pass
+  def close(self):
+    self.flush()
+
+class SQLiteSink(RecordSink):
+  '''The record tables of the database'''
+  phase = 'db insert'
+  def __init__(self,cur):
+    self.cur = cur
+  def write(self,table,rows):
+    self.cur.executemany(RECORD_INSERTS[table],rows)
+
+class CSVSink(RecordSink):
+  '''A CSV file per record table in directory, with a header row. Each run
+     appends to the files.'''
+  phase = 'csv write'
+  def __init__(self,directory):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self.files     = {}
+    self.writers   = {}
+
+  def _writer(self,table):
+    if table not in self.writers:
+      filename           = os.path.join(self.directory,table+'.csv')
+      isnew              = not os.path.isfile(filename) or os.path.getsize(filename)==0
+      self.files[table]  = open(filename,'ab')
+      self.writers[table] = csv.writer(self.files[table])
+      if isnew:
+        self.writers[table].writerow(RECORD_COLUMNS[table])
+    return self.writers[table]
+
+  @staticmethod
+  def _field(x):
+    if x is None:
+      return ''
+    if isinstance(x,unicode):
+      return x.encode('utf-8')
+    return x
+
+  def write(self,table,rows):
+    field = self._field
+    self._writer(table).writerows([[field(x) for x in row] for row in rows])
+
+  def flush(self):
+    for f in self.files.values():
+      f.flush()
+
+  def close(self):
+    for f in self.files.values():
+      f.close()
+
+class ParquetSink(RecordSink):
+  '''Parquet files in directory, partitioned Hive-style by record table and
+     the year and month of each record, e.g. texts/year=2011/month=7/. Rows are
+     buffered per partition and written partsize at a time, each write a new
+     file, so nothing already written is touched by a later run.'''
+  phase    = 'parquet write'
+  partsize = 100000
+
+  def __init__(self,directory):
+    if pyarrow is None:
+      raise ImportError("Writing Parquet requires the pyarrow package")
+    self.directory = directory
+    self.runid     = time.strftime('%Y%m%dT%H%M%S')
+    self.buffers   = {} #(table,year,month) -> rows
+    self.parts     = 0
+    self.types     = {'time':pyarrow.timestamp('us'), 'duration':pyarrow.int64(), 'confidence':pyarrow.float64()}
+
+  def write(self,table,rows):
+    for row in rows:
+      key    = (table,row[0].year,row[0].month)
+      buffer = self.buffers.setdefault(key,[])
+      buffer.append(row)
+      if len(buffer)>=self.partsize:
+        self._flush(key)
+
+  def _flush(self,key):
+    rows = self.buffers.pop(key,None)
+    if not rows:
+      return
+    [table,year,month] = key
+    columns   = RECORD_COLUMNS[table]
+    arrays    = [pyarrow.array(list(values),type=self.types.get(name,pyarrow.string())) for name,values in zip(columns,zip(*rows))]
+    directory = os.path.join(self.directory,table,'year=%d' % year,'month=%d' % month)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.parts += 1
+    pyarrow.parquet.write_table(pyarrow.Table.from_arrays(arrays,names=columns),
+                                os.path.join(directory,'part-%s-%05d.parquet' % (self.runid,self.parts)))
+
+  def flush(self):
+    for key in list(self.buffers):
+      self._flush(key)
+
+def WriteRecords(sinks,records,batchsize=5000,stats=None,seen=None):
+  '''Write the records, a list or a gvParserLib.RecordBatch, to each of the
+     RecordSinks, grouping rows by table and handing them over batchsize at a
+     time. Time spent in each sink is added to stats, if given. Records that
+     seen, a FingerprintIndex, finds already loaded are left out.'''
+  if isinstance(records,gvParserLib.RecordBatch):
+    rows = BatchRows(records)
+  else:
+    rows = itertools.imap(RecordRow,records)
+  if seen:
+    rows = seen.FilterNew(rows,stats)
+
+  def Flush(table,batch):
+    for sink in sinks:
+      with Timing(stats,sink.phase,len(batch)):
+        sink.write(table,batch)
+
+  batches = dict((table,[]) for table in RECORD_COLUMNS)
+  for row in rows:
+    if row is None:
+      continue
+    batch = batches[row[0]]
+    batch.append(row[1])
+    if len(batch)>=batchsize:
+      Flush(row[0],batch)
+      batches[row[0]] = []
+
+  for table in batches:
+    if batches[table]:
+      Flush(table,batches[table])
+
+def WriteRecordsToSQL(cur,records,batchsize=5000,stats=None):
+  '''Insert the records, a list or a gvParserLib.RecordBatch, into the
+     database. See WriteRecords.'''
+  WriteRecords([SQLiteSink(cur)],records,batchsize,stats)
+
+class ShardSink(SQLiteSink):
+  '''The record tables of a worker's shard database'''
+  phase = 'shard insert'
+
+class ShardWriter(object):
+  '''A database of a parsing process's own, with the NewDatabase schema but no
+     indexes, that it writes the records it parses to, so that writing as well
+     as parsing is spread over the processes. The main process is only sent
+     what contact resolution needs.'''
+  def __init__(self,filename,batchsize=5000):
+    self.filename = filename
+    self.conn     = sqlite3.connect(filename)
+    self.cur      = self.conn.cursor()
+    #A scratch file, thrown away whether or not the load succeeds
+    self.cur.execute('PRAGMA journal_mode=OFF')
+    self.cur.execute('PRAGMA synchronous=OFF')
+    NewDatabase(self.cur)
+    self.sinks     = [ShardSink(self.cur)]
+    self.batchsize = batchsize
+
+  def take(self,record,stats=None):
+    '''Write each record, or each text of a conversation, whose database
+       number is already known, as StreamFixContactNumbers would pass it on.
+       Returns [contacts,deferred]: the (name,number) of each of them, in
+       order, for the ContactIndex, and those that have to wait for it.'''
+    contacts = []
+    ready    = []
+    deferred = []
+    for i in IterExplodeTextRecords([record]):
+      contacts.append((i.contact.name,i.contact.phonenumber))
+      if RecordNumber(i):
+        ready.append(i)
+      else:
+        deferred.append(i)
+    WriteRecords(self.sinks,ready,self.batchsize,stats)
+    return [contacts,deferred]
+
+  def close(self):
+    self.conn.commit()
+    self.conn.close()
+
+#How many databases SQLite can have attached at once, unless built otherwise
+MAX_ATTACHED = 10
+
+def AttachShards(cur,directory):
+  '''Attach each ShardWriter database in directory to the database, for
+     MergeShards. Those beyond MAX_ATTACHED are first copied into the others.
+     SQLite's Python module commits before an ATTACH, so this is done before
+     the load writes anything, and DetachShards after it commits. Returns
+     the names they are attached as.'''
+  shards = [os.path.join(directory,fl) for fl in sorted(os.listdir(directory)) if fl.endswith('.db')]
+  for i,extra in enumerate(shards[MAX_ATTACHED:]):
+    conn = sqlite3.connect(shards[i%MAX_ATTACHED])
+    conn.execute('ATTACH DATABASE ? AS extra',(extra,))
+    for table,columns in sorted(RECORD_COLUMNS.items()):
+      columns = ','.join(columns)
+      conn.execute('INSERT INTO %s (%s) SELECT %s FROM extra.%s' % (table,columns,columns,table))
+    conn.commit()
+    conn.close()
+  names = []
+  for i,shard in enumerate(shards[:MAX_ATTACHED]):
+    cur.execute('ATTACH DATABASE ? AS shard%d' % (i),(shard,))
+    names.append('shard%d' % (i))
+  return names
+
+def MergeShards(cur,shards):
+  '''Copy the records in each of the shards attached by AttachShards into the
+     database, in bulk. The database's natural keys skip records it already
+     has, as inserting them one at a time would.'''
+  for shard in shards:
+    for table,columns in sorted(RECORD_COLUMNS.items()):
+      columns = ','.join(columns)
+      cur.execute('INSERT OR IGNORE INTO %s (%s) SELECT %s FROM %s.%s' % (table,columns,columns,shard,table))
+
+def DetachShards(cur,shards):
+  for shard in shards:
+    cur.execute('DETACH DATABASE %s' % (shard))
+
+#The columns of each table's natural key, in the order of RECORD_KEYS
+RECORD_KEY_COLUMNS = {
+  'texts' : ['time','number','texttype','message'],
+  'calls' : ['time','number','calltype'],
+  'audio' : ['time','number','type']
+}
+
+def _KeyText(x):
+  '''A key column's value as the unicode text it is compared as'''
+  if isinstance(x,unicode):
+    return x
+  if isinstance(x,str):
+    return x.decode('utf-8')
+  return unicode(x) #datetimes are stored as str() gives them
+
+class FingerprintIndex(object):
+  '''The 64-bit hash of the natural key of every record in the database,
+     sorted, behind a Bloom filter of them, both saved in the database's
+     fingerprint_index table. Rows are checked against it a batch at a time,
+     with NumPy if it is installed: the Bloom filter turns away most new rows
+     with a few bit tests, and only the rest are looked for in the sorted
+     hashes. Records already loaded are so skipped without a query per row.
+     Two keys sharing a hash would lose the second record; across ten million
+     records the odds of that are about one in three hundred thousand.
+     The hashes added by each run are saved as a sorted run of their own in
+     fingerprint_runs, which are merged into the rest only once there are
+     maxruns of them or they hold a third of the hashes.'''
+  nhashes         = 7  #bits set per record
+  bits_per_record = 10 #about a 1% false positive rate when full
+  maxruns         = 16
+  _hash           = struct.Struct('<q')
+
+  def __init__(self,fingerprints,bits=None):
+    self.fingerprints = fingerprints #sorted array of the database's hashes
+    self.fresh        = set()        #hashes of the rows let through since loading
+    self.skipped      = 0            #rows left out as already loaded
+    self.records      = 0            #records in the database when loaded or last saved
+    self.since        = None         #and their LastRowids
+    self.runs         = []           #the length of each of the runs saved apart from the rest
+    self.stored       = False        #whether the rest are saved
+    self.positions    = dict((table,[RECORD_COLUMNS[table].index(column) for column in columns])
+                             for table,columns in RECORD_KEY_COLUMNS.items())
+    if bits is None:
+      self._Size(2*len(fingerprints))
+      self._Add(fingerprints)
+    else:
+      self.bits = bits
+      self.mask = len(bits)*8-1
+
+  @staticmethod
+  def RecordCount(cur):
+    return sum(cur.execute('SELECT COUNT(*) FROM %s' % (table)).fetchone()[0] for table in RECORD_COLUMNS)
+
+  @classmethod
+  def Load(cls,cur):
+    '''The index saved in the database, or a new one built from its records if
+       there is none or the records have changed some other way since'''
+    records = cls.RecordCount(cur)
+    row     = cur.execute('SELECT records,hashes,bloom,fingerprints FROM fingerprint_index WHERE id=0').fetchone()
+    if row and row[0]==records and row[1]==cls.nhashes:
+      runs = []
+      for data in [row[3]]+[run for (run,) in cur.execute('SELECT fingerprints FROM fingerprint_runs ORDER BY id')]:
+        run = array.array(gvParserLib._INT64)
+        run.fromstring(bytes(data))
+        runs.append(run)
+      fingerprints = runs[0]
+      for run in runs[1:]:
+        fingerprints = cls._Merge(fingerprints,run)
+      index        = cls(fingerprints,bytearray(row[2]))
+      index.runs   = [len(run) for run in runs[1:]]
+      index.stored = True
+    else:
+      cur.execute('DELETE FROM fingerprint_runs')
+      if records:
+        print "Building the fingerprint index of %d records." % (records)
+      fingerprints = []
+      for table,columns in RECORD_KEY_COLUMNS.items():
+        for key in cur.execute('SELECT %s FROM %s' % (','.join(columns),table)):
+          fingerprint = cls.Fingerprint(table,key)
+          if fingerprint is not None:
+            fingerprints.append(fingerprint)
+      index = cls(array.array(gvParserLib._INT64,sorted(set(fingerprints))))
+    index.records = records
+    index.since   = LastRowids(cur)
+    return index
+
+  def Save(self,cur):
+    '''Add the rows let through to the index and store it for the next run: the
+       Bloom filter, and the new hashes as a run of their own'''
+    fresh             = sorted(self.fresh)
+    self.fingerprints = self._Merge(self.fingerprints,fresh)
+    if len(self.fingerprints)*self.bits_per_record>len(self.bits)*8:
+      self._Size(2*len(self.fingerprints))
+      self._Add(self.fingerprints)
+    else:
+      self._Add(fresh)
+    self.fresh = set()
+
+    #Only rows added since loading need counting
+    self.records += sum(cur.execute('SELECT COUNT(*) FROM %s WHERE rowid>?' % (table),(self.since[table],)).fetchone()[0]
+                        for table in RECORD_COLUMNS)
+    self.since    = LastRowids(cur)
+    if not self.stored or len(self.runs)>=self.maxruns or 3*(sum(self.runs)+len(fresh))>=len(self.fingerprints):
+      cur.execute('DELETE FROM fingerprint_runs')
+      cur.execute('INSERT OR REPLACE INTO fingerprint_index (id,records,hashes,bloom,fingerprints) VALUES (0,?,?,?,?)',
+                  (self.records,self.nhashes,sqlite3.Binary(bytes(self.bits)),sqlite3.Binary(self.fingerprints.tostring())))
+      self.runs   = []
+      self.stored = True
+      return
+    if fresh:
+      cur.execute('INSERT INTO fingerprint_runs (fingerprints) VALUES (?)',
+                  (sqlite3.Binary(array.array(gvParserLib._INT64,fresh).tostring()),))
+      self.runs.append(len(fresh))
+      cur.execute('UPDATE fingerprint_index SET records=?,bloom=? WHERE id=0',(self.records,sqlite3.Binary(bytes(self.bits))))
+    else:
+      cur.execute('UPDATE fingerprint_index SET records=? WHERE id=0',(self.records,))
+
+  @staticmethod
+  def _Merge(fingerprints,fresh):
+    '''The sorted array of the hashes in two sorted sequences'''
+    if not len(fresh):
+      return fingerprints
+    if numpy is None:
+      return array.array(gvParserLib._INT64,heapq.merge(fingerprints,fresh))
+    index  = numpy.frombuffer(fingerprints,dtype=numpy.int64) if len(fingerprints) else numpy.zeros(0,numpy.int64)
+    fresh  = numpy.asarray(fresh,dtype=numpy.int64)
+    merged = array.array(gvParserLib._INT64)
+    merged.fromstring(numpy.insert(index,numpy.searchsorted(index,fresh),fresh).tostring())
+    return merged
+
+  @classmethod
+  def Fingerprint(cls,table,key):
+    '''The signed 64-bit hash of a natural key, the values of its columns in
+       RECORD_KEY_COLUMNS order, or None if it holds a NULL other than the
+       number, since SQLite never takes such a row for a duplicate'''
+    if None in key:
+      if any(x is None for i,x in enumerate(key) if i!=1):
+        return None
+      key = [x if x is not None else '' for x in key]
+    text = u'\x00'.join([table]+map(_KeyText,key)).encode('utf-8')
+    return cls._hash.unpack_from(hashlib.md5(text).digest())[0]
+
+  def _Size(self,records):
+    nbits = 1<<16
+    while nbits<records*self.bits_per_record:
+      nbits <<= 1
+    self.bits = bytearray(nbits>>3)
+    self.mask = nbits-1
+
+  def _Positions(self,fingerprints):
+    '''The bits of each of a NumPy array of hashes, one array per hash function'''
+    f  = fingerprints.view(numpy.uint64)
+    h1 = f & numpy.uint64(0xffffffff)
+    h2 = (f>>numpy.uint64(32)) | numpy.uint64(1)
+    return [(h1+numpy.uint64(i)*h2) & numpy.uint64(self.mask) for i in xrange(self.nhashes)]
+
+  def _Add(self,fingerprints):
+    '''Set the Bloom filter's bits for each of the hashes'''
+    if not len(fingerprints):
+      return
+    if numpy is not None:
+      bits = numpy.frombuffer(self.bits,dtype=numpy.uint8)
+      for p in self._Positions(numpy.asarray(fingerprints,dtype=numpy.int64)):
+        numpy.bitwise_or.at(bits,(p>>numpy.uint64(3)).astype(numpy.intp),numpy.left_shift(1,p&numpy.uint64(7)).astype(numpy.uint8))
+      return
+    bits = self.bits
+    for fingerprint in fingerprints:
+      fingerprint &= 0xffffffffffffffff
+      h1 = fingerprint & 0xffffffff
+      h2 = (fingerprint>>32) | 1
+      for i in xrange(self.nhashes):
+        p = (h1+i*h2) & self.mask
+        bits[p>>3] |= 1<<(p&7)
+
+  def Contains(self,fingerprints):
+    '''Whether each of a list of hashes is in the index, as a list of bools'''
+    if numpy is not None:
+      f     = numpy.array(fingerprints,dtype=numpy.int64)
+      bits  = numpy.frombuffer(self.bits,dtype=numpy.uint8)
+      maybe = numpy.ones(len(f),dtype=bool)
+      for p in self._Positions(f):
+        maybe &= ((bits[(p>>numpy.uint64(3)).astype(numpy.intp)]>>(p&numpy.uint64(7)).astype(numpy.uint8)) & 1).astype(bool)
+      found = numpy.zeros(len(f),dtype=bool)
+      index = numpy.frombuffer(self.fingerprints,dtype=numpy.int64) if len(self.fingerprints) else numpy.zeros(0,numpy.int64)
+      if maybe.any() and len(index):
+        candidates = f[maybe]
+        at         = numpy.minimum(numpy.searchsorted(index,candidates),len(index)-1)
+        found[maybe] = index[at]==candidates
+      return found.tolist()
+
+    found = []
+    bits  = self.bits
+    index = self.fingerprints
+    for fingerprint in fingerprints:
+      h1 = fingerprint & 0xffffffff
+      h2 = ((fingerprint & 0xffffffffffffffff)>>32) | 1
+      for i in xrange(self.nhashes):
+        p = (h1+i*h2) & self.mask
+        if not bits[p>>3] & (1<<(p&7)):
+          found.append(False)
+          break
       else:
-        duration = i.duration.total_seconds()
-      record = (str(i.date),i.contact.phonenumber,duration,i.calltype)
-      cur.execute('''INSERT INTO calls (time, number, duration, calltype) VALUES (?,?,?,?)''',record)
+        at = bisect.bisect_left(index,fingerprint)
+        found.append(at<len(index) and index[at]==fingerprint)
+    return found
+
+  def _Screen(self,rows):
+    '''The rows, from RecordRow, that are neither in the index nor repeat an
+       earlier row'''
+    fingerprints = [self.Fingerprint(table,[row[i] for i in self.positions[table]]) for table,row in rows]
+    found        = self.Contains([x or 0 for x in fingerprints])
+    kept         = []
+    for row,fingerprint,loaded in itertools.izip(rows,fingerprints,found):
+      if fingerprint is not None:
+        if loaded or fingerprint in self.fresh:
+          self.skipped += 1
+          continue
+        self.fresh.add(fingerprint)
+      kept.append(row)
+    return kept
+
+  def FilterNew(self,rows,stats=None,batchsize=5000):
+    '''The rows from RecordRow, without those already loaded'''
+    batch = []
+    for row in itertools.chain(rows,[None]):
+      if row is not None:
+        batch.append(row)
+        if len(batch)<batchsize:
+          continue
+      if batch:
+        with Timing(stats,'fingerprint check',len(batch)):
+          kept = self._Screen(batch)
+        for i in kept:
+          yield i
+        batch = []
 
 def WriteContactRecords(filename,numbers_to_names,number_notes):
   contact_records = [(numbers_to_names[x],x) for x in numbers_to_names]
@@ -168,8 +1368,8 @@ def WriteContactRecords(filename,numbers_to_names,number_notes):
 
 def ExplodeTextRecords(records):
   #Separate text conversations from non-text conversations
-  texts     = filter(lambda x: isinstance(x,gvParserLib.TextConversationList),records)
-  non_texts = filter(lambda x: not isinstance(x,gvParserLib.TextConversationList),records)
+  texts     = filter(lambda x: isinstance(x,TEXT_CONVERSATIONS),records)
+  non_texts = filter(lambda x: not isinstance(x,TEXT_CONVERSATIONS),records)
 
   #Explode text conversations into their constituent objects
   texts   = [i for x in texts for i in x]
@@ -177,82 +1377,617 @@ def ExplodeTextRecords(records):
 
   return records
 
+def IterExplodeTextRecords(records):
+  '''Streaming ExplodeTextRecords: yield text conversations as their
+     constituent messages, in the order the records arrive'''
+  for x in records:
+    if isinstance(x,TEXT_CONVERSATIONS):
+      for i in x:
+        yield i
+    else:
+      yield x
+
 def ContactsToDB(cur,numbers_to_names,number_notes):
   numbers_to_names = [(numbers_to_names[x],x) for x in numbers_to_names]
   numbers_to_names = list(set(numbers_to_names))
   numbers_to_names.sort()
+
+  cur.execute('''SELECT number,name FROM contacts''')
+  loaded = dict(cur.fetchall())
+
+  rows = []
   for i in numbers_to_names:
-    note = number_notes.get(i[1],"")
+    if i[1] in loaded:
+      #Already loaded by an earlier run; only a change of name is news
+      if loaded[i[1]]!=i[0]:
+        print i
+        print "Number is already a contact named '%s'" % (loaded[i[1]])
+      continue
     #Ensure all records have notes, even if there are no notes
-    try:
-      cur.execute('''INSERT INTO contacts (name,number,notes) VALUES (?,?,?)''', (i[0],i[1],note) )
-    except sqlite3.IntegrityError as e:
-      print i
-      print e
+    note = number_notes.get(i[1],"")
+    rows.append( (i[0],i[1],note) )
+  cur.executemany('''INSERT INTO contacts (name,number,notes) VALUES (?,?,?)''', rows)
   print "Contacts loaded."
 
 
-parser = argparse.ArgumentParser(description='Load Google Voice data into a database.')
-parser.add_argument('--contacts', '-c', action='store', default=None, help='File to load contacts from.')
-parser.add_argument('path',     help='Directory containing Google Voice files or Contacts file.')
-parser.add_argument('database', help='Name of database to create or append to.')
-parser.add_argument('--contactcsv','-f',action='store',default='contacts.csv',help="File to write discovered contacts to.")
-parser.add_argument('--clear',  help='Clear database prior to inserting new Google Voice records.', action='store_const', const=True, default=False)
-parser.add_argument('--mynumbers', '-m', action='store',default='',help="Comma-delimited list of this account's phone numbers")
-args = parser.parse_args()
+def Load(args,stats=None):
+  '''Load the Google Voice files named by the parsed command line args'''
+  #Every number is put in the canonical form for the account's country
+  numbers   = gvParserLib.PhoneNumbers.for_account(args.mynumbers.split(','))
+  mynumbers = numbers.mynumbers
+
+  if args.jobs<1:
+    args.jobs = multiprocessing.cpu_count()
+
+  if os.path.isfile(args.contactcsv):
+    print "File '%s' already exists. Will not overwrite. Quitting" % (args.contactcsv)
+    sys.exit(-1)
+
+  #Shards are only written by parsing processes
+  sharded = args.shards and args.jobs>1
+  if sharded and (args.csv or args.parquet):
+    print "--shards writes records straight to the database, so cannot be used with --csv or --parquet."
+    sys.exit(-1)
+  if args.fingerprints and sharded:
+    print "--fingerprints checks records as they are written by this process, so cannot be used with --shards."
+    sys.exit(-1)
+
+  number_notes = {}
+  if args.contacts:
+    [args.contacts, number_notes] = ReadContactsFile(args.contacts,numbers)
+
+  [conn,cur] = OpenDatabase(args.database,args.clear)
+  TuneDatabase(cur,args.journalmode,args.synchronous)
+  CanonicalNumbers(cur,numbers)
+  if args.rebuildstats and HasContactStats(cur):
+    with Timing(stats,'contact stats'):
+      RebuildContactStats(cur)
+  elif args.contactstats or args.rebuildstats:
+    with Timing(stats,'contact stats'):
+      CreateContactStats(cur) #kept up to date by its triggers from here on
+  #The load itself is one transaction from here on, so that one that stops part
+  #way changes nothing. SQLite's Python module commits before any statement
+  #that changes the schema, so those are done before it or after.
+  conn.commit()
+
+  #Only files that are new since the last run, or have changed, are parsed
+  #The Takeout may be unpacked or still in its archive
+  source = gvParserLib.Source.from_path(args.path)
+  if args.prefetch:
+    #Read files ahead for the manifest check and the parser alike
+    source = gvParserLib.Prefetcher(source,args.prefetch,args.prefetchmb<<20,stats=stats)
+
+  with Timing(stats,'manifest check'):
+    [filenames,files] = ChangedGVoiceFiles(cur,source)
+  if not filenames:
+    print "Nothing new to load."
+    RecordFiles(cur,source,files,{})
+    conn.commit()
+    return
+
+  if args.deferindexes:
+    DropRecordKeys(cur)
+    conn.commit()
+
+  def NoRecords():
+    '''Record the files read, which hold no records, and quit'''
+    print "Found no new Google voice records!"
+    RecordFiles(cur,source,files,digests)
+    conn.commit()
+    if args.deferindexes:
+      CreateRecordKeys(cur)
+      conn.commit()
+    sys.exit(-1)
+
+  #Contacts are resolved across every file loaded so far, not just this run's
+  index = LoadContactIndex(cur)
+
+  #Where this run's records and contacts start, so only they need linking
+  since = LastRowids(cur)
+
+  #The manifest's hashes of the files parsed, from the contents the parser reads
+  digests = {}
+
+  #Everywhere the records are written
+  sinks = [SQLiteSink(cur)]
+  if args.csv:
+    sinks.append(CSVSink(args.csv))
+  if args.parquet:
+    sinks.append(ParquetSink(args.parquet))
+
+  #Records the database already has are not written anywhere
+  seen = None
+  if args.fingerprints:
+    with Timing(stats,'fingerprint load'):
+      seen = FingerprintIndex.Load(cur)
+
+  cache = None
+  if args.cache:
+    cache = gvParserLib.ParseCache(args.cache,args.cachesize<<20)
+
+  if sharded:
+    #Each parsing process writes the records it can to its own database, which
+    #are merged into this one once parsing is done. As with --stream, only the
+    #contact index and the records waiting on it come back here.
+    shardir  = tempfile.mkdtemp(prefix='gvshards',dir=os.path.dirname(os.path.abspath(args.database)))
+    shards   = []
+    deferred = gvParserLib.RecordBatch()
+    try:
+      nfiles = 0
+      for [contacts,waiting] in IterGVoiceRecords(source,mynumbers,args.jobs,args.chunksize,not args.unordered,window=1000,engine=args.engine,filenames=filenames,stats=stats,cache=cache,shards=shardir,incremental=True,country=numbers.country,digests=digests):
+        for name,number in contacts:
+          index.add_pair(name,number)
+        deferred.extend(waiting)
+        nfiles+=1
+      if nfiles==0:
+        NoRecords()
+
+      with Timing(stats,'shard merge'):
+        shards = AttachShards(cur,shardir)
+        MergeShards(cur,shards)
+      print "Merged %d shards." % (len(shards))
+    finally:
+      #Attached shards stay readable until they are detached
+      shutil.rmtree(shardir)
+
+    with Timing(stats,'contact resolution'):
+      [names_to_numbers,numbers_to_names] = index.tables(args.contacts,mynumbers)
+      deferred.fill_contacts(names_to_numbers,numbers_to_names)
+    WriteRecords(sinks,deferred,args.batchsize,stats,seen)
+  elif args.stream:
+    #Records flow from the parser straight to the database. Only the contact
+    #index, and the few records waiting on it, are kept until the end.
+    records = IterGVoiceRecords(source,mynumbers,args.jobs,args.chunksize,not args.unordered,window=1000,engine=args.engine,filenames=filenames,stats=stats,cache=cache,incremental=True,country=numbers.country,digests=digests)
+    first   = next(records,None)
+    if first is None:
+      NoRecords()
+    records = IterExplodeTextRecords(itertools.chain([first],records))
+
+    deferred = gvParserLib.RecordBatch()
+    WriteRecords(sinks,StreamFixContactNumbers(records,index,deferred),args.batchsize,stats,seen)
+
+    with Timing(stats,'contact resolution'):
+      [names_to_numbers,numbers_to_names] = index.tables(args.contacts,mynumbers)
+      deferred.fill_contacts(names_to_numbers,numbers_to_names)
+    WriteRecords(sinks,deferred,args.batchsize,stats,seen)
+  else:
+    records = IterGVoiceRecords(source,mynumbers,args.jobs,args.chunksize,not args.unordered,engine=args.engine,filenames=filenames,stats=stats,cache=cache,country=numbers.country,digests=digests)
+    #Held as columns rather than objects, with conversations exploded into
+    #their messages as they arrive
+    batch    = gvParserLib.RecordBatch()
+    nrecords = 0
+    for record in IterIndexRecords(records,index):
+      batch.append(record)
+      nrecords+=1
+    if nrecords==0:
+      NoRecords()
+    else:
+      print "Read %d records." % (nrecords)
+
+    with Timing(stats,'contact resolution'):
+      [records,numbers_to_names] = FixContactNumbers(batch,args.contacts,mynumbers,index)
+
+    WriteRecords(sinks,records,args.batchsize,stats,seen)
+
+  for sink in sinks:
+    with Timing(stats,sink.phase,0):
+      sink.close()
+
+  index.report(args.ambiguities)
+  SaveContactIndex(cur,index)
+
+  WriteContactRecords(args.contactcsv,numbers_to_names,number_notes)
+
+  with Timing(stats,'contacts to db'):
+    ContactsToDB(cur,numbers_to_names,number_notes)
+
+  with Timing(stats,'link contacts'):
+    LinkContacts(cur,since)
+
+  if seen:
+    print "Skipped %d records already loaded." % (seen.skipped)
+    with Timing(stats,'fingerprint save'):
+      seen.Save(cur)
+
+  #Last, so that the files are only known to be loaded once all of the above is
+  RecordFiles(cur,source,files,digests)
+
+  """
+  else:
+    if not os.path.isfile(args.database):
+      print "Database does not exist!"
+      sys.exit(-1)
+
+    conn = sqlite3.connect(args.database)
+    cur  = conn.cursor()
+
+    cur.execute('DELETE FROM contacts;')
+    ContactsToDB(cur,args.path)
+    conn.commit()
+  """
 
-mynumbers = args.mynumbers.split(',')
+  with Timing(stats,'commit'):
+    conn.commit()
+  if sharded:
+    DetachShards(cur,shards)
 
-if os.path.isfile(args.contactcsv):
-  print "File '%s' already exists. Will not overwrite. Quitting" % (args.contactcsv)
-  sys.exit(-1)
+  if args.deferindexes:
+    print "Building indexes."
+    with Timing(stats,'index build'):
+      CreateRecordKeys(cur)
+      conn.commit()
 
-number_notes = {}
-if args.contacts:
-  [args.contacts, number_notes] = ReadContactsFile(args.contacts)
+  if args.fulltext:
+    with Timing(stats,'full-text index'):
+      CreateTextSearch(cur)
+      conn.commit()
 
-records = ReadGVoiceRecords(args.path,mynumbers)
-if len(records)==0:
-  print "Found no Google voice records!"
-  sys.exit(-1)
-else:
-  print "Read %d records." % (len(records))
+  if cache:
+    evicted = cache.evict()
+    if evicted:
+      print "Evicted %d records from the parse cache." % (evicted)
+    cache.close()
 
-records = ExplodeTextRecords(records)
+class PollingWatch(object):
+  '''The files written to a directory, found by listing it every interval
+     seconds. A file is reported once two listings in a row agree on its size
+     and modification time, so one still being copied in is not read half
+     written.'''
+  kind = 'polling'
 
-[records,numbers_to_names] = FixContactNumbers(records,args.contacts,mynumbers)
+  def __init__(self,source,interval):
+    self.source   = source
+    self.interval = interval
+    self.listed   = dict((name,(size,mtime)) for name,size,mtime in source.members())
+    self.settling = {}
 
-db_existed = os.path.isfile(args.database)
+  def wait(self,timeout=None):
+    '''Names of the files written since the last call, waiting up to timeout
+       seconds, or one interval if that is sooner'''
+    time.sleep(self.interval if timeout is None else min(timeout,self.interval))
+    ready    = []
+    settling = {}
+    for name,size,mtime in self.source.members():
+      if self.listed.get(name)==(size,mtime):
+        continue
+      if self.settling.get(name)==(size,mtime):
+        self.listed[name] = (size,mtime)
+        ready.append(name)
+      else:
+        settling[name] = (size,mtime)
+    self.settling = settling
+    return ready
+
+class InotifyWatch(object):
+  '''The files closed after writing in, or moved into, a directory, as Linux's
+     inotify reports them. Raises OSError or AttributeError where there is no
+     inotify.'''
+  kind           = 'inotify'
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_TO    = 0x00000080
+  IN_Q_OVERFLOW  = 0x00004000
+  _event         = struct.Struct('iIII') #wd, mask, cookie, len; then the name
+
+  def __init__(self,source):
+    self.source = source
+    libc        = ctypes.CDLL(None,use_errno=True)
+    self.fd     = libc.inotify_init()
+    if self.fd<0:
+      raise OSError(ctypes.get_errno(),'inotify_init failed')
+    if libc.inotify_add_watch(self.fd,source.path,self.IN_CLOSE_WRITE|self.IN_MOVED_TO)<0:
+      os.close(self.fd)
+      raise OSError(ctypes.get_errno(),'inotify_add_watch failed')
+
+  def wait(self,timeout=None):
+    '''Names of the files written since the last call, waiting up to timeout
+       seconds, or until there are some if it is None'''
+    try:
+      if not select.select([self.fd],[],[],timeout)[0]:
+        return []
+    except select.error: #interrupted by a signal
+      return []
+    data   = os.read(self.fd,1<<16)
+    names  = []
+    offset = 0
+    while offset<len(data):
+      [wd,mask,cookie,length] = self._event.unpack_from(data,offset)
+      offset += self._event.size
+      name    = data[offset:offset+length].rstrip('\0')
+      offset += length
+      if mask & self.IN_Q_OVERFLOW:
+        #Events were lost. The manifest check sorts out which files are new.
+        return [name for name,size,mtime in self.source.members()]
+      if name.endswith('.html'):
+        names.append(os.path.join(self.source.path,name))
+    return names
+
+  def close(self):
+    os.close(self.fd)
+
+def WatchDirectory(source,interval):
+  '''An InotifyWatch of a gvParserLib.DirectorySource if this system has
+     inotify, or a PollingWatch listing it every interval seconds'''
+  try:
+    return InotifyWatch(source)
+  except (OSError,AttributeError):
+    return PollingWatch(source,interval)
+
+class Watcher(object):
+  '''A load that stays running, keeping the database connection, contact
+     index, contacts CSV, fingerprint index and parser between batches, and
+     loading the files written to the directory as they appear. Files are
+     gathered into batches of up to batchfiles, and a batch is loaded once it
+     is full or its first file has waited latency seconds. A file that cannot
+     be parsed is reported and put in the file manifest, as if it had been
+     loaded, so that it is only tried again once it changes.'''
+  def __init__(self,args,stats=None):
+    self.args       = args
+    self.stats      = stats
+    self.numbers    = gvParserLib.PhoneNumbers.for_account(args.mynumbers.split(','))
+    self.mynumbers  = self.numbers.mynumbers
+    self.latency    = args.latency
+    self.batchfiles = args.watchbatch
+    self.contacts   = None
+    self.notes      = {}
+    if args.contacts:
+      [self.contacts,self.notes] = ReadContactsFile(args.contacts,self.numbers)
+
+    [self.conn,self.cur] = OpenDatabase(args.database,args.clear)
+    TuneDatabase(self.cur,args.journalmode,args.synchronous)
+    CanonicalNumbers(self.cur,self.numbers)
+    if args.rebuildstats and HasContactStats(self.cur):
+      RebuildContactStats(self.cur)
+    elif args.contactstats or args.rebuildstats:
+      CreateContactStats(self.cur)
+    if args.fulltext:
+      CreateTextSearch(self.cur) #kept up to date by its triggers from here on
+
+    self.source = gvParserLib.Source.from_path(args.path)
+    self.index  = LoadContactIndex(self.cur)
+    self.sinks  = [SQLiteSink(self.cur)]
+    if args.csv:
+      self.sinks.append(CSVSink(args.csv))
+    if args.parquet:
+      self.sinks.append(ParquetSink(args.parquet))
+    self.seen = None
+    if args.fingerprints:
+      with Timing(stats,'fingerprint load'):
+        self.seen = FingerprintIndex.Load(self.cur)
+    self.cache = None
+    if args.cache:
+      self.cache = gvParserLib.ParseCache(args.cache,args.cachesize<<20)
+
+    self.started  = time.time()
+    self.pending  = collections.OrderedDict() #name -> when it was seen
+    self.files    = 0 #files loaded, and records read from them
+    self.records  = 0
+    self.failed   = 0 #files that could not be parsed
+    self.batches  = 0
+    self.last     = {}
+    self.stopping = False
+
+  def _stop(self,signum,frame):
+    self.stopping = True
+
+  def load(self,members=None):
+    '''Load those of members, a list of (name,size,mtime), or of every file in
+       the directory if it is None, that are new or have changed, and commit.
+       Returns [files,records] read.'''
+    stats = self.stats
+    with Timing(stats,'manifest check'):
+      [filenames,files] = ChangedGVoiceFiles(self.cur,self.source,members)
+    if not filenames:
+      RecordFiles(self.cur,self.source,files,{})
+      self.conn.commit()
+      return [0,0]
 
-conn = sqlite3.connect(args.database)
-cur = conn.cursor()
+    since   = LastRowids(self.cur)
+    digests = {}
+    failed  = {}
+    records = IterGVoiceRecords(self.source,self.mynumbers,engine=self.args.engine,filenames=filenames,stats=stats,cache=self.cache,country=self.numbers.country,digests=digests,failed=failed)
+    batch   = gvParserLib.RecordBatch()
+    for record in IterIndexRecords(records,self.index):
+      batch.append(record)
+    for name,error in sorted(failed.items()):
+      print "Could not parse '%s', which is skipped until it changes. %s" % (name,error)
+    self.failed += len(failed)
 
-if not db_existed:
-  NewDatabase(cur)
+    with Timing(stats,'contact resolution'):
+      [records,numbers_to_names] = FixContactNumbers(batch,self.csvcontacts(),self.mynumbers,self.index)
+    WriteRecords(self.sinks,records,self.args.batchsize,stats,self.seen)
+    for sink in self.sinks:
+      with Timing(stats,sink.phase,0):
+        sink.flush()
 
-if args.clear:
-  cur.execute('DELETE FROM texts;')
-  cur.execute('DELETE FROM audio;')
-  cur.execute('DELETE FROM calls;')
+    SaveContactIndex(self.cur,self.index)
+    with Timing(stats,'contacts to db'):
+      ContactsToDB(self.cur,numbers_to_names,self.notes)
+    with Timing(stats,'link contacts'):
+      LinkContacts(self.cur,since)
+    RecordFiles(self.cur,self.source,files,digests)
+    with Timing(stats,'commit'):
+      self.conn.commit()
+    return [len(filenames),len(batch)]
 
-WriteRecordsToSQL(cur,records)
+  def csvcontacts(self):
+    '''A copy of the contacts CSV for ContactIndex.tables, which changes it'''
+    if not self.contacts:
+      return self.contacts
+    return dict((name,list(numbers)) for name,numbers in self.contacts.iteritems())
 
-WriteContactRecords(args.contactcsv,numbers_to_names,number_notes)
+  def load_pending(self):
+    '''Load the batchfiles files that have waited longest'''
+    start   = time.time()
+    names   = list(itertools.islice(self.pending,self.batchfiles))
+    waited  = start-self.pending[names[0]]
+    members = []
+    for name in names:
+      del self.pending[name]
+      try:
+        members.append((name,)+gvParserLib.DirectorySource._size_mtime(os.stat(name)))
+      except OSError: #gone again already
+        pass
+    [files,records] = self.load(members)
+    self.count(files,records,start,waited)
 
-ContactsToDB(cur,numbers_to_names,number_notes)
+  def count(self,files,records,start,waited=0):
+    '''Add a loaded batch to the counters, and report them'''
+    now           = time.time()
+    self.files   += files
+    self.records += records
+    self.batches += 1
+    elapsed       = max(now-self.started,1e-9)
+    self.last     = {'files':files, 'records':records, 'seconds':now-start, 'latency':now-start+waited}
+    if files:
+      print "Loaded %d files, %d records in %.2fs; %d files waiting. %.1f files/s, %.1f records/s since starting." % (
+        files,records,now-start,len(self.pending),self.files/elapsed,self.records/elapsed)
+    if self.args.status:
+      #Replaced whole, so a reader never sees it half written
+      with open(self.args.status+'.tmp','w') as f:
+        json.dump(self.counters(),f,indent=2)
+      os.rename(self.args.status+'.tmp',self.args.status)
 
-"""
-else:
-  if not os.path.isfile(args.database):
-    print "Database does not exist!"
+  def counters(self):
+    '''Throughput and backlog, as plain data ready for json.dump'''
+    elapsed = max(time.time()-self.started,1e-9)
+    oldest  = time.time()-next(self.pending.itervalues()) if self.pending else 0
+    return {'files'              : self.files,
+            'records'            : self.records,
+            'batches'            : self.batches,
+            'seconds'            : elapsed,
+            'files_per_second'   : self.files/elapsed,
+            'records_per_second' : self.records/elapsed,
+            'failed_files'       : self.failed,
+            'backlog_files'      : len(self.pending),
+            'backlog_seconds'    : oldest,
+            'last_batch'         : self.last}
+
+  def run(self):
+    '''Load whatever in the directory is new, then each file written to it,
+       until SIGINT or SIGTERM'''
+    for signum in (signal.SIGINT,signal.SIGTERM):
+      signal.signal(signum,self._stop)
+
+    #Watch first, so nothing written during the first load is missed
+    watch = WatchDirectory(self.source,self.latency/2.)
+    start = time.time()
+    [files,records] = self.load()
+    self.count(files,records,start)
+    print "Watching '%s' for new files (%s)." % (self.source.path,watch.kind)
+
+    while not self.stopping:
+      timeout = None
+      if self.pending:
+        timeout = max(0,self.latency-(time.time()-next(self.pending.itervalues())))
+      for name in watch.wait(timeout):
+        if name not in self.pending:
+          self.pending[name] = time.time()
+      if self.stopping:
+        break
+      if self.pending and (len(self.pending)>=self.batchfiles or time.time()-next(self.pending.itervalues())>=self.latency):
+        self.load_pending()
+
+    #Anything seen but not yet loaded is loaded now
+    while self.pending:
+      self.load_pending()
+    if watch.kind=='inotify':
+      watch.close()
+    self.close()
+
+  def close(self):
+    '''Finish as a load does: save the fingerprint index and write the
+       contacts and ambiguities CSVs'''
+    for sink in self.sinks:
+      with Timing(self.stats,sink.phase,0):
+        sink.close()
+    [names_to_numbers,numbers_to_names] = self.index.tables(self.csvcontacts(),self.mynumbers)
+    self.index.report(self.args.ambiguities)
+    WriteContactRecords(self.args.contactcsv,numbers_to_names,self.notes)
+    if self.seen:
+      print "Skipped %d records already loaded." % (self.seen.skipped)
+      with Timing(self.stats,'fingerprint save'):
+        self.seen.Save(self.cur)
+    with Timing(self.stats,'commit'):
+      self.conn.commit()
+    if self.cache:
+      self.cache.evict()
+      self.cache.close()
+    print "Loaded %d files, %d records in %d batches." % (self.files,self.records,self.batches)
+
+def Watch(args,stats=None):
+  '''Load the Google Voice files in the directory named by the parsed command
+     line args, and keep loading those written to it until interrupted'''
+  if os.path.isfile(args.contactcsv):
+    print "File '%s' already exists. Will not overwrite. Quitting" % (args.contactcsv)
     sys.exit(-1)
+  if not os.path.isdir(args.path):
+    print "--watch needs a directory to watch."
+    sys.exit(-1)
+  if args.shards or args.deferindexes:
+    print "--watch loads a batch at a time into the database, so cannot be used with --shards or --deferindexes."
+    sys.exit(-1)
+  Watcher(args,stats).run()
 
-  conn = sqlite3.connect(args.database)
-  cur  = conn.cursor()
+def main():
+  parser = argparse.ArgumentParser(description='Load Google Voice data into a database.')
+  parser.add_argument('--contacts', '-c', action='store', default=None, help='File to load contacts from.')
+  parser.add_argument('path',     help='Directory containing Google Voice files, or the Takeout .zip or .tgz containing them, or Contacts file.')
+  parser.add_argument('database', help='Name of database to create or append to.')
+  parser.add_argument('--contactcsv','-f',action='store',default='contacts.csv',help="File to write discovered contacts to.")
+  parser.add_argument('--clear',  help='Clear database prior to inserting new Google Voice records.', action='store_const', const=True, default=False)
+  parser.add_argument('--mynumbers', '-m', action='store',default='',help="Comma-delimited list of this account's phone numbers. Numbers without a country code are taken to be in the first one's country.")
+  parser.add_argument('--jobs', '-j', action='store', type=int, default=1, help='Number of processes to parse files with. 0 uses every core.')
+  parser.add_argument('--chunksize', action='store', type=int, default=None, help='Number of files handed to a parsing process at a time.')
+  parser.add_argument('--unordered', help='Collect parsed files in completion order rather than directory order.', action='store_const', const=True, default=False)
+  parser.add_argument('--engine', action='store', default='html5lib', choices=sorted(gvParserLib.Parser.engines), help='HTML parser to read the Google Voice files with.')
+  parser.add_argument('--prefetch', action='store', type=int, default=0, help='Number of files to read ahead of the parser on background threads.')
+  parser.add_argument('--prefetchmb', action='store', type=int, default=64, help='Most megabytes of files to hold read ahead with --prefetch.')
+  parser.add_argument('--ambiguities', action='store', default=None, help='CSV file to list names with several numbers, and numbers with several names, in.')
+  parser.add_argument('--cache', action='store', default=None, help='File to keep parsed records in, so that files seen before are not parsed again.')
+  parser.add_argument('--cachesize', action='store', type=int, default=256, help='Most megabytes of records to keep in the --cache file.')
+  parser.add_argument('--csv', action='store', default=None, help='Directory to also write the records to as CSV files, one per record type.')
+  parser.add_argument('--parquet', action='store', default=None, help='Directory to also write the records to as Parquet, partitioned by record type, year and month. Needs pyarrow.')
+  parser.add_argument('--fulltext', action='store_const', const=True, default=False, help='Keep full-text indexes of messages and voicemail transcripts, for gvquery.py search.')
+  parser.add_argument('--contactstats', action='store_const', const=True, default=False, help='Keep tables of the texts, calls and voicemails with each number, overall and per month, for gvquery.py summary and monthly.')
+  parser.add_argument('--rebuildstats', action='store_const', const=True, default=False, help='Work the --contactstats tables out again from the records before loading.')
+  parser.add_argument('--shards', help='With --jobs, have each parsing process write the records it parses to a database of its own, and merge these at the end.', action='store_const', const=True, default=False)
+  parser.add_argument('--stream', help='Stream records from the parser to the database instead of reading them all into memory first.', action='store_const', const=True, default=False)
+  parser.add_argument('--batchsize', action='store', type=int, default=5000, help='Number of rows written to the database per statement.')
+  parser.add_argument('--journalmode', action='store', default=None, choices=['DELETE','TRUNCATE','PERSIST','MEMORY','WAL','OFF'], help='SQLite journal mode to load with.')
+  parser.add_argument('--synchronous', action='store', default=None, choices=['OFF','NORMAL','FULL','EXTRA'], help='SQLite sync level to load with.')
+  parser.add_argument('--fingerprints', help='Keep an index of hashes of the records already loaded, and leave those out of the database and exports without looking each one up.', action='store_const', const=True, default=False)
+  parser.add_argument('--deferindexes', help='Drop the duplicate-catching indexes during the load and rebuild them at the end.', action='store_const', const=True, default=False)
+  parser.add_argument('--watch', help='After loading, keep watching the directory and load the files written to it, until interrupted.', action='store_const', const=True, default=False)
+  parser.add_argument('--latency', action='store', type=float, default=2.0, help='With --watch, the most seconds a new file waits to be loaded.')
+  parser.add_argument('--watchbatch', action='store', type=int, default=500, help='With --watch, the most files loaded in one batch.')
+  parser.add_argument('--status', action='store', default=None, help='With --watch, a file to keep throughput and backlog counters in as JSON.')
+  parser.add_argument('--stats', help='Report time spent in each phase of the load, and the slowest files.', action='store_const', const=True, default=False)
+  parser.add_argument('--statsjson', action='store', default=None, help='File to write the --stats figures to as JSON.')
+  parser.add_argument('--profile', action='store', default=None, help='File to write cProfile output to. Only covers the main process.')
+  args = parser.parse_args()
 
-  cur.execute('DELETE FROM contacts;')
-  ContactsToDB(cur,args.path)
-  conn.commit()
-"""
+  stats = None
+  if args.stats or args.statsjson:
+    stats = gvParserLib.PhaseStats()
+
+  profile = cProfile.Profile() if args.profile else None
+  start   = time.time()
+  try:
+    run = Watch if args.watch else Load
+    if profile:
+      profile.runcall(run,args,stats)
+    else:
+      run(args,stats)
+  finally:
+    if profile:
+      profile.dump_stats(args.profile)
+    if stats:
+      stats.add('total',time.time()-start)
+      if args.stats:
+        stats.report()
+      if args.statsjson:
+        with open(args.statsjson,'w') as f:
+          json.dump(stats.as_dict(),f,indent=2)
 
-conn.commit()
\ No newline at end of file
+if __name__=='__main__':
+  main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#Common queries over a database loaded by gvproc.py
+import os
+import sys
+import sqlite3
+import argparse
+import gvParserLib
+
+def OpenQueryDatabase(filename):
+  '''Connect to a database made by gvproc.py. Returns [conn,cur].'''
+  if not os.path.isfile(filename):
+    print "Database does not exist!"
+    sys.exit(-1)
+  conn = sqlite3.connect(filename)
+  cur  = conn.cursor()
+  return [conn,cur]
+
+def HasTextSearch(cur):
+  '''Whether gvproc.py --fulltext has made the full-text indexes'''
+  cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name IN ('texts_fts','audio_fts')")
+  return cur.fetchone()[0]==2
+
+def HasContactStats(cur):
+  '''Whether gvproc.py --contactstats has made the per-number summary tables'''
+  cur.execute("SELECT 1 FROM sqlite_master WHERE name='contact_stats'")
+  return cur.fetchone() is not None
+
+def CanonicalNumber(cur,number):
+  '''A number, written any way, in the canonical form gvproc.py keeps numbers
+     in, for the country of the account the database was loaded for. A
+     database loaded before numbers were made canonical has the number as it
+     is written.'''
+  cur.execute("SELECT 1 FROM sqlite_master WHERE name='number_format'")
+  if cur.fetchone() is None:
+    return number
+  row = cur.execute('SELECT country FROM number_format WHERE id=0').fetchone()
+  if row is None:
+    return number
+  return gvParserLib.PhoneNumbers(row[0]).canonical(number)
+
+def _RecordFilter(cur,number,name,start,end):
+  '''The WHERE clause and parameters picking out records with a number, or
+     with any of the numbers of a contact name, between two times. start is
+     inclusive and end exclusive; either may be a datetime or a string like
+     '2011-07-01'. Each condition is one the record tables are indexed on.'''
+  clauses = []
+  params  = []
+  if number is not None:
+    clauses.append('number=?')
+    params.append(CanonicalNumber(cur,number))
+  if name is not None:
+    clauses.append('contact_id IN (SELECT id FROM contacts WHERE name=?)')
+    params.append(name)
+  if start is not None:
+    clauses.append('time>=?')
+    params.append(start)
+  if end is not None:
+    clauses.append('time<?')
+    params.append(end)
+  if not clauses:
+    return ['',[]]
+  return ['WHERE '+' AND '.join(clauses),params]
+
+def Timeline(cur,number=None,name=None,start=None,end=None,limit=None):
+  '''Every text, call and voicemail with a number, or with a contact of this
+     name at any of their numbers, in time order. Returns a list of
+     (time,kind,number,type,text,duration) where kind is 'text', 'call' or
+     'audio' and type is the texttype, calltype or audio type.'''
+  [where,params] = _RecordFilter(cur,number,name,start,end)
+  query = '''SELECT time,'text',number,texttype,message,NULL FROM texts %s
+             UNION ALL SELECT time,'call',number,calltype,NULL,duration FROM calls %s
+             UNION ALL SELECT time,'audio',number,type,text,duration FROM audio %s
+             ORDER BY 1''' % (where,where,where)
+  params = params*3
+  if limit:
+    query += ' LIMIT ?'
+    params.append(limit)
+  cur.execute(query,params)
+  return cur.fetchall()
+
+def CallStats(cur,number=None,name=None,start=None,end=None):
+  '''The number and total length in seconds of each type of call, per number,
+     busiest first. Returns a list of (name,number,calltype,calls,seconds).
+     Without a number or name every call is counted, which reads the whole of
+     an index.'''
+  [where,params] = _RecordFilter(cur,number,name,start,end)
+  #Summing before joining lets the whole sum come from the calls_stats index
+  cur.execute('''SELECT contacts.name,sums.number,sums.calltype,sums.calls,sums.seconds FROM
+                   (SELECT number,calltype,COUNT(*) AS calls,IFNULL(SUM(duration),0) AS seconds
+                    FROM calls %s GROUP BY number,calltype) AS sums
+                 LEFT JOIN contacts ON contacts.number=sums.number
+                 ORDER BY sums.calls DESC''' % (where),params)
+  return cur.fetchall()
+
+def _NumberFilter(cur,number,name):
+  '''The WHERE clause and parameters picking out a number, or any of the
+     numbers of a contact name, from the summary tables'''
+  if number is not None:
+    return ['WHERE number=?',[CanonicalNumber(cur,number)]]
+  if name is not None:
+    return ['WHERE number IN (SELECT number FROM contacts WHERE name=?)',[name]]
+  return ['',[]]
+
+#Each record table's part in the summaries, when they have to be worked out
+_SUMMARY_PARTS = '''SELECT IFNULL(number,'') AS number, time, 1 AS texts, 0 AS calls, 0 AS call_seconds, 0 AS voicemails FROM texts
+                    UNION ALL SELECT IFNULL(number,''), time, 0, 1, IFNULL(duration,0), 0 FROM calls
+                    UNION ALL SELECT IFNULL(number,''), time, 0, 0, 0, type='voicemail' FROM audio'''
+
+def ContactSummary(cur,number=None,name=None):
+  '''The texts, calls, seconds on the phone and voicemails with a number, or
+     with each number of a contact name, or with every number, and the first
+     and last time of any of them, busiest first. Returns a list of
+     (name,number,texts,calls,call_seconds,voicemails,first_time,last_time).
+     With the --contactstats tables this is a lookup; without them every
+     record is read.'''
+  [where,params] = _NumberFilter(cur,number,name)
+  if HasContactStats(cur):
+    sums = 'SELECT * FROM contact_stats %s' % (where)
+  else:
+    sums = '''SELECT number,SUM(texts) AS texts,SUM(calls) AS calls,SUM(call_seconds) AS call_seconds,
+                     SUM(voicemails) AS voicemails,MIN(time) AS first_time,MAX(time) AS last_time
+              FROM (%s) %s GROUP BY number''' % (_SUMMARY_PARTS,where)
+  cur.execute('''SELECT contacts.name,sums.number,sums.texts,sums.calls,sums.call_seconds,sums.voicemails,sums.first_time,sums.last_time
+                 FROM (%s) AS sums LEFT JOIN contacts ON contacts.number=sums.number
+                 ORDER BY sums.texts+sums.calls+sums.voicemails DESC,sums.number''' % (sums),params)
+  return cur.fetchall()
+
+def MonthlySummary(cur,number=None,name=None):
+  '''ContactSummary month by month. Returns a list of (name,number,month,texts,
+     calls,call_seconds,voicemails,first_time,last_time) in month order, where
+     month is like '2011-07'.'''
+  [where,params] = _NumberFilter(cur,number,name)
+  if HasContactStats(cur):
+    sums = 'SELECT * FROM contact_month_stats %s' % (where)
+  else:
+    sums = '''SELECT number,strftime('%%Y-%%m',time) AS month,SUM(texts) AS texts,SUM(calls) AS calls,
+                     SUM(call_seconds) AS call_seconds,SUM(voicemails) AS voicemails,MIN(time) AS first_time,MAX(time) AS last_time
+              FROM (%s) %s GROUP BY number,month''' % (_SUMMARY_PARTS,where)
+  cur.execute('''SELECT contacts.name,sums.number,sums.month,sums.texts,sums.calls,sums.call_seconds,sums.voicemails,sums.first_time,sums.last_time
+                 FROM (%s) AS sums LEFT JOIN contacts ON contacts.number=sums.number
+                 ORDER BY sums.month,sums.number''' % (sums),params)
+  return cur.fetchall()
+
+def SearchTranscripts(cur,query,limit=50):
+  '''Texts and voicemail transcripts matching query, best matches first.
+     Returns a list of (time,kind,number,text). With the full-text indexes
+     query is an FTS5 query, e.g. 'dinner AND friday', and every match is
+     ranked, so a query matching much of the database is slow; without them it
+     is a plain substring, found by reading every row.'''
+  if not HasTextSearch(cur):
+    like = '%'+query+'%'
+    cur.execute('''SELECT time,'text',number,message FROM texts WHERE message LIKE ?
+                   UNION ALL SELECT time,'audio',number,text FROM audio WHERE text LIKE ?
+                   ORDER BY 1 DESC LIMIT ?''',(like,like,limit))
+    return cur.fetchall()
+
+  cur.execute('''SELECT time,kind,number,text FROM (
+                   SELECT texts.time AS time,'text' AS kind,texts.number AS number,texts.message AS text,texts_fts.rank AS rank
+                   FROM texts_fts JOIN texts ON texts.rowid=texts_fts.rowid WHERE texts_fts MATCH ?
+                   UNION ALL
+                   SELECT audio.time,'audio',audio.number,audio.text,audio_fts.rank
+                   FROM audio_fts JOIN audio ON audio.rowid=audio_fts.rowid WHERE audio_fts MATCH ?)
+                 ORDER BY rank LIMIT ?''',(query,query,limit))
+  return cur.fetchall()
+
+def PrintRows(rows):
+  for row in rows:
+    print '\t'.join((x if isinstance(x,unicode) else unicode(x if x is not None else '')) for x in row).encode('utf-8')
+
+def main():
+  parser = argparse.ArgumentParser(description='Query a database of Google Voice data loaded by gvproc.py.')
+  parser.add_argument('database', help='Database to query.')
+  subparsers = parser.add_subparsers(dest='command')
+
+  timeline = subparsers.add_parser('timeline', help='Texts, calls and voicemails with a number or contact, in time order.')
+  calls    = subparsers.add_parser('calls',    help='Number and length of calls per number and call type.')
+  for p in (timeline,calls):
+    p.add_argument('--number', action='store', default=None, help='Only records with this number.')
+    p.add_argument('--name',   action='store', default=None, help='Only records with any of the numbers of this contact.')
+    p.add_argument('--start',  action='store', default=None, help='Only records at or after this time, e.g. 2011-07-01.')
+    p.add_argument('--end',    action='store', default=None, help='Only records before this time.')
+  timeline.add_argument('--limit', action='store', type=int, default=None, help='Most records to list.')
+
+  summary = subparsers.add_parser('summary', help='Texts, calls and voicemails per number, with the first and last of them.')
+  monthly = subparsers.add_parser('monthly', help='Texts, calls and voicemails per number and month.')
+  for p in (summary,monthly):
+    p.add_argument('--number', action='store', default=None, help='Only this number.')
+    p.add_argument('--name',   action='store', default=None, help='Only the numbers of this contact.')
+
+  search = subparsers.add_parser('search', help='Search texts and voicemail transcripts.')
+  search.add_argument('query', help='Words to search for.')
+  search.add_argument('--limit', action='store', type=int, default=50, help='Most records to list.')
+  args = parser.parse_args()
+
+  [conn,cur] = OpenQueryDatabase(args.database)
+  if args.command=='timeline':
+    PrintRows(Timeline(cur,args.number,args.name,args.start,args.end,args.limit))
+  elif args.command=='calls':
+    PrintRows(CallStats(cur,args.number,args.name,args.start,args.end))
+  elif args.command=='summary':
+    PrintRows(ContactSummary(cur,args.number,args.name))
+  elif args.command=='monthly':
+    PrintRows(MonthlySummary(cur,args.number,args.name))
+  elif args.command=='search':
+    PrintRows(SearchTranscripts(cur,args.query,args.limit))
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,248 @@
+#Checks that gvproc.py's ways of loading the same files give the same output
+import os
+import sys
+import gc
+import glob
+import json
+import time
+import shutil
+import signal
+import sqlite3
+import tarfile
+import datetime
+import tempfile
+import subprocess
+import unittest
+import gvproc
+import gvbench
+import gvParserLib
+
+GVPROC = os.path.join(os.path.dirname(os.path.abspath(gvproc.__file__)), 'gvproc.py')
+
+def ReadCSVs(directory):
+  '''Each CSV file's header, and its rows in sorted order'''
+  tables = {}
+  for table in gvproc.RECORD_COLUMNS:
+    with open(os.path.join(directory, table+'.csv'), 'rb') as f:
+      lines = f.read().splitlines()
+    tables[table] = [lines[0], sorted(lines[1:])]
+  return tables
+
+def ReadParquet(directory):
+  '''Each record table's rows, in sorted order, with times as microseconds'''
+  import pyarrow
+  import pyarrow.parquet
+  tables = {}
+  for table in gvproc.RECORD_COLUMNS:
+    rows = []
+    for part in glob.glob(os.path.join(directory, table, '*', '*', '*.parquet')):
+      part    = pyarrow.parquet.read_table(part)
+      columns = [part.column(name) for name in gvproc.RECORD_COLUMNS[table]]
+      columns = [c.cast(pyarrow.int64()) if name=='time' else c for name, c in zip(gvproc.RECORD_COLUMNS[table], columns)]
+      rows.extend(zip(*[c.to_pylist() for c in columns]))
+    tables[table] = sorted(rows)
+  return tables
+
+class SinkTest(unittest.TestCase):
+  '''The rows written to the CSV and Parquet exports by each way of loading'''
+  @classmethod
+  def setUpClass(cls):
+    cls.scratch = tempfile.mkdtemp(prefix='gvtest')
+    cls.corpus  = os.path.join(cls.scratch, 'takeout')
+    gvbench.GenerateTakeout(cls.corpus, conversations=30, messages=10, calls=60, voicemails=20, multiway=2, contacts=20, seed=5)
+    try:
+      import pyarrow
+      cls.parquet = True
+    except ImportError:
+      cls.parquet = False
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.scratch)
+
+  def Load(self, name, *options):
+    '''Load the corpus into a new database with options, returning the directory written to'''
+    out  = os.path.join(self.scratch, name)
+    args = [sys.executable, GVPROC, self.corpus, os.path.join(out, 'gv.db'), '-f', os.path.join(out, 'contacts.csv'),
+            '-m', gvbench.MYNUMBER.lstrip('+'), '--csv', os.path.join(out, 'csv')]
+    if self.parquet:
+      args += ['--parquet', os.path.join(out, 'parquet')]
+    os.makedirs(out)
+    with open(os.devnull, 'w') as devnull:
+      subprocess.check_call(args+list(options), stdout=devnull)
+    return out
+
+  def test_stream_matches_batch(self):
+    batch  = self.Load('batch')
+    stream = self.Load('stream', '--stream')
+    self.assertEqual(ReadCSVs(os.path.join(stream, 'csv')), ReadCSVs(os.path.join(batch, 'csv')))
+    if self.parquet:
+      self.assertEqual(ReadParquet(os.path.join(stream, 'parquet')), ReadParquet(os.path.join(batch, 'parquet')))
+
+  def test_whole_seconds(self):
+    calls = ReadCSVs(os.path.join(self.Load('seconds', '--stream'), 'csv'))['calls'][1]
+    durations = [line.split(',')[2] for line in calls]
+    self.assertTrue(any(durations))
+    self.assertTrue(all(d=='' or d.isdigit() for d in durations), durations)
+
+def CountRows(database):
+  '''How many rows each record table of database has, and the file manifest'''
+  conn = sqlite3.connect(database)
+  try:
+    return dict((table,conn.execute('SELECT COUNT(*) FROM %s' % (table)).fetchone()[0]) for table in list(gvproc.RECORD_COLUMNS)+['files'])
+  finally:
+    conn.close()
+
+class ManifestTest(unittest.TestCase):
+  '''The file manifest after a load that stops part way'''
+  @classmethod
+  def setUpClass(cls):
+    cls.scratch = tempfile.mkdtemp(prefix='gvtest')
+    corpus      = cls.corpus = os.path.join(cls.scratch, 'takeout')
+    gvbench.GenerateTakeout(corpus, conversations=40, messages=5, calls=100, voicemails=20, multiway=0, contacts=20, seed=9)
+    names = sorted(os.listdir(corpus))
+    #A call whose time cannot be read, which stops a load
+    with open(os.path.join(corpus, 'Nobody - Placed - 2011-01-01T00_00_00Z.html'), 'w') as f:
+      f.write(gvbench.HEADER % 'Nobody' + gvbench.CALL % ('Nobody', 'Nobody', gvbench.TEL % ('+15559999999', 'Nobody'),
+              'not a time', 'never', '', gvbench.TAGS % ('placed', 'Placed')) + gvbench.FOOTER)
+    #A tar archive is read in order, so the bad file comes after the others' records are written
+    cls.good = os.path.join(cls.scratch, 'good.tgz')
+    cls.bad  = os.path.join(cls.scratch, 'bad.tgz')
+    for archive, members in ((cls.good, names), (cls.bad, names+['Nobody - Placed - 2011-01-01T00_00_00Z.html'])):
+      with tarfile.open(archive, 'w:gz') as tar:
+        for name in members:
+          tar.add(os.path.join(corpus, name), name)
+    expected = os.path.join(cls.scratch, 'expected.db')
+    cls.Run(cls.good, expected)
+    cls.expected = CountRows(expected)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.scratch)
+
+  @classmethod
+  def Args(cls, takeout, database, *options):
+    '''gvproc.py's arguments to load takeout into database with options'''
+    contacts = tempfile.mktemp(suffix='.csv', dir=cls.scratch)
+    return [GVPROC, takeout, database, '-f', contacts, '-m', gvbench.MYNUMBER.lstrip('+')]+list(options)
+
+  @classmethod
+  def Run(cls, takeout, database, *options):
+    '''Load takeout into database with options, returning gvproc.py's exit code'''
+    with open(os.devnull, 'w') as devnull:
+      return subprocess.call([sys.executable]+cls.Args(takeout, database, *options), stdout=devnull, stderr=devnull)
+
+  def test_rerun_after_failure(self):
+    expected = self.expected
+    for options in (['--stream', '--deferindexes', '--batchsize', '10'], ['--stream'], []):
+      database = tempfile.mktemp(suffix='.db', dir=self.scratch)
+      self.assertNotEqual(self.Run(self.bad, database, *options), 0, options)
+      self.assertEqual(CountRows(database)['files'], 0, options)
+      #The files read before the failure are loaded again
+      self.assertEqual(self.Run(self.good, database, *options), 0, options)
+      self.assertEqual(CountRows(database), expected, options)
+
+  def test_interrupted_shard_merge(self):
+    database = tempfile.mktemp(suffix='.db', dir=self.scratch)
+    options  = ['--jobs', '2', '--shards']
+    def Interrupt(*args):
+      raise KeyboardInterrupt
+    [argv, stdout, contacts] = [sys.argv, sys.stdout, gvproc.ContactsToDB]
+    [sys.argv, sys.stdout, gvproc.ContactsToDB] = [self.Args(self.good, database, *options), open(os.devnull, 'w'), Interrupt]
+    try:
+      self.assertRaises(KeyboardInterrupt, gvproc.main)
+    finally:
+      sys.stdout.close()
+      [sys.argv, sys.stdout, gvproc.ContactsToDB] = [argv, stdout, contacts]
+      sys.exc_clear()
+      gc.collect() #the load's connection, which rolls back as it closes
+    self.assertEqual(sum(CountRows(database).values()), 0)
+    self.assertEqual(self.Run(self.good, database, *options), 0)
+    self.assertEqual(CountRows(database), self.expected)
+
+  def Watch(self, database):
+    '''Watch the corpus, good files and bad, until the first load is done.
+       Returns the status it reported.'''
+    status  = tempfile.mktemp(suffix='.json', dir=self.scratch)
+    args    = [sys.executable]+self.Args(self.corpus, database, '--watch', '--status', status)
+    with open(os.devnull, 'w') as devnull:
+      watcher = subprocess.Popen(args, stdout=devnull, stderr=devnull)
+      for i in range(600):
+        if os.path.exists(status) or watcher.poll() is not None:
+          break
+        time.sleep(0.1)
+      if watcher.poll() is None:
+        watcher.send_signal(signal.SIGTERM)
+      self.assertEqual(watcher.wait(), 0)
+    with open(status) as f:
+      return json.load(f)
+
+  def test_watch_bad_file(self):
+    database = tempfile.mktemp(suffix='.db', dir=self.scratch)
+    status   = self.Watch(database)
+    self.assertEqual(status['failed_files'], 1)
+    #Every good file is loaded, and the bad one is in the manifest too
+    self.assertEqual(CountRows(database), dict(self.expected, files=self.expected['files']+1))
+    #Started again, it does not try the bad file again
+    status = self.Watch(database)
+    self.assertEqual([status['files'], status['failed_files']], [0, 0])
+
+class SavedIndexTest(unittest.TestCase):
+  '''The contact and fingerprint indexes, saved between runs a little at a time'''
+  def setUp(self):
+    self.conn = sqlite3.connect(':memory:')
+    self.cur  = self.conn.cursor()
+    gvproc.NewDatabase(self.cur)
+    gvproc.UpgradeDatabase(self.cur)
+
+  def Calls(self, first, count):
+    '''count calls, one to each number from first on'''
+    return [('calls', (datetime.datetime(2011, 1, 1, 0, 0, i % 60), '1555%07d' % (i), 60, 'Placed')) for i in range(first, first+count)]
+
+  def test_fingerprint_runs(self):
+    for run in range(3*gvproc.FingerprintIndex.maxruns):
+      seen = gvproc.FingerprintIndex.Load(self.cur)
+      #This run's calls, and some of the last run's again
+      kept = list(seen.FilterNew(self.Calls(max(run*5-2, 0), 5 if run==0 else 7)))
+      self.assertEqual(len(kept), 5, run)
+      gvproc.SQLiteSink(self.cur).write('calls', [row for table, row in kept])
+      seen.Save(self.cur)
+      self.assertLess(self.cur.execute('SELECT COUNT(*) FROM fingerprint_runs').fetchone()[0], gvproc.FingerprintIndex.maxruns)
+    self.assertEqual(self.cur.execute('SELECT records FROM fingerprint_index').fetchone()[0], 5*run+5)
+    saved = gvproc.FingerprintIndex.Load(self.cur).fingerprints
+    self.cur.execute('DELETE FROM fingerprint_index')
+    self.assertEqual(saved, gvproc.FingerprintIndex.Load(self.cur).fingerprints)
+
+  def test_contact_index(self):
+    index = gvproc.ContactIndex()
+    for pair in [('A', '15550000001'), ('B', None), ('A', '15550000001'), (None, '15550000002')]:
+      index.add_pair(*pair)
+    gvproc.SaveContactIndex(self.cur, index)
+    for pair in [('B', None), ('C', '15550000003'), ('A', '15550000001')]:
+      index.add_pair(*pair)
+    gvproc.SaveContactIndex(self.cur, index)
+    self.assertEqual(gvproc.LoadContactIndex(self.cur).pair_freq, index.pair_freq)
+    self.assertEqual(self.cur.execute('SELECT COUNT(*) FROM contact_index').fetchone()[0], 4)
+
+  def test_canonical_contact_index(self):
+    self.cur.executemany('INSERT INTO contact_index (name,number,count) VALUES (?,?,?)',
+                         [('A', '555-000-0001', 2), ('B', '15550000002', 1), ('A', '15550000001', 3), ('A', '(555) 000-0001', 1)])
+    gvproc.CanonicalNumbers(self.cur, gvParserLib.PhoneNumbers('1'))
+    self.assertEqual(self.cur.execute('SELECT name,number,count FROM contact_index ORDER BY rowid').fetchall(),
+                     [('A', '15550000001', 6), ('B', '15550000002', 1)])
+
+  def test_link_contacts(self):
+    self.cur.execute("INSERT INTO contacts (name,number) VALUES ('A','15550000000')")
+    gvproc.SQLiteSink(self.cur).write('calls', [row for table, row in self.Calls(0, 3)])
+    gvproc.LinkContacts(self.cur)
+    since = gvproc.LastRowids(self.cur)
+    #A new record of an old contact, and an old record of a new one
+    gvproc.SQLiteSink(self.cur).write('calls', [(datetime.datetime(2012, 1, 1), '15550000000', 60, 'Placed')]+[row for table, row in self.Calls(3, 2)])
+    self.cur.execute("INSERT INTO contacts (name,number) VALUES ('B','15550000001'),('D','15550000003')")
+    gvproc.LinkContacts(self.cur, since)
+    self.assertEqual(self.cur.execute('SELECT calls.number,name FROM calls LEFT JOIN contacts ON contact_id=contacts.id ORDER BY calls.rowid').fetchall(),
+                     [('15550000000', 'A'), ('15550000001', 'B'), ('15550000002', None),
+                      ('15550000000', 'A'), ('15550000003', 'D'), ('15550000004', None)])
+
+if __name__=='__main__':
+  unittest.main()
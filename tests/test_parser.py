@@ -0,0 +1,198 @@
+#Checks that gvParserLib's different ways of reading a file give the same records
+import os
+import shutil
+import tempfile
+import unittest
+import gvParserLib
+import gvbench
+from gvbench import RecordFields
+
+MYNUMBERS = [gvbench.MYNUMBER.lstrip('+')]
+
+def ReadFile(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+class ConversationTest(unittest.TestCase):
+  '''Conversations read incrementally against the same ones read as a tree'''
+  @classmethod
+  def setUpClass(cls):
+    cls.corpus  = tempfile.mkdtemp(prefix='gvtest')
+    takeout     = gvbench.SyntheticTakeout(cls.corpus, contacts=20, seed=7)
+    for messages in (1, 2, 40, 400):
+      takeout.conversation(messages)
+    takeout.conversation(60, multiway=True)
+    cls.files = sorted(os.path.join(cls.corpus, fl) for fl in os.listdir(cls.corpus))
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.corpus)
+
+  def setUp(self):
+    self.iterparse_bytes = gvParserLib.Parser.iterparse_bytes
+
+  def tearDown(self):
+    gvParserLib.Parser.iterparse_bytes = self.iterparse_bytes
+    gvParserLib.Parser.stream_texts    = False
+
+  def Parse(self, path, engine, iterparse_bytes, stream_texts=False):
+    gvParserLib.Parser.iterparse_bytes = iterparse_bytes
+    gvParserLib.Parser.stream_texts    = stream_texts
+    return gvParserLib.Parser.process_bytes(ReadFile(path), path, MYNUMBERS, engine)
+
+  def Texts(self, record):
+    return [RecordFields(txt) for txt in record]
+
+  def test_incremental_matches_tree(self):
+    for path in self.files:
+      tree = self.Parse(path, 'lxml', 1 << 40)
+      self.assertIsInstance(tree, gvParserLib.TextConversationList)
+      self.assertEqual(self.Texts(self.Parse(path, 'html5lib', 0)), self.Texts(tree), path)
+
+      listed = self.Parse(path, 'lxml', 0)
+      self.assertIsInstance(listed, gvParserLib.TextConversationList)
+      self.assertEqual(RecordFields(listed), RecordFields(tree), path)
+
+      stream = self.Parse(path, 'lxml', 0, stream_texts=True)
+      self.assertIsInstance(stream, gvParserLib.TextConversationStream)
+      self.assertEqual(self.Texts(stream), self.Texts(tree), path)
+      #Reading it again reads the file again
+      self.assertEqual(self.Texts(stream), self.Texts(tree), path)
+
+      texts = gvParserLib.TextConversationList.iter_texts(ReadFile(path), path, MYNUMBERS)
+      self.assertEqual(self.Texts(texts), self.Texts(tree), path)
+
+  def test_stream_batch_matches_tree(self):
+    for path in self.files:
+      tree   = gvParserLib.RecordBatch([self.Parse(path, 'lxml', 1 << 40)])
+      stream = gvParserLib.RecordBatch([self.Parse(path, 'lxml', 0, stream_texts=True)])
+      self.assertEqual([RecordFields(r) for r in stream], [RecordFields(r) for r in tree], path)
+
+  def test_no_conversation(self):
+    path = os.path.join(self.corpus, 'Nobody - Text - 2011-01-01T00_00_00Z.html')
+    with open(path, 'w') as f:
+      f.write(gvbench.HEADER % 'Nobody' + '<div class="hChatLog hfeed">\n</div>\n' + gvbench.FOOTER)
+    try:
+      self.assertIsNone(gvParserLib.TextConversationStream.from_bytes(ReadFile(path), path, MYNUMBERS))
+      self.assertEqual(list(gvParserLib.TextConversationList.iter_texts(ReadFile(path), path, MYNUMBERS)), [])
+    finally:
+      os.remove(path)
+
+class EngineTest(unittest.TestCase):
+  '''Every registered parser engine against html5lib's records'''
+  @classmethod
+  def setUpClass(cls):
+    cls.corpus = tempfile.mkdtemp(prefix='gvtest')
+    gvbench.GenerateTakeout(cls.corpus, conversations=20, messages=10, calls=30, voicemails=15, words=20, multiway=2, contacts=10, seed=11)
+    #A transcript without word confidences has no mean confidence
+    gvbench.SyntheticTakeout(cls.corpus, contacts=1, seed=12).voicemail(10, confidences=False)
+    #Bodies full of named, numeric and bogus entities and emoji references. Takeout
+    #escapes a literal '&', so a malformed numeric reference is only ever written so.
+    bodies = [body.replace(u'&#xZZ;', u'&amp;#xZZ;') for body in gvbench.UnescapeBodies(count=60, seed=3)]
+    sender = gvbench.TEL % (gvbench.MYNUMBER, 'Me')
+    with open(os.path.join(cls.corpus, 'Entities - Text - 2011-01-01T00_00_00Z.html'), 'w') as f:
+      f.write(gvbench.HEADER % 'Entities')
+      f.write('<div class="hChatLog hfeed">\n')
+      for i, body in enumerate(bodies):
+        f.write(gvbench.MESSAGE % ('2011-01-01T00:%02d:%02d.000Z' % (i // 60, i % 60), 'Jan 1, 2011', sender, body.encode('ascii')))
+      f.write('</div>\n')
+      f.write(gvbench.FOOTER)
+    cls.files = sorted(os.path.join(cls.corpus, fl) for fl in os.listdir(cls.corpus))
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.corpus)
+
+  def test_engines_agree(self):
+    kinds = set()
+    for path in self.files:
+      expected = gvParserLib.Parser.process_file(path, MYNUMBERS, 'html5lib')
+      kinds.add(expected.__class__.__name__)
+      if isinstance(expected, gvParserLib.AudioRecord):
+        self.assertTrue(expected.text, path)
+      for engine in sorted(gvParserLib.Parser.engines):
+        record = gvParserLib.Parser.process_file(path, MYNUMBERS, engine)
+        self.assertEqual(RecordFields(record), RecordFields(expected), '%s: %s' % (engine, path))
+    self.assertEqual(kinds, set(['TextConversationList', 'CallRecord', 'AudioRecord']))
+
+  def test_number_batch(self):
+    numbers = gvParserLib.NumberBatch()
+    records = []
+    gvParserLib.Parser.numbers = numbers
+    try:
+      for path in self.files:
+        records.append(gvParserLib.Parser.process_file(path, MYNUMBERS, 'lxml'))
+    finally:
+      gvParserLib.Parser.numbers = None
+    numbers.convert()
+    confidences = set()
+    for path, record in zip(self.files, records):
+      self.assertEqual(RecordFields(record), RecordFields(gvParserLib.Parser.process_file(path, MYNUMBERS, 'lxml')), path)
+      if isinstance(record, gvParserLib.AudioRecord):
+        confidences.add(record.confidences is not None)
+        self.assertEqual(record.confidences is None, record.confidence is None, path)
+    self.assertEqual(confidences, set([True, False]))
+
+  def test_entities(self):
+    path  = os.path.join(self.corpus, 'Entities - Text - 2011-01-01T00_00_00Z.html')
+    texts = [txt.text for txt in gvParserLib.Parser.process_file(path, MYNUMBERS, 'lxml')]
+    self.assertEqual(len(texts), 60)
+    self.assertTrue(any(u'\u2600' <= c for text in texts for c in text)) #emoji, or their surrogates
+    self.assertTrue(any(u'&bogus;' in text for text in texts))
+    self.assertTrue(any(u'&#xZZ;' in text for text in texts))
+
+class PhoneNumbersTest(unittest.TestCase):
+  '''Numbers as Takeout and contacts CSVs write them, in canonical form'''
+  def test_north_america(self):
+    numbers = gvParserLib.PhoneNumbers('1')
+    for written in ('+1 555-123-4567', '+15551234567', '15551234567', '1-555-123-4567', '5551234567',
+                    '555-123-4567', '(555) 123-4567', 'tel:+15551234567', 'tel:+1-555-123-4567;ext=22'):
+      self.assertEqual(numbers.canonical(written), '15551234567', written)
+    self.assertEqual(numbers.canonical('(555) 000-0001'), '15550000001')
+    #Short codes, and numbers that cannot be North American, are left as they are
+    self.assertEqual(numbers.canonical('12345'), '12345')
+    self.assertEqual(numbers.canonical('0123456789'), '0123456789')
+    #International, with a '+' or the 011 exit code
+    for written in ('+44 20 7946 0958', '011 44 20 7946 0958', '+442079460958'):
+      self.assertEqual(numbers.canonical(written), '442079460958', written)
+    #Anything without digits is kept as it is
+    for written in (None, '', 'Unknown'):
+      self.assertEqual(numbers.canonical(written), written)
+
+  def test_other_country(self):
+    numbers = gvParserLib.PhoneNumbers('44')
+    for written in ('020 7946 0958', '+44 20 7946 0958', '0044 20 7946 0958', '442079460958'):
+      self.assertEqual(numbers.canonical(written), '442079460958', written)
+    self.assertEqual(numbers.canonical('+1 555-123-4567'), '15551234567')
+    self.assertEqual(numbers.canonical('001 555 123 4567'), '15551234567')
+    self.assertEqual(numbers.canonical('12345'), '12345')
+
+  def test_pooled(self):
+    numbers = gvParserLib.PhoneNumbers('1')
+    self.assertIs(numbers.canonical('+1 555-123-4567'), numbers.canonical('(555) 123-4567'))
+
+  def test_for_account(self):
+    account = gvParserLib.PhoneNumbers.for_account(['(555) 000-0000', '+1 555 000 0001'])
+    self.assertEqual(account.country, '1')
+    self.assertEqual(account.mynumbers, ['15550000000', '15550000001'])
+    #The same account, by the numbers as written or made canonical
+    self.assertIs(gvParserLib.PhoneNumbers.for_account(['(555) 000-0000', '+1 555 000 0001']), account)
+    self.assertIs(gvParserLib.PhoneNumbers.for_account(account.mynumbers), account)
+    self.assertIs(gvParserLib.PhoneNumbers.for_account(account.mynumbers, '1'), account)
+
+    #The country is that of the first number written with one
+    self.assertEqual(gvParserLib.PhoneNumbers.for_account(['5550000000']).country, '1')
+    self.assertEqual(gvParserLib.PhoneNumbers.for_account(['020 7946 0000', '+44 20 7946 0000']).country, '44')
+    self.assertEqual(gvParserLib.PhoneNumbers.for_account(['+33 1 23 45 67 89']).country, '33')
+    self.assertEqual(gvParserLib.PhoneNumbers.for_account(['+353 1 234 5678']).country, '353')
+    french = gvParserLib.PhoneNumbers.for_account(['+33 1 23 45 67 89'])
+    self.assertEqual(french.mynumbers, ['33123456789'])
+    self.assertEqual(french.canonical('01 23 45 67 80'), '33123456780')
+    #which canonical numbers do not always tell, so it can be given
+    self.assertEqual(gvParserLib.PhoneNumbers.for_account(['33123456780']).country, '1')
+    self.assertEqual(gvParserLib.PhoneNumbers.for_account(['33123456780'], '33').country, '33')
+    #and by the numbers it was first made with
+    self.assertIs(gvParserLib.PhoneNumbers.for_account(['33123456789']), french)
+
+if __name__=='__main__':
+  unittest.main()